@@ -27,9 +27,15 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import numpy
+from cython.operator cimport dereference as deref
 from libcpp cimport bool
+from libcpp.string cimport string
+from libcpp.unordered_map cimport unordered_map
 from libcpp.vector cimport vector
 from libc.stdint cimport uint32_t, uint64_t
+from libc.stdlib cimport strtod, strtoll
+from loom.schema import MODEL_TO_DATATYPE
 
 
 cdef extern from "loom/schema.pb.h":
@@ -327,6 +333,373 @@ def assignment_stream_load(char * filename):
     del f
 
 
+def assignment_stream_load_array(char * filename):
+    '''
+    Load an assignment stream as a pair of numpy arrays (rowids, groupids),
+    where rowids is a uint64 array of shape [row_count] and groupids is a
+    uint32 array of shape [row_count, kind_count].
+    '''
+    cdef InFile * f = new InFile(filename)
+    cdef Assignment message = Assignment()
+    cdef vector[uint64_t] rowids
+    cdef vector[uint32_t] groupids
+    cdef int kind_count = -1
+    cdef int kindid
+    cdef size_t i
+    cdef uint64_t[:] rowids_view
+    cdef uint32_t[:] groupids_view
+    try:
+        while f.try_read_stream(message.ptr[0]):
+            if kind_count == -1:
+                kind_count = message.ptr.groupids_size()
+            elif message.ptr.groupids_size() != kind_count:
+                raise ValueError(
+                    'inconsistent kind count in {}'.format(filename))
+            rowids.push_back(message.ptr.rowid())
+            for kindid in xrange(kind_count):
+                groupids.push_back(message.ptr.groupids(kindid))
+    finally:
+        del f
+    kind_count = max(kind_count, 0)
+    rowids_array = numpy.empty(rowids.size(), dtype=numpy.uint64)
+    groupids_array = numpy.empty(
+        (rowids.size(), kind_count),
+        dtype=numpy.uint32)
+    rowids_view = rowids_array
+    groupids_view = groupids_array.reshape(-1)
+    for i in xrange(rowids.size()):
+        rowids_view[i] = rowids[i]
+    for i in xrange(groupids.size()):
+        groupids_view[i] = groupids[i]
+    return rowids_array, groupids_array
+
+
+cdef enum Datatype:
+    DATATYPE_BOOLEANS
+    DATATYPE_COUNTS
+    DATATYPE_REALS
+
+
+cdef dict DATATYPES = {
+    'booleans': DATATYPE_BOOLEANS,
+    'counts': DATATYPE_COUNTS,
+    'reals': DATATYPE_REALS,
+}
+
+
+cdef enum Parser:
+    PARSE_SYMBOL
+    PARSE_COUNT
+    PARSE_REAL
+
+
+cdef enum CsvState:
+    CSV_START_RECORD
+    CSV_START_FIELD
+    CSV_IN_FIELD
+    CSV_IN_QUOTED_FIELD
+    CSV_QUOTE_IN_QUOTED_FIELD
+    CSV_EAT_LF
+
+
+CSV_BLOCK_SIZE = 2 ** 20
+
+
+cdef inline bool is_space(char c):
+    return (
+        c == c' ' or c == c'\t' or c == c'\n' or c == c'\r' or
+        c == c'\x0b' or c == c'\x0c')
+
+
+cdef bytes to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    else:
+        return str(value)
+
+
+cdef class RowEncoder:
+    '''
+    Encodes csv rows to a Row stream, parsing csv and feature values in C.
+    This is built from a list of encoders as dumped by make_encoding,
+    where every bb, dd and dpd encoder has symbols.
+    Values missing from the symbols of a truncated encoder are encoded as
+    unobserved, since dpd models cannot learn from OTHER.
+    '''
+    cdef vector[string] names
+    cdef vector[int] datatypes
+    cdef vector[int] parsers
+    cdef vector[unordered_map[string, uint32_t]] symbols
+    cdef vector[bool] truncated
+    cdef vector[int] column_slots
+    cdef vector[string] header
+    cdef vector[string] values
+    cdef string field
+    cdef size_t column
+    cdef bool reading_header
+    cdef uint64_t row_count
+    cdef uint64_t id_offset
+    cdef uint64_t id_stride
+    cdef Row_cc * row
+    cdef OutFile * out
+
+    def __cinit__(self):
+        self.row = new Row_cc()
+        self.out = NULL
+
+    def __dealloc__(self):
+        del self.row
+        if self.out != NULL:
+            del self.out
+
+    def __init__(self, encoders):
+        cdef unordered_map[string, uint32_t] table
+        for encoder in encoders:
+            name = to_bytes(encoder['name'])
+            model = encoder['model']
+            if model not in MODEL_TO_DATATYPE:
+                raise ValueError('unknown model {}'.format(model))
+            datatype = MODEL_TO_DATATYPE[model]
+            table.clear()
+            if 'symbols' in encoder:
+                parser = PARSE_SYMBOL
+                for key, value in encoder['symbols'].iteritems():
+                    table[to_bytes(key)] = value
+            elif datatype == 'counts':
+                parser = PARSE_COUNT
+            elif datatype == 'reals':
+                parser = PARSE_REAL
+            else:
+                raise ValueError('missing symbols for {}'.format(name))
+            self.names.push_back(name)
+            self.datatypes.push_back(DATATYPES[datatype])
+            self.parsers.push_back(parser)
+            self.symbols.push_back(table)
+            self.truncated.push_back(encoder.get('truncated', False))
+        self.values.resize(self.names.size())
+
+    cdef int _set_header(self, vector[string] & header) except -1:
+        cdef size_t pos
+        cdef size_t slot
+        cdef dict name_to_pos = {}
+        for pos in xrange(header.size()):
+            name_to_pos[header[pos]] = pos
+        self.column_slots.assign(header.size(), -1)
+        for slot in xrange(self.names.size()):
+            found = name_to_pos.get(self.names[slot])
+            if found is not None:
+                self.column_slots[found] = slot
+        return 0
+
+    cdef int _save_field(self) except -1:
+        cdef int slot
+        if self.reading_header:
+            self.header.push_back(self.field)
+        elif self.column < self.column_slots.size():
+            slot = self.column_slots[self.column]
+            if slot >= 0:
+                self.values[slot].swap(self.field)
+        self.field.clear()
+        self.column += 1
+        return 0
+
+    cdef int _end_record(self) except -1:
+        cdef size_t column_count = self.column
+        cdef size_t slot
+        cdef string * text
+        cdef char * begin
+        cdef char * end
+        cdef char * stop
+        cdef string key
+        cdef unordered_map[string, uint32_t].iterator found
+        cdef long long count
+        cdef uint32_t code = 0
+        cdef double real = 0
+        cdef Value_cc * value
+        cdef Observed_cc * observed
+
+        self.column = 0
+        if self.reading_header:
+            self.reading_header = False
+            self._set_header(self.header)
+            return 0
+        if column_count != self.column_slots.size():
+            raise ValueError('row {} has wrong length {}'.format(
+                self.row_count,
+                column_count))
+
+        self.row.Clear()
+        self.row.neg().observed().set_sparsity(SPARSITY_NONE)
+        value = self.row.pos()
+        observed = value.observed()
+        observed.set_sparsity(SPARSITY_DENSE)
+        self.row.set_id(self.id_offset + self.id_stride * self.row_count)
+        for slot in xrange(self.names.size()):
+            text = &self.values[slot]
+            begin = <char *> text.c_str()
+            end = begin + text.size()
+            while begin != end and is_space(begin[0]):
+                begin += 1
+            while begin != end and is_space(end[-1]):
+                end -= 1
+            if begin == end:
+                observed.add_dense(False)
+                continue
+
+            if self.parsers[slot] == PARSE_SYMBOL:
+                key.assign(begin, end - begin)
+                found = self.symbols[slot].find(key)
+                if found == self.symbols[slot].end():
+                    if not self.truncated[slot]:
+                        raise KeyError(key)
+                    observed.add_dense(False)
+                    text.clear()
+                    continue
+                code = deref(found).second
+            elif self.parsers[slot] == PARSE_COUNT:
+                count = strtoll(begin, &stop, 10)
+                if stop != end or count < 0 or count > 0xFFFFFFFF:
+                    raise ValueError('invalid count: {}'.format(
+                        begin[:end - begin]))
+                code = count
+            else:
+                real = strtod(begin, &stop)
+                if stop != end:
+                    raise ValueError('invalid real: {}'.format(
+                        begin[:end - begin]))
+
+            observed.add_dense(True)
+            if self.datatypes[slot] == DATATYPE_BOOLEANS:
+                value.add_booleans(code != 0)
+            elif self.datatypes[slot] == DATATYPE_COUNTS:
+                value.add_counts(code)
+            else:
+                value.add_reals(real)
+            text.clear()
+
+        self.out.write_stream(self.row[0])
+        self.row_count += 1
+        return 0
+
+    def dump_csv(
+            self,
+            f,
+            char * rows_out,
+            uint64_t id_offset=0,
+            uint64_t id_stride=1,
+            header=None,
+            Py_ssize_t size=-1):
+        '''
+        Encode csv rows read from file f and write them to rows_out,
+        returning the number of rows written.
+        If header is None, the first csv row is the header.
+        If size >= 0, only size bytes are read from f.
+        '''
+        cdef bytes block
+        cdef char * data
+        cdef Py_ssize_t length
+        cdef Py_ssize_t i
+        cdef char c
+        cdef CsvState state = CSV_START_RECORD
+        cdef vector[string] header_names
+
+        self.row_count = 0
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.column = 0
+        self.field.clear()
+        self.header.clear()
+        for i in xrange(self.values.size()):
+            self.values[i].clear()
+        if header is None:
+            self.reading_header = True
+        else:
+            self.reading_header = False
+            header_names = [to_bytes(name) for name in header]
+            self._set_header(header_names)
+
+        make_dir_for(rows_out)
+        self.out = new OutFile(rows_out)
+        try:
+            while size != 0:
+                if size < 0:
+                    block = f.read(CSV_BLOCK_SIZE)
+                else:
+                    block = f.read(min(size, CSV_BLOCK_SIZE))
+                    size -= len(block)
+                if not block:
+                    break
+                data = block
+                length = len(block)
+                for i in xrange(length):
+                    c = data[i]
+                    if state == CSV_EAT_LF:
+                        state = CSV_START_RECORD
+                        if c == c'\n':
+                            continue
+                    if state == CSV_START_RECORD:
+                        if c == c'\n' or c == c'\r':
+                            self._end_record()  # an empty row
+                            state = CSV_EAT_LF if c == c'\r' else state
+                            continue
+                        state = CSV_START_FIELD
+                    if state == CSV_START_FIELD:
+                        if c == c'"':
+                            state = CSV_IN_QUOTED_FIELD
+                        elif c == c',':
+                            self._save_field()
+                        elif c == c'\n' or c == c'\r':
+                            self._save_field()
+                            self._end_record()
+                            state = CSV_EAT_LF if c == c'\r' else \
+                                CSV_START_RECORD
+                        else:
+                            self.field.push_back(c)
+                            state = CSV_IN_FIELD
+                    elif state == CSV_IN_FIELD:
+                        if c == c',':
+                            self._save_field()
+                            state = CSV_START_FIELD
+                        elif c == c'\n' or c == c'\r':
+                            self._save_field()
+                            self._end_record()
+                            state = CSV_EAT_LF if c == c'\r' else \
+                                CSV_START_RECORD
+                        else:
+                            self.field.push_back(c)
+                    elif state == CSV_IN_QUOTED_FIELD:
+                        if c == c'"':
+                            state = CSV_QUOTE_IN_QUOTED_FIELD
+                        else:
+                            self.field.push_back(c)
+                    else:  # CSV_QUOTE_IN_QUOTED_FIELD
+                        if c == c'"':
+                            self.field.push_back(c)
+                            state = CSV_IN_QUOTED_FIELD
+                        elif c == c',':
+                            self._save_field()
+                            state = CSV_START_FIELD
+                        elif c == c'\n' or c == c'\r':
+                            self._save_field()
+                            self._end_record()
+                            state = CSV_EAT_LF if c == c'\r' else \
+                                CSV_START_RECORD
+                        else:
+                            self.field.push_back(c)
+                            state = CSV_IN_FIELD
+
+            if state == CSV_IN_QUOTED_FIELD:
+                raise ValueError('unexpected end of data')
+            elif state != CSV_START_RECORD and state != CSV_EAT_LF:
+                # the last row has no trailing newline
+                self._save_field()
+                self._end_record()
+        finally:
+            del self.out
+            self.out = NULL
+        return self.row_count
+
+
 cdef class RequestStream:
     cdef OutFile * ptr
 
@@ -71,6 +71,10 @@ DEFAULTS = {
     },
     'query': {
         'parallel': True,
+        'cache_rows': False,
+        'cache_scores': False,
+        'threads': 1,
+        'posterior_cache_size': 0,
     },
 }
 
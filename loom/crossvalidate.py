@@ -103,7 +103,7 @@ def crossvalidate_one(
     rows = loom.query.load_data_rows(results['test'])
     loom.config.config_dump({}, results['query']['config'])
     with loom.query.get_server(results['root'], debug=debug) as query:
-        scores = [query.score(row) for row in rows]
+        scores = query.score_many(rows).tolist()
 
     json_dump(scores, results['scores'])
     LOG(' done\n')
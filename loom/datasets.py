@@ -27,6 +27,7 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import numpy
 from distributions.io.stream import json_dump
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
@@ -138,6 +139,7 @@ def generate_one((name, sample_count, force, debug)):
         model_out=paths['samples'][0]['model'],
         groups_out=paths['samples'][0]['groups'],
         assign_out=paths['samples'][0]['assign'],
+        assign_columnar_out=paths['samples'][0]['assign_columnar'],
         **config)
     loom.format.make_schema(
         model_in=paths['samples'][0]['model'],
@@ -146,6 +148,9 @@ def generate_one((name, sample_count, force, debug)):
         schema_in=paths['ingest']['schema'],
         model_in=paths['samples'][0]['model'],
         encoding_out=paths['ingest']['encoding'])
+    loom.format.make_encoding_index(
+        encoding_in=paths['ingest']['encoding'],
+        encoding_index_out=paths['ingest']['encoding_index'])
     loom.format.make_schema_row(
         schema_in=paths['ingest']['schema'],
         schema_row_out=paths['ingest']['schema_row'])
@@ -168,8 +173,15 @@ def generate_one((name, sample_count, force, debug)):
     loom.format.import_rowids(
         rows_csv_in=paths['ingest']['rows_csv'],
         rowids_out=paths['ingest']['rowids'],
-        id_field='_id')
+        id_field='_id',
+        rowid_index_out=paths['ingest']['rowid_index'])
     protobuf_stream_dump([], paths['query']['query_log'])
+    protobuf_stream_dump([], paths['query']['baseline_scores'])
+    numpy.save(
+        paths['query']['relate_matrix'],
+        numpy.zeros((0, 0), dtype=numpy.float32))
+    json_dump({}, paths['query']['relate_matrix_meta'])
+    mkdir_p(paths['query']['groupings'])
     loom.config.config_dump({}, paths['query']['config'])
     for seed, sample in enumerate(paths['samples']):
         loom.config.config_dump({'seed': seed}, sample['config'])
@@ -189,6 +201,7 @@ def generate_one((name, sample_count, force, debug)):
             cp_ns(sample0['model'], sample['model'])
             cp_ns(sample0['groups'], sample['groups'])
             cp_ns(sample0['assign'], sample['assign'])
+            cp_ns(sample0['assign_columnar'], sample['assign_columnar'])
         else:
             loom.runner.mix(
                 config_in=sample['config'],
@@ -199,6 +212,7 @@ def generate_one((name, sample_count, force, debug)):
                 model_out=sample['model'],
                 groups_out=sample['groups'],
                 assign_out=sample['assign'],
+                assign_columnar_out=sample['assign_columnar'],
                 debug=debug)
     loom.consensus.make_fake_consensus(
         paths=paths,
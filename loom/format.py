@@ -27,11 +27,17 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import heapq
 import shutil
+import tempfile
+from contextlib import contextmanager
 from itertools import cycle
+from itertools import islice
 from itertools import izip
 from contextlib2 import ExitStack
 from collections import defaultdict
+import numpy
+import pandas
 import parsable
 from distributions.dbg.models import dpd
 from distributions.fileutil import tempdir
@@ -39,6 +45,8 @@ from distributions.io.stream import json_dump
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
 from distributions.io.stream import protobuf_stream_load
+from loom.util import csv_chunk_reader
+from loom.util import open_csv_chunk
 from loom.util import csv_reader
 from loom.util import csv_writer
 from loom.util import LoomError
@@ -157,11 +165,101 @@ class CategoricalEncoderBuilder(object):
         self.counts.update(counts)
 
 
+class HeavyHitterEncoderBuilder(object):
+    '''
+    Approximately counts dpd values in bounded memory, keeping at most the
+    max_symbols most frequent values and mapping all others to OTHER_DECODE.
+    Counts are a mergeable Misra-Gries summary of at most 2 * max_symbols
+    counters: every value occurring in more than a 1 / (max_symbols + 1)
+    fraction of rows is kept, with its count underestimated by at most that
+    fraction of rows.
+    '''
+    def __init__(self, name, model, max_symbols):
+        assert model == 'dpd', model
+        assert max_symbols > 0, max_symbols
+        self.name = name
+        self.model = model
+        self.max_symbols = max_symbols
+        self.counts = defaultdict(lambda: 0)
+        self.truncated = False
+
+    def add_value(self, value):
+        self.counts[value] += 1
+        if len(self.counts) > 2 * self.max_symbols:
+            self._prune()
+
+    def __iadd__(self, other):
+        assert other.max_symbols == self.max_symbols
+        for key, value in other.counts.iteritems():
+            self.counts[key] += value
+        self.truncated |= other.truncated
+        self._prune()
+        return self
+
+    def _prune(self):
+        if len(self.counts) <= self.max_symbols:
+            return
+        threshold = heapq.nlargest(
+            self.max_symbols + 1,
+            self.counts.itervalues())[-1]
+        counts = self.counts
+        self.counts = defaultdict(lambda: 0)
+        for key, count in counts.iteritems():
+            if count > threshold:
+                self.counts[key] = count - threshold
+        self.truncated = True
+
+    def build(self):
+        self._prune()
+        sorted_keys = [(-count, key) for key, count in self.counts.iteritems()]
+        sorted_keys.sort()
+        symbols = {key: i for i, (_, key) in enumerate(sorted_keys)}
+        assert OTHER_DECODE not in symbols, \
+            'data cannot assume reserved value {}'.format(OTHER_DECODE)
+        symbols[OTHER_DECODE] = dpd.OTHER
+        encoder = {
+            'name': self.name,
+            'model': self.model,
+            'symbols': symbols,
+        }
+        if self.truncated:
+            encoder['truncated'] = True
+        return encoder
+
+    def __getstate__(self):
+        return (
+            self.name,
+            self.model,
+            self.max_symbols,
+            dict(self.counts),
+            self.truncated,
+        )
+
+    def __setstate__(self, (name, model, max_symbols, counts, truncated)):
+        self.name = name
+        self.model = model
+        self.max_symbols = max_symbols
+        self.counts = defaultdict(lambda: 0)
+        self.counts.update(counts)
+        self.truncated = truncated
+
+
 ENCODER_BUILDERS = defaultdict(lambda: DefaultEncoderBuilder)
 ENCODER_BUILDERS['dd'] = CategoricalEncoderBuilder
 ENCODER_BUILDERS['dpd'] = CategoricalEncoderBuilder
 
 
+def make_encoder_builder(name, model, max_dpd_symbols=None):
+    '''
+    Make an encoder builder, counting dpd values approximately in bounded
+    memory iff max_dpd_symbols is not None.
+    '''
+    if model == 'dpd' and max_dpd_symbols is not None:
+        return HeavyHitterEncoderBuilder(name, model, max_dpd_symbols)
+    else:
+        return ENCODER_BUILDERS[model](name, model)
+
+
 class CategoricalFakeEncoderBuilder(object):
     def __init__(self, name, model):
         self.name = name
@@ -187,9 +285,24 @@ FAKE_ENCODER_BUILDERS['dd'] = CategoricalFakeEncoderBuilder
 FAKE_ENCODER_BUILDERS['dpd'] = CategoricalFakeEncoderBuilder
 
 
+def load_encoders(encoding_in):
+    '''
+    Load a list of encoders from either an encoding json file or an encoding
+    index directory built by make_encoding_index.
+    '''
+    if os.path.isdir(encoding_in):
+        return EncodingIndex(encoding_in).encoders
+    else:
+        return json_load(encoding_in)
+
+
 def load_encoder(encoder):
     model = encoder['model']
-    if 'symbols' in encoder:
+    if encoder.get('truncated'):
+        symbols = encoder['symbols']
+        other = symbols[OTHER_DECODE]
+        encode = lambda value: symbols.get(value, other)
+    elif 'symbols' in encoder:
         encode = encoder['symbols'].__getitem__
     elif model == 'bb':
         encode = BOOLEAN_SYMBOLS.__getitem__
@@ -200,7 +313,9 @@ def load_encoder(encoder):
 
 def load_decoder(encoder):
     model = encoder['model']
-    if 'symbols' in encoder:
+    if isinstance(encoder.get('symbols'), SymbolIndex):
+        decode = encoder['symbols'].decode
+    elif 'symbols' in encoder:
         decoder = {value: key for key, value in encoder['symbols'].iteritems()}
         decode = decoder.__getitem__
     elif model == 'bb':
@@ -210,10 +325,140 @@ def load_decoder(encoder):
     return decode
 
 
-def _make_encoder_builders_file((schema_in, rows_in)):
-    assert os.path.isfile(rows_in)
+def load_column_encoder(encoder):
+    '''
+    Returns a function mapping a pandas.Series of strings, with nulls for
+    missing values, to a list of encoded values, with None for missing values.
+    Categorical symbols are encoded through a precompiled index lookup.
+    Unknown values of truncated encoders are encoded as OTHER_DECODE.
+    '''
+    if isinstance(encoder.get('symbols'), SymbolIndex):
+        return _load_symbol_index_column_encoder(encoder)
+    model = encoder['model']
+    if 'symbols' in encoder:
+        symbols = encoder['symbols']
+    elif model == 'bb':
+        symbols = BOOLEAN_SYMBOLS
+    else:
+        symbols = None
+
+    if symbols is not None:
+        keys = pandas.Index(symbols.keys())
+        values = numpy.array(symbols.values(), dtype=object)
+        truncated = encoder.get('truncated', False)
+
+        def encode(column):
+            missing = column.isnull().values
+            codes = keys.get_indexer(column.values)
+            bad = (codes == -1) & ~missing
+            if bad.any() and truncated:
+                codes[bad] = keys.get_loc(OTHER_DECODE)
+            elif bad.any():
+                raise ValueError('bad value in column {}: {}'.format(
+                    encoder['name'],
+                    column.values[bad][0]))
+            result = values.take(codes)
+            result[missing] = None
+            return result.tolist()
+
+    else:
+        dtype = loom.schema.MODELS[model].Value
+
+        def encode(column):
+            missing = column.isnull().values
+            values = column.values[~missing]
+            result = numpy.empty(len(column), dtype=object)
+            try:
+                if dtype is int and values.dtype.kind == 'f':
+                    # counts with nulls arrive as floats; cast, not format
+                    if (values != numpy.floor(values)).any():
+                        raise ValueError('non-integer count')
+                result[~missing] = values.astype(dtype)
+            except (TypeError, ValueError):
+                raise ValueError('bad value in column {}'.format(
+                    encoder['name']))
+            return result.tolist()
+
+    return encode
+
+
+def load_column_decoder(encoder):
+    '''
+    Returns a function mapping a sequence of encoded values, with None for
+    missing values, to a pandas.Series of strings, with nulls for missing
+    values.
+    '''
+    if isinstance(encoder.get('symbols'), SymbolIndex):
+        return _load_symbol_index_column_decoder(encoder)
+    model = encoder['model']
+    if 'symbols' in encoder:
+        symbols = encoder['symbols']
+        codes = pandas.Index(symbols.values())
+        keys = numpy.array(symbols.keys(), dtype=object)
+    elif model == 'bb':
+        codes = pandas.Index([False, True])
+        keys = numpy.array(['0', '1'], dtype=object)
+    else:
+        codes = None
+
+    def decode(values):
+        column = pandas.Series(values, dtype=object)
+        present = column.notnull().values
+        result = numpy.empty(len(column), dtype=object)
+        if codes is None:
+            result[present] = column.values[present].astype(str)
+        else:
+            positions = codes.get_indexer(column.values[present])
+            if (positions == -1).any():
+                raise ValueError('bad value in column {}'.format(
+                    encoder['name']))
+            result[present] = keys.take(positions)
+        return pandas.Series(result, dtype=object)
+
+    return decode
+
+
+def _load_symbol_index_column_encoder(encoder):
+    symbols = encoder['symbols']
+    other = symbols[OTHER_DECODE] if encoder.get('truncated') else None
+
+    def encode(column):
+        missing = column.isnull().values
+        labels, uniques = pandas.factorize(column.values[~missing])
+        codes = [symbols.get(key, other) for key in uniques]
+        if None in codes:
+            raise ValueError('bad value in column {}: {}'.format(
+                encoder['name'],
+                uniques[codes.index(None)]))
+        result = numpy.empty(len(column), dtype=object)
+        result[~missing] = numpy.array(codes, dtype=object).take(labels)
+        return result.tolist()
+
+    return encode
+
+
+def _load_symbol_index_column_decoder(encoder):
+    symbols = encoder['symbols']
+
+    def decode(values):
+        column = pandas.Series(values, dtype=object)
+        present = column.notnull().values
+        labels, uniques = pandas.factorize(column.values[present])
+        try:
+            keys = [symbols.decode(code) for code in uniques]
+        except KeyError:
+            raise ValueError('bad value in column {}'.format(
+                encoder['name']))
+        result = numpy.empty(len(column), dtype=object)
+        result[present] = numpy.array(keys, dtype=object).take(labels)
+        return pandas.Series(result, dtype=object)
+
+    return decode
+
+
+def _make_encoder_builders_file((schema_in, rows_in, max_dpd_symbols)):
     schema = json_load(schema_in)
-    with csv_reader(rows_in) as reader:
+    with csv_chunk_reader(rows_in) as reader:
         header = reader.next()
         builders = []
         seen = set()
@@ -224,8 +469,7 @@ def _make_encoder_builders_file((schema_in, rows_in)):
                         name, rows_in))
                 seen.add(name)
                 model = schema[name]
-                Builder = ENCODER_BUILDERS[model]
-                builder = Builder(name, model)
+                builder = make_encoder_builder(name, model, max_dpd_symbols)
             else:
                 builder = None
             builders.append(builder)
@@ -246,12 +490,10 @@ def _make_encoder_builders_file((schema_in, rows_in)):
     return [b for b in builders if b is not None]
 
 
-def _make_encoder_builders_dir(schema_in, rows_in):
-    assert os.path.isdir(rows_in)
-    files_in = [os.path.join(rows_in, f) for f in os.listdir(rows_in)]
+def _make_encoder_builders_parts(schema_in, parts_in, max_dpd_symbols):
     partial_builders = loom.util.parallel_map(_make_encoder_builders_file, [
-        (schema_in, file_in)
-        for file_in in files_in
+        (schema_in, part_in, max_dpd_symbols)
+        for part_in in parts_in
     ])
     builders = partial_builders[0]
     for other_builders in partial_builders[1:]:
@@ -262,6 +504,21 @@ def _make_encoder_builders_dir(schema_in, rows_in):
     return builders
 
 
+def _make_encoder_builders_dir(schema_in, rows_in, max_dpd_symbols):
+    assert os.path.isdir(rows_in)
+    files_in = [os.path.join(rows_in, f) for f in os.listdir(rows_in)]
+    return _make_encoder_builders_parts(schema_in, files_in, max_dpd_symbols)
+
+
+def _make_encoder_builders_chunks(schema_in, rows_in, max_dpd_symbols):
+    assert os.path.isfile(rows_in)
+    with _split_csv_file(rows_in) as chunks_in:
+        return _make_encoder_builders_parts(
+            schema_in,
+            chunks_in,
+            max_dpd_symbols)
+
+
 def get_encoder_rank(encoder):
     rank = loom.schema.MODEL_RANK[encoder['model']]
     params = None
@@ -275,19 +532,205 @@ def get_encoder_rank(encoder):
 @loom.documented.transform(
     inputs=['ingest.schema', 'ingest.rows_csv'],
     outputs=['ingest.encoding'])
-def make_encoding(schema_in, rows_in, encoding_out):
+def make_encoding(schema_in, rows_in, encoding_out, max_dpd_symbols=None):
     '''
     Make a row encoder from csv rows data + json schema.
+    If max_dpd_symbols is set, each dpd feature keeps only its most frequent
+    values, counted approximately in bounded memory; rarer values are
+    ingested as unobserved and queried as OTHER_DECODE.
     '''
+    if max_dpd_symbols is not None:
+        max_dpd_symbols = int(max_dpd_symbols)
     if os.path.isdir(rows_in):
-        builders = _make_encoder_builders_dir(schema_in, rows_in)
+        builders = _make_encoder_builders_dir(
+            schema_in,
+            rows_in,
+            max_dpd_symbols)
+    elif _is_splittable(rows_in):
+        builders = _make_encoder_builders_chunks(
+            schema_in,
+            rows_in,
+            max_dpd_symbols)
     else:
-        builders = _make_encoder_builders_file((schema_in, rows_in))
+        builders = _make_encoder_builders_file(
+            (schema_in, rows_in, max_dpd_symbols))
     encoders = [builder.build() for builder in builders]
     encoders.sort(key=get_encoder_rank)
     json_dump(encoders, encoding_out)
 
 
+ENCODING_INDEX_ENCODERS = 'encoders.json'
+ENCODING_INDEX_SOURCE = 'source.json'
+ENCODING_INDEX_BASENAMES = {
+    'offsets': 'offsets.npy',
+    'strings': 'strings.npy',
+    'codes': 'codes.npy',
+    'decode_order': 'decode_order.npy',
+    'decode_codes': 'decode_codes.npy',
+}
+
+
+@parsable.command
+@loom.documented.transform(
+    inputs=['ingest.encoding'],
+    outputs=['ingest.encoding_index'])
+def make_encoding_index(encoding_in, encoding_index_out):
+    '''
+    Build a binary encoding index from an encoding json file. The index is a
+    directory of .npy arrays: each feature's symbols sorted by key and packed
+    into a strings blob with offsets, their codes, and the permutation
+    sorting codes, so that both directions can be searched in O(log n)
+    without loading symbols into python dicts.
+    The size and mtime of encoding_in are recorded to detect stale indices.
+    '''
+    source = _get_encoding_source(encoding_in)
+    encoders = json_load(encoding_in)
+    keys = []
+    codes = []
+    decode_order = []
+    for encoder in encoders:
+        if 'symbols' in encoder:
+            pairs = sorted(
+                (key.encode('utf-8'), code)
+                for key, code in encoder.pop('symbols').iteritems())
+            begin = len(keys)
+            keys += [key for key, _ in pairs]
+            codes += [code for _, code in pairs]
+            order = sorted(xrange(len(pairs)), key=lambda i: pairs[i][1])
+            decode_order += [begin + i for i in order]
+            encoder['symbol_range'] = [begin, len(keys)]
+    lengths = numpy.array(map(len, keys), dtype=numpy.int64)
+    offsets = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    codes = numpy.array(codes, dtype=numpy.uint32)
+    decode_order = numpy.array(decode_order, dtype=numpy.int64)
+    arrays = {
+        'offsets': offsets,
+        'strings': numpy.fromstring(''.join(keys), dtype=numpy.uint8),
+        'codes': codes,
+        'decode_order': decode_order,
+        'decode_codes': codes[decode_order],
+    }
+    if os.path.exists(encoding_index_out):
+        shutil.rmtree(encoding_index_out)
+    os.makedirs(encoding_index_out)
+    for key, array in arrays.iteritems():
+        filename = os.path.join(
+            encoding_index_out,
+            ENCODING_INDEX_BASENAMES[key])
+        numpy.save(filename, array)
+    json_dump(
+        encoders,
+        os.path.join(encoding_index_out, ENCODING_INDEX_ENCODERS))
+    json_dump(source, os.path.join(encoding_index_out, ENCODING_INDEX_SOURCE))
+
+
+def _get_encoding_source(encoding_in):
+    stat = os.stat(encoding_in)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def is_encoding_index_current(encoding_in, encoding_index_in):
+    '''
+    Whether encoding_index_in exists and was built from encoding_in as it
+    is now, i.e. encoding_in has not been rewritten since.
+    '''
+    filename = os.path.join(encoding_index_in, ENCODING_INDEX_SOURCE)
+    if not os.path.exists(filename) or not os.path.exists(encoding_in):
+        return False
+    return json_load(filename) == _get_encoding_source(encoding_in)
+
+
+class EncodingIndex(object):
+    '''
+    Memory-mapped view of an encoding index built by make_encoding_index.
+    The encoders attribute lists encoders like those of the encoding json
+    file, but whose symbols are SymbolIndex views of the memory map, which
+    is shared among all processes loading the index.
+    '''
+    def __init__(self, encoding_index_in):
+        for key, basename in ENCODING_INDEX_BASENAMES.iteritems():
+            filename = os.path.join(encoding_index_in, basename)
+            setattr(self, '_' + key, numpy.load(filename, mmap_mode='r'))
+        filename = os.path.join(encoding_index_in, ENCODING_INDEX_ENCODERS)
+        self.encoders = json_load(filename)
+        for encoder in self.encoders:
+            if 'symbol_range' in encoder:
+                begin, end = encoder.pop('symbol_range')
+                encoder['symbols'] = SymbolIndex(self, begin, end)
+
+    def _get_string(self, pos):
+        begin, end = self._offsets[pos], self._offsets[pos + 1]
+        return self._strings[begin:end].tostring()
+
+
+class SymbolIndex(object):
+    '''
+    Read-only view of one feature's symbols in an EncodingIndex. Indexing by
+    key returns the code, like a dict; use decode(code) for the reverse
+    lookup.
+    '''
+    def __init__(self, index, begin, end):
+        self._index = index
+        self._begin = begin
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._begin
+
+    def _find(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        get_string = self._index._get_string
+        begin = self._begin
+        end = self._end
+        while begin < end:
+            mid = (begin + end) / 2
+            if get_string(mid) < key:
+                begin = mid + 1
+            else:
+                end = mid
+        if begin < self._end and get_string(begin) == key:
+            return begin
+        return None
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos is None:
+            raise KeyError(key)
+        return int(self._index._codes[pos])
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        pos = self._find(key)
+        if pos is None:
+            return default
+        return int(self._index._codes[pos])
+
+    def iteritems(self):
+        index = self._index
+        offsets = index._offsets[self._begin:self._end + 1].tolist()
+        codes = index._codes[self._begin:self._end].tolist()
+        strings = index._strings[offsets[0]:offsets[-1]].tostring()
+        for pos, code in enumerate(codes):
+            begin = offsets[pos] - offsets[0]
+            end = offsets[pos + 1] - offsets[0]
+            yield strings[begin:end], code
+
+    def decode(self, code):
+        '''
+        Returns the key of code, or raises KeyError.
+        '''
+        codes = self._index._decode_codes[self._begin:self._end]
+        pos = numpy.searchsorted(codes, code)
+        if pos == len(codes) or codes[pos] != code:
+            raise KeyError(code)
+        return self._index._get_string(
+            self._index._decode_order[self._begin + pos])
+
+
 def ensure_fake_encoders_are_sorted(encoders):
     dds = [e['symbols'] for e in encoders if e['model'] == 'dd']
     for smaller, larger in izip(dds, dds[1:]):
@@ -356,15 +799,58 @@ def make_fake_encoding(schema_in, model_in, encoding_out):
     json_dump(encoders, encoding_out)
 
 
-def _import_dir(import_file, args):
-    rows_csv_in, file_out, id_offset, id_stride, misc = args
-    assert os.path.isdir(rows_csv_in)
-    parts_in = sorted(
-        os.path.abspath(os.path.join(rows_csv_in, f))
-        for f in os.listdir(rows_csv_in)
-    )
+def _is_splittable(rows_csv_in):
+    '''
+    Whether a single csv file is large enough to import in chunks.
+    This depends only on file size, so that row ids are deterministic.
+    '''
+    return os.path.getsize(rows_csv_in) > loom.util.CSV_CHUNK_SIZE
+
+
+@contextmanager
+def decompress_csv(rows_csv_in, dirname):
+    '''
+    Yield an uncompressed copy of a .csv.gz or .csv.bz2 file, written to a
+    temporary file in dirname and removed on exit; other paths are yielded
+    unchanged. Decompressing once up front lets each ingest pass decide
+    whether to split by the uncompressed size, and read chunks in parallel.
+    '''
+    if os.path.isdir(rows_csv_in) or not loom.util.is_compressed(rows_csv_in):
+        yield rows_csv_in
+        return
+    fd, filename = tempfile.mkstemp(suffix='.csv', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            with open_compressed(rows_csv_in, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out)
+        yield filename
+    finally:
+        os.remove(filename)
+
+
+@contextmanager
+def _split_csv_file(rows_csv_in, name=None):
+    '''
+    Yield a list of CsvChunks of a csv file, named name (default the
+    file's basename). Compressed files are first decompressed to a
+    temporary file, since they cannot be read from an arbitrary offset.
+    '''
+    rows_csv_in = os.path.abspath(rows_csv_in)
+    if name is None:
+        name = os.path.basename(rows_csv_in)
+    with tempdir():
+        if loom.util.is_compressed(rows_csv_in):
+            filename = os.path.abspath('rows.csv')
+            with open_compressed(rows_csv_in, 'rb') as f_in:
+                with open(filename, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        else:
+            filename = rows_csv_in
+        yield loom.util.split_csv_file(filename, name=name)
+
+
+def _import_parts(import_file, parts_in, file_out, id_offset, id_stride, misc):
     part_count = len(parts_in)
-    assert part_count > 0, 'no files in {}'.format(rows_csv_in)
     parts_out = []
     tasks = []
     for i, part_in in enumerate(parts_in):
@@ -373,6 +859,11 @@ def _import_dir(import_file, args):
         stride = id_stride * part_count
         parts_out.append(part_out)
         tasks.append((part_in, part_out, offset, stride, misc))
+    if part_count == 0:
+        # e.g. a file with a header but no rows
+        with open_compressed(file_out, 'wb'):
+            pass
+        return
     with tempdir():
         loom.util.parallel_map(import_file, tasks)
         # It is safe use open instead of open_compressed even for .gz files;
@@ -384,7 +875,31 @@ def _import_dir(import_file, args):
                 os.remove(part_out)
 
 
-def _import_rows(import_file, rows_csv_in, file_out, misc):
+def _import_dir(import_file, args):
+    rows_csv_in, file_out, id_offset, id_stride, misc = args
+    assert os.path.isdir(rows_csv_in)
+    parts_in = sorted(
+        os.path.abspath(os.path.join(rows_csv_in, f))
+        for f in os.listdir(rows_csv_in)
+    )
+    assert parts_in, 'no files in {}'.format(rows_csv_in)
+    _import_parts(import_file, parts_in, file_out, id_offset, id_stride, misc)
+
+
+def _import_chunks(import_file, args, name=None):
+    rows_csv_in, file_out, id_offset, id_stride, misc = args
+    assert os.path.isfile(rows_csv_in)
+    with _split_csv_file(rows_csv_in, name) as chunks_in:
+        _import_parts(
+            import_file,
+            chunks_in,
+            file_out,
+            id_offset,
+            id_stride,
+            misc)
+
+
+def _import_rows(import_file, rows_csv_in, file_out, misc, name=None):
     rows_csv_in = os.path.abspath(rows_csv_in)
     file_out = os.path.abspath(file_out)
     id_offset = 0
@@ -392,16 +907,23 @@ def _import_rows(import_file, rows_csv_in, file_out, misc):
     args = (rows_csv_in, file_out, id_offset, id_stride, misc)
     if os.path.isdir(rows_csv_in):
         _import_dir(import_file, args)
+    elif name is not None or _is_splittable(rows_csv_in):
+        # named chunks carry the name into positional rowids
+        _import_chunks(import_file, args, name)
     else:
         import_file(args)
 
 
 def _import_rowids_file(args):
     rows_csv_in, rowids_out, id_offset, id_stride, id_field = args
-    assert os.path.isfile(rows_csv_in)
-    with csv_reader(rows_csv_in) as reader:
+    with csv_chunk_reader(rows_csv_in) as reader:
         header = reader.next()
-        if id_field is None:
+        if id_field is None and isinstance(rows_csv_in, tuple):
+            # number rows by position in the original file, as if unsplit
+            get_rowid = lambda i, row: '{}:{}'.format(
+                rows_csv_in.name,
+                rows_csv_in.first_row + i)
+        elif id_field is None:
             basename = os.path.basename(rows_csv_in)
             get_rowid = lambda i, row: '{}:{}'.format(basename, i)
         else:
@@ -412,56 +934,208 @@ def _import_rowids_file(args):
                 writer.writerow((id_offset + id_stride * i, get_rowid(i, row)))
 
 
+ROWID_INDEX_BASENAMES = {
+    'internal_ids': 'internal_ids.npy',
+    'offsets': 'offsets.npy',
+    'strings': 'strings.npy',
+    'external_order': 'external_order.npy',
+}
+ROWID_INDEX_BLOCK_SIZE = 2 ** 16  # rows per block when building an index
+
+
+def _load_rowid_blocks(rowids_in, block_size):
+    '''
+    Returns (internal_ids, external_ids) arrays, where external_ids is a
+    fixed-width string array, parsing block_size csv rows at a time.
+    '''
+    internal_blocks = [numpy.zeros(0, dtype=numpy.int64)]
+    external_blocks = [numpy.zeros(0, dtype='S1')]
+    with csv_reader(rowids_in) as reader:
+        while True:
+            block = list(islice(reader, block_size))
+            if not block:
+                break
+            internal_ids, external_ids = izip(*block)
+            internal_ids = numpy.array(internal_ids, dtype=str)
+            internal_blocks.append(internal_ids.astype(numpy.int64))
+            external_blocks.append(numpy.array(external_ids, dtype=str))
+    internal_ids = numpy.concatenate(internal_blocks)
+    external_ids = numpy.concatenate(external_blocks)
+    return internal_ids, external_ids
+
+
+def make_rowid_index(rowids_in, rowid_index_out, block_size=None):
+    '''
+    Build a binary rowid index from a rowids csv file. The index is a
+    directory of .npy arrays: internal ids in sorted order, external ids
+    packed into a strings blob with offsets, and the permutation sorting
+    external ids, so that both directions can be searched in O(log n).
+    Rows are parsed in blocks of block_size and sorted with numpy, holding
+    external ids in a fixed-width array rather than as python strings.
+    '''
+    if block_size is None:
+        block_size = ROWID_INDEX_BLOCK_SIZE
+    internal_ids, external_ids = _load_rowid_blocks(rowids_in, block_size)
+    order = numpy.argsort(internal_ids, kind='mergesort')
+    internal_ids = internal_ids[order]
+    external_ids = external_ids[order]
+    del order
+    lengths = numpy.char.str_len(external_ids)
+    offsets = numpy.zeros(len(external_ids) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    width = external_ids.dtype.itemsize
+    padded = external_ids.view(numpy.uint8).reshape(len(external_ids), width)
+    strings = padded[numpy.arange(width) < lengths[:, numpy.newaxis]]
+    del padded
+    external_order = numpy.argsort(external_ids, kind='mergesort')
+    external_order = external_order.astype(numpy.int64)
+    if os.path.exists(rowid_index_out):
+        shutil.rmtree(rowid_index_out)
+    os.makedirs(rowid_index_out)
+    arrays = {
+        'internal_ids': internal_ids,
+        'offsets': offsets,
+        'strings': strings,
+        'external_order': external_order,
+    }
+    for key, array in arrays.iteritems():
+        filename = os.path.join(rowid_index_out, ROWID_INDEX_BASENAMES[key])
+        numpy.save(filename, array)
+
+
+class RowidIndex(object):
+    '''
+    Memory-mapped view of a rowid index built by make_rowid_index.
+    Indexing by internal id returns the external id, like a dict;
+    use find(external_id) for the reverse lookup.
+    '''
+    def __init__(self, rowid_index_in):
+        for key, basename in ROWID_INDEX_BASENAMES.iteritems():
+            filename = os.path.join(rowid_index_in, basename)
+            setattr(self, '_' + key, numpy.load(filename, mmap_mode='r'))
+
+    def __len__(self):
+        return len(self._internal_ids)
+
+    def _get_string(self, pos):
+        begin, end = self._offsets[pos], self._offsets[pos + 1]
+        return self._strings[begin:end].tostring()
+
+    def __getitem__(self, internal_id):
+        pos = numpy.searchsorted(self._internal_ids, internal_id)
+        if pos == len(self) or self._internal_ids[pos] != internal_id:
+            raise KeyError(internal_id)
+        return self._get_string(pos)
+
+    def __contains__(self, internal_id):
+        pos = numpy.searchsorted(self._internal_ids, internal_id)
+        return pos < len(self) and self._internal_ids[pos] == internal_id
+
+    def find(self, external_id):
+        '''
+        Returns the internal id of external_id, or raises KeyError.
+        '''
+        begin = 0
+        end = len(self)
+        while begin < end:
+            mid = (begin + end) / 2
+            if self._get_string(self._external_order[mid]) < external_id:
+                begin = mid + 1
+            else:
+                end = mid
+        if begin < len(self):
+            pos = self._external_order[begin]
+            if self._get_string(pos) == external_id:
+                return int(self._internal_ids[pos])
+        raise KeyError(external_id)
+
+
+class RowidDict(dict):
+    '''
+    In-memory rowid map loaded from a rowids csv file, with the interface of
+    RowidIndex, for stores ingested without a rowid index.
+    '''
+    def __init__(self, rowids_in):
+        with csv_reader(rowids_in) as reader:
+            dict.__init__(self, (
+                (int(internal_id), external_id)
+                for internal_id, external_id in reader
+            ))
+        self._internal_ids = None
+
+    def find(self, external_id):
+        '''
+        Returns the internal id of external_id, or raises KeyError.
+        '''
+        if self._internal_ids is None:
+            self._internal_ids = {
+                external_id: internal_id
+                for internal_id, external_id in self.iteritems()
+            }
+        return self._internal_ids[external_id]
+
+
 @parsable.command
 @loom.documented.transform(
     inputs=['ingest.rows_csv'],
-    outputs=['ingest.rowids'])
-def import_rowids(rows_csv_in, rowids_out, id_field=None):
+    outputs=['ingest.rowids', 'ingest.rowid_index'])
+def import_rowids(
+        rows_csv_in,
+        rowids_out,
+        id_field=None,
+        rowid_index_out=None,
+        name=None):
     '''
     Import rowids from csv format to rowid index csv format.
     rows_csv_in can be a csv file or a directory containing csv files.
     Any csv file may be be raw .csv, or compressed .csv.gz or .csv.bz2.
+    If rowid_index_out is given, also build a binary rowid index there.
+    Without an id_field, rows of a single file are named by position as
+    name:i, where name defaults to the file's basename; pass the original
+    name when importing a decompressed copy, so that rowids do not change.
     '''
-    _import_rows(_import_rowids_file, rows_csv_in, rowids_out, id_field)
+    _import_rows(
+        _import_rowids_file,
+        rows_csv_in,
+        rowids_out,
+        id_field,
+        name)
+    if rowid_index_out is not None:
+        make_rowid_index(rowids_out, rowid_index_out)
+
+
+def load_row_encoder(encoders):
+    '''
+    Compile a list of encoders to a loom.cFormat.RowEncoder,
+    which encodes csv files to Row streams without per-value python calls.
+    '''
+    encoders = [
+        dict(encoder, symbols=BOOLEAN_SYMBOLS)
+        if encoder['model'] == 'bb' and 'symbols' not in encoder
+        else encoder
+        for encoder in encoders
+    ]
+    return loom.cFormat.RowEncoder(encoders)
 
 
 def _import_rows_file(args):
     rows_csv_in, rows_out, id_offset, id_stride, encoding_in = args
-    assert os.path.isfile(rows_csv_in)
-    encoders = json_load(encoding_in)
-    message = loom.cFormat.Row()
-    add_field = {
-        'booleans': message.add_booleans,
-        'counts': message.add_counts,
-        'reals': message.add_reals,
-    }
-    with csv_reader(rows_csv_in) as reader:
-        feature_names = list(reader.next())
-        header_length = len(feature_names)
-        name_to_pos = {name: i for i, name in enumerate(feature_names)}
-        schema = []
-        for encoder in encoders:
-            pos = name_to_pos.get(encoder['name'])
-            add = add_field[loom.schema.MODEL_TO_DATATYPE[encoder['model']]]
-            encode = load_encoder(encoder)
-            schema.append((pos, add, encode))
-
-        def rows():
-            for i, row in enumerate(reader):
-                if len(row) != header_length:
-                    raise LoomError('row {} has wrong length {}:\n{}'.format(
-                        i, len(row), row))
-                message.id = id_offset + id_stride * i
-                for pos, add, encode in schema:
-                    value = None if pos is None else row[pos].strip()
-                    observed = bool(value)
-                    message.add_observed(observed)
-                    if observed:
-                        add(encode(value))
-                yield message
-                message.Clear()
-
-        loom.cFormat.row_stream_dump(rows(), rows_out)
+    encoder = load_row_encoder(load_encoders(encoding_in))
+    try:
+        if isinstance(rows_csv_in, tuple):
+            with open_csv_chunk(rows_csv_in) as (f, header, size):
+                encoder.dump_csv(
+                    f,
+                    rows_out,
+                    id_offset,
+                    id_stride,
+                    header,
+                    size)
+        else:
+            with open_compressed(rows_csv_in, 'rb') as f:
+                encoder.dump_csv(f, rows_out, id_offset, id_stride)
+    except ValueError as e:
+        raise LoomError('{}: {}'.format(rows_csv_in, e))
 
 
 @parsable.command
@@ -471,8 +1145,11 @@ def _import_rows_file(args):
 def import_rows(encoding_in, rows_csv_in, rows_out):
     '''
     Import rows from csv format to protobuf-stream format.
+    encoding_in can be an encoding json file or an encoding index.
     rows_csv_in can be a csv file or a directory containing csv files.
     Any csv file may be be raw .csv, or compressed .csv.gz or .csv.bz2.
+    Large single files are split at record boundaries and imported in
+    parallel; compressed files are first decompressed to a temp file.
     '''
     _import_rows(_import_rows_file, rows_csv_in, rows_out, encoding_in)
 
@@ -497,7 +1174,7 @@ def export_rows(encoding_in, rows_in, rows_csv_out, chunk_size=1000000):
     if not (chunk_size > 0):
         raise LoomError('Invalid chunk_size {}, must be positive'.format(
             chunk_size))
-    encoders = json_load(encoding_in)
+    encoders = load_encoders(encoding_in)
     fields = [loom.schema.MODEL_TO_DATATYPE[e['model']] for e in encoders]
     decoders = [load_decoder(e) for e in encoders]
     header = ['_id'] + [e['name'] for e in encoders]
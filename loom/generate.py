@@ -146,6 +146,7 @@ def generate(
         model_out='model.pb.gz',
         groups_out=None,
         assign_out=None,
+        assign_columnar_out=None,
         init_out=None,
         debug=False,
         profile=None):
@@ -159,6 +160,8 @@ def generate(
         groups_out = os.path.abspath(groups_out)
     if assign_out is not None:
         assign_out = os.path.abspath(assign_out)
+    if assign_columnar_out is not None:
+        assign_columnar_out = os.path.abspath(assign_columnar_out)
     if init_out is not None:
         init_out = os.path.abspath(init_out)
 
@@ -183,6 +186,7 @@ def generate(
             model_out=model_out,
             groups_out=groups_out,
             assign_out=assign_out,
+            assign_columnar_out=assign_columnar_out,
             debug=debug,
             profile=profile)
 
@@ -27,7 +27,9 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import tempfile
 import numpy
+import scipy.sparse
 import pymetis
 import pymetis._internal  # HACK to avoid errors finding .so files in path
 from itertools import izip
@@ -36,12 +38,15 @@ from collections import namedtuple
 from distributions.io.stream import json_dump
 from distributions.io.stream import open_compressed
 from loom.schema_pb2 import CrossCat
-from loom.cFormat import assignment_stream_load
+from loom.cFormat import assignment_stream_load_array
 from loom.util import LoomError
+from loom.util import mkdir_p
 from loom.util import parallel_map
 import loom.store
 
 METIS_ARGS_TEMPFILE = 'temp.metis_args.json'
+COLUMNAR_ASSIGNMENTS_MAGIC = 'loomcas1'
+CHUNK_SIZE = 10000
 
 Row = namedtuple('Row', ['row_id', 'group_id', 'confidence'])
 
@@ -53,25 +58,201 @@ def collate(pairs):
     return groups.values()
 
 
-def group(root, feature_name, parallel=False):
+def group(root, feature_name, parallel=False, cache=False):
+    '''
+    Compute the consensus grouping of rows by the kind containing a feature.
+    If cache is true, groupings are cached under query/groupings, keyed by
+    the per-sample kindids of the feature, so that features sharing kinds in
+    every sample share a cached grouping.
+    '''
     paths = loom.store.get_paths(root, sample_count=None)
     map_ = parallel_map if parallel else map
-    groupings = map_(group_sample, [
+    kindids = map_(find_kindid, [
         (sample, feature_name)
         for sample in paths['samples']
     ])
-    return group_reduce(groupings)
+    if cache:
+        filename = get_grouping_path(paths['query']['groupings'], kindids)
+        fingerprint = loom.store.get_fingerprint(paths)
+        grouping = load_grouping(filename, fingerprint)
+        if grouping is not None:
+            return grouping
+    groupings = map_(group_sample, izip(paths['samples'], kindids))
+    grouping = group_reduce(groupings)
+    if cache:
+        dump_grouping(grouping, filename, fingerprint)
+    return grouping
 
 
-def group_sample((sample, featureid)):
+def find_kindid((sample, featureid)):
     model = CrossCat()
     with open_compressed(sample['model']) as f:
         model.ParseFromString(f.read())
     for kindid, kind in enumerate(model.kinds):
         if featureid in kind.featureids:
-            break
-    assignments = assignment_stream_load(sample['assign'])
-    return collate((a.groupids(kindid), a.rowid) for a in assignments)
+            return kindid
+    raise LoomError('feature {} not found in {}'.format(
+        featureid,
+        sample['model']))
+
+
+def is_columnar_current(sample):
+    '''
+    Whether a sample's columnar assignments exist and are at least as new as
+    its assignment stream, i.e. were written by the same run.
+    '''
+    columnar = sample['assign_columnar']
+    if not os.path.exists(columnar):
+        return False
+    if not os.path.exists(sample['assign']):
+        return True
+    return os.path.getmtime(columnar) >= os.path.getmtime(sample['assign'])
+
+
+def group_sample((sample, kindid)):
+    if is_columnar_current(sample):
+        assignments = ColumnarAssignments(sample['assign_columnar'])
+        return assignments.groups(kindid)
+    rowids, groupids = assignment_stream_load_array(sample['assign'])
+    groupids = groupids[:, kindid]
+    order = numpy.argsort(groupids, kind='mergesort')
+    bounds = numpy.flatnonzero(numpy.diff(groupids[order])) + 1
+    return numpy.split(rowids[order], bounds)
+
+
+class ColumnarAssignments(object):
+    '''
+    Memory-mapped view of a columnar assignments file, with an inverted index
+    from (kindid, groupid) to rows.
+    This must match loom::columnar_assignments_dump(-,-,-) in
+    src/assignments.hpp
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            magic = f.read(len(COLUMNAR_ASSIGNMENTS_MAGIC))
+            if magic != COLUMNAR_ASSIGNMENTS_MAGIC:
+                raise LoomError('bad columnar assignments: {}'.format(
+                    filename))
+            row_count, kind_count = map(
+                int,
+                numpy.fromfile(f, dtype=numpy.uint64, count=2))
+            self._offset = f.tell()
+        self._filename = filename
+        self.group_counts = self._load(numpy.uint64, kind_count)
+        self.rowids = self._load(numpy.uint64, row_count)
+        self._group_offsets = [
+            self._load(numpy.uint64, int(group_count) + 1)
+            for group_count in self.group_counts
+        ]
+        self._groupids = [
+            self._load(numpy.uint32, row_count)
+            for _ in xrange(kind_count)
+        ]
+        self._positions = [
+            self._load(numpy.uint32, row_count)
+            for _ in xrange(kind_count)
+        ]
+        self._sorted_positions = None
+        self._sorted_rowids = None
+
+    def _load(self, dtype, count):
+        if count == 0:
+            return numpy.zeros(0, dtype=dtype)
+        array = numpy.memmap(
+            self._filename,
+            dtype=dtype,
+            mode='r',
+            offset=self._offset,
+            shape=(count,))
+        self._offset += array.nbytes
+        return array
+
+    @property
+    def row_count(self):
+        return len(self.rowids)
+
+    @property
+    def kind_count(self):
+        return len(self.group_counts)
+
+    def groupids(self, kindid):
+        return self._groupids[kindid]
+
+    def group_rowids(self, kindid, groupid):
+        '''
+        Returns the rowids of rows assigned to a group, in O(group size).
+        '''
+        offsets = self._group_offsets[kindid]
+        begin, end = offsets[groupid], offsets[groupid + 1]
+        return self.rowids[self._positions[kindid][begin:end]]
+
+    def groups(self, kindid):
+        '''
+        Returns a list of rowid arrays, one per nonempty group of a kind.
+        '''
+        offsets = self._group_offsets[kindid]
+        rowids = self.rowids[self._positions[kindid]]
+        groups = numpy.split(rowids, offsets[1:-1].astype(numpy.intp))
+        return [group for group in groups if len(group)]
+
+    def neighbors(self, kindid, rowid):
+        '''
+        Returns the rowids of rows sharing a group with rowid in a kind.
+        '''
+        if self._sorted_positions is None:
+            self._sorted_positions = numpy.argsort(self.rowids)
+            self._sorted_rowids = self.rowids[self._sorted_positions]
+        pos = numpy.searchsorted(self._sorted_rowids, rowid)
+        if pos == self.row_count or self._sorted_rowids[pos] != rowid:
+            raise KeyError(rowid)
+        groupid = self._groupids[kindid][self._sorted_positions[pos]]
+        return self.group_rowids(kindid, groupid)
+
+
+def get_grouping_path(groupings_path, kindids):
+    basename = 'grouping.{}.npz'.format('.'.join(map(str, kindids)))
+    return os.path.join(groupings_path, basename)
+
+
+def load_grouping(filename, fingerprint):
+    '''
+    Load a cached grouping, or return None if it is missing or stale.
+    A file that cannot be read, e.g. a corrupt one, also counts as missing.
+    '''
+    if not os.path.exists(filename):
+        return None
+    try:
+        with numpy.load(filename) as cached:
+            if cached['fingerprint'].item() != fingerprint:
+                return None
+            return map(Row._make, izip(
+                cached['row_id'].tolist(),
+                cached['group_id'].tolist(),
+                cached['confidence'].tolist()))
+    except Exception:
+        return None
+
+
+def dump_grouping(grouping, filename, fingerprint):
+    '''
+    Write a grouping to a temp file and rename it into place, so that
+    concurrent readers see either the previous file or the complete one.
+    '''
+    dirname = os.path.dirname(filename)
+    mkdir_p(dirname)
+    fd, temp_path = tempfile.mkstemp(suffix='.npz', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(
+                f,
+                fingerprint=numpy.array(fingerprint),
+                row_id=numpy.array([row.row_id for row in grouping]),
+                group_id=numpy.array([row.group_id for row in grouping]),
+                confidence=numpy.array([row.confidence for row in grouping]))
+        os.rename(temp_path, filename)
+    except Exception:
+        os.remove(temp_path)
+        raise
 
 
 def group_reduce(groupings):
@@ -114,23 +295,32 @@ def find_consensus_grouping(groupings, debug=False):
     # Set up consensus grouping problem
 
     allgroups = sum(groupings, [])
-    objects = list(set(sum(allgroups, [])))
-    objects.sort()
-    index = {item: i for i, item in enumerate(objects)}
-
-    vertices = [numpy.array(map(index.__getitem__, g), dtype=numpy.intp)
-                for g in allgroups]
-
-    contains = numpy.zeros((len(vertices), len(objects)), dtype=numpy.float32)
-    for v, vertex in enumerate(vertices):
-        contains[v, vertex] = 1  # i.e. for u in vertex: contains[v, u] = i
-
-    # We use the binary Jaccard measure for similarity
-    overlap = numpy.dot(contains, contains.T)
-    diag = overlap.diagonal()
-    denom = (diag.reshape(len(vertices), 1) +
-             diag.reshape(1, len(vertices)) - overlap)
-    similarity = overlap / denom
+    vertex_count = len(allgroups)
+    sizes = numpy.array(map(len, allgroups), dtype=numpy.int64)
+    members = numpy.concatenate([numpy.asarray(g) for g in allgroups])
+    objects = numpy.unique(members)
+    object_count = len(objects)
+
+    # contains is a sparse vertex x object incidence matrix
+    indptr = numpy.zeros(vertex_count + 1, dtype=numpy.int64)
+    numpy.cumsum(sizes, out=indptr[1:])
+    contains = scipy.sparse.csr_matrix(
+        (
+            numpy.ones(len(members), dtype=numpy.int32),
+            numpy.searchsorted(objects, members),
+            indptr,
+        ),
+        shape=(vertex_count, object_count))
+    del members
+
+    # We use the binary Jaccard measure for similarity,
+    # computed only on the nonzero overlaps
+    overlap = contains.dot(contains.T).tocsr()
+    overlap.sort_indices()
+    rows = numpy.repeat(numpy.arange(vertex_count), numpy.diff(overlap.indptr))
+    cols = overlap.indices
+    denom = sizes[rows] + sizes[cols] - overlap.data
+    similarity = overlap.data / denom.astype(numpy.float64)
 
     # ------------------------------------------------------------------------
     # Format for metis
@@ -138,16 +328,17 @@ def find_consensus_grouping(groupings, debug=False):
     if not (similarity.max() <= 1):
         raise LoomError('similarity.max() = {}'.format(similarity.max()))
     similarity *= 2**16  # metis segfaults if this is too large
-    int_similarity = numpy.zeros(similarity.shape, dtype=numpy.int32)
-    int_similarity[:] = numpy.rint(similarity)
-
-    edges = int_similarity.nonzero()
-    edge_weights = map(int, int_similarity[edges])
-    edges = numpy.transpose(edges)
-
-    adjacency = [[] for _ in vertices]
-    for i, j in edges:
-        adjacency[i].append(j)
+    int_similarity = numpy.rint(similarity).astype(numpy.int32)
+    nonzero = (int_similarity != 0)
+    rows = rows[nonzero]
+    cols = cols[nonzero]
+    edge_weights = int_similarity[nonzero].tolist()
+
+    bounds = numpy.searchsorted(rows, numpy.arange(vertex_count + 1))
+    adjacency = [
+        cols[begin:end].tolist()
+        for begin, end in izip(bounds[:-1], bounds[1:])
+    ]
 
     # FIXME is there a better way to choose the final group count?
     group_count = int(numpy.median(map(len, groupings)))
@@ -169,26 +360,35 @@ def find_consensus_grouping(groupings, debug=False):
     # ------------------------------------------------------------------------
     # Clean up solution
 
-    parts = range(group_count)
-    if len(partition) != len(vertices):
+    if len(partition) != vertex_count:
         raise LoomError('metis output vector has wrong length')
 
-    represents = numpy.zeros((len(parts), len(vertices)))
-    for v, p in enumerate(partition):
-        represents[p, v] = 1
+    represents = scipy.sparse.csr_matrix(
+        (numpy.ones(vertex_count), (partition, numpy.arange(vertex_count))),
+        shape=(group_count, vertex_count))
 
-    contains = numpy.dot(represents, contains)
-    represent_counts = represents.sum(axis=1)
+    scores = represents.dot(contains).tocsr()
+    represent_counts = numpy.bincount(partition, minlength=group_count)
     represent_counts[numpy.where(represent_counts == 0)] = 1  # avoid NANs
-    contains /= represent_counts.reshape(group_count, 1)
-
-    bestmatch = contains.argmax(axis=0)
-    confidence = contains[bestmatch, range(len(bestmatch))]
-    if not all(numpy.isfinite(confidence)):
+    scores.data /= numpy.repeat(represent_counts, numpy.diff(scores.indptr))
+    scores = scores.tocsc()
+
+    # find each object's best matching part, a chunk of objects at a time
+    bestmatch = numpy.zeros(object_count, dtype=numpy.intp)
+    confidence = numpy.zeros(object_count)
+    for begin in xrange(0, object_count, CHUNK_SIZE):
+        end = min(begin + CHUNK_SIZE, object_count)
+        chunk = scores[:, begin:end].toarray()
+        best = chunk.argmax(axis=0)
+        bestmatch[begin:end] = best
+        confidence[begin:end] = chunk[best, numpy.arange(end - begin)]
+    if not numpy.isfinite(confidence).all():
         raise LoomError('confidence is nan')
+    objects = objects.tolist()
+    confidence = confidence.tolist()
 
-    nonempty_groups = list(set(bestmatch))
-    nonempty_groups.sort()
+    nonempty_groups = numpy.unique(bestmatch).tolist()
+    bestmatch = bestmatch.tolist()
     reindex = {j: i for i, j in enumerate(nonempty_groups)}
 
     grouping = [
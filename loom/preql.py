@@ -29,21 +29,36 @@
 from copy import copy
 import csv
 import math
+import os
+import tempfile
 from contextlib import contextmanager
 from itertools import izip
 from collections import Counter
+from collections import deque
+from distributions.io.stream import json_dump
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
 from StringIO import StringIO
 import numpy
+import pandas
+from numpy.lib.format import open_memmap
+import scipy.sparse
 from sklearn.cluster import SpectralClustering
+from loom.format import load_column_decoder
+from loom.format import load_column_encoder
 from loom.format import load_decoder
 from loom.format import load_encoder
+from loom.format import load_encoders
+from loom.format import is_encoding_index_current
+from loom.format import RowidDict
+from loom.format import RowidIndex
 import loom.store
 import loom.query
 import loom.group
 
 SAMPLE_COUNT = 1000
+ADAPTIVE_SAMPLE_COUNT = 100
+NUMERIC_MODELS = frozenset(['gp', 'nich'])
 
 
 class CsvWriter(object):
@@ -134,11 +149,15 @@ class PreQL(object):
         self._paths = loom.store.get_paths(query_server.root)
         if encoding is None:
             encoding = self._paths['ingest']['encoding']
+            encoding_index = self._paths['ingest']['encoding_index']
+            if is_encoding_index_current(encoding, encoding_index):
+                encoding = encoding_index
         self._query_server = query_server
-        self._encoders = json_load(encoding)
+        self._encoders = load_encoders(encoding)
         transforms = self._paths['ingest']['transforms']
         self._transform = loom.transforms.load_transforms(transforms)
         self._feature_names = [e['name'] for e in self._encoders]
+        self._name_to_model = {e['name']: e['model'] for e in self._encoders}
         self._feature_set = frozenset(self._feature_names)
         self._name_to_pos = {
             name: i
@@ -152,6 +171,14 @@ class PreQL(object):
             e['name']: load_encoder(e)
             for e in self._encoders
             }
+        self._name_to_decode_column = {
+            e['name']: load_column_decoder(e)
+            for e in self._encoders
+            }
+        self._name_to_encode_column = {
+            e['name']: load_column_encoder(e)
+            for e in self._encoders
+            }
         self._rowid_map = None
         self._debug = debug
 
@@ -166,13 +193,18 @@ class PreQL(object):
 
     @property
     def rowid_map(self):
+        '''
+        Maps internal row ids to external row ids; rowid_map.find maps
+        external row ids back to internal row ids.
+        '''
         if self._rowid_map is None:
-            filename = self._paths['ingest']['rowids']
-            with loom.util.csv_reader(filename) as reader:
-                self._rowid_map = {
-                    int(internal_id): external_id
-                    for internal_id, external_id in reader
-                    }
+            filename = self._paths['ingest']['rowid_index']
+            if os.path.exists(filename):
+                self._rowid_map = RowidIndex(filename)
+            else:
+                # e.g. stores ingested before rowid indices were built
+                filename = self._paths['ingest']['rowids']
+                self._rowid_map = RowidDict(filename)
         return self._rowid_map
 
     def close(self):
@@ -265,19 +297,79 @@ class PreQL(object):
         row = self._transform.backward_row(features, header, row)
         return row
 
+    def encode_frame(self, rows):
+        '''
+        Encode a batch of rows column-wise.
+
+        Inputs:
+            rows - a pandas.DataFrame or dict of arrays, with columns
+                labeled by feature names and missing values as nan, None
+                or empty strings
+
+        Outputs:
+            A list of encoded rows, as accepted by encode_row's callers.
+        '''
+        frame = pandas.DataFrame(rows).reset_index(drop=True)
+        transformed = set(t.feature_name for t in self._transform.transforms)
+        for name in frame.columns:
+            column = frame[name]
+            if column.dtype == object:
+                frame[name] = column.where(column != '')
+            elif (self._name_to_model.get(name) not in NUMERIC_MODELS or
+                    name in transformed):
+                # only categorical and transformed values are parsed as text
+                present = column.notnull()
+                frame[name] = column.astype(str).astype(object).where(present)
+        features = self._feature_names
+        frame = self._transform.forward_frame(features, frame)
+        columns = [
+            self._name_to_encode_column[name](frame[name])
+            for name in features
+        ]
+        return map(list, izip(*columns))
+
+    def decode_frame(self, rows, header=None):
+        '''
+        Decode a batch of encoded rows column-wise.
+
+        Inputs:
+            rows - a list of encoded rows, as returned by the query server
+            header - an optional list of output columns
+
+        Outputs:
+            A pandas.DataFrame with columns header (default feature_names)
+            and missing values as null.
+        '''
+        features = self._feature_names
+        if header is None:
+            header = features
+        rows = list(rows)
+        columns = izip(*rows) if rows else [[]] * len(features)
+        frame = pandas.DataFrame(
+            {
+                name: self._name_to_decode_column[name](column)
+                for name, column in izip(features, columns)
+            },
+            columns=features)
+        return self._transform.backward_frame(header, frame)
+
     def _normalized_mutual_information(
             self,
             feature_set1,
             feature_set2,
             entropys=None,
             conditioning_row=None,
-            sample_count=None):
+            sample_count=None,
+            tolerance=None,
+            max_sample_count=None):
         mi = self._query_server.mutual_information(
                 feature_set1=feature_set1,
                 feature_set2=feature_set2,
                 entropys=entropys,
                 conditioning_row=conditioning_row,
-                sample_count=sample_count).mean
+                sample_count=sample_count,
+                tolerance=tolerance,
+                max_sample_count=max_sample_count).mean
         return normalize_mutual_information(mi)
 
     def predict(self, rows_csv, count, result_out=None, id_offset=True):
@@ -323,23 +415,66 @@ class PreQL(object):
         if id_offset and header[0] in self._feature_names:
             raise ValueError('id field conflict: {}'.format(header[0]))
         writer.writerow(header)
-        for row in reader:
-            if id_offset:
-                row_id = row[0]
-            conditioning_row = self.encode_row(row, header)
-            to_sample = [value is None for value in conditioning_row]
-            samples = self._query_server.sample(
-                    to_sample,
-                    conditioning_row,
-                    count)
+        for row, samples in self._iter_predictions(reader, header, count):
             for sample in samples:
-                print sample
-                sample = self.decode_row(sample, header)
                 if id_offset:
-                    sample[0] = row_id
+                    sample[0] = row[0]
                 writer.writerow(sample)
 
-    def relate(self, columns, result_out=None, sample_count=SAMPLE_COUNT):
+    def predict_frame(self, rows, count):
+        '''
+        Like predict, but inputs and outputs pandas.DataFrames.
+
+        Inputs:
+            rows - a pandas.DataFrame of conditional rows, with columns
+                labeled by feature names and missing values as nan or None
+            count - number of samples to generate for each input row
+
+        Outputs:
+            A pandas.DataFrame with the same columns as rows and count
+            sampled rows for each input row, indexed by the input row's index.
+        '''
+        header = list(rows.columns)
+        conditioning_rows = self.encode_frame(rows)
+        requests = (
+            ([value is None for value in row], row)
+            for row in conditioning_rows
+        )
+        results = self._query_server.batch_sample(requests, count)
+        index = []
+        samples = []
+        for label, row_samples in izip(rows.index, results):
+            index += [label] * len(row_samples)
+            samples += row_samples
+        result = self.decode_frame(samples, header)
+        result.index = index
+        return result
+
+    def _iter_predictions(self, rows, header, count):
+        '''
+        Yield (row, samples) for each input row, where samples are count
+        decoded rows sampled conditioned on row.
+        '''
+        pending = deque()
+
+        def encode_rows():
+            for row in rows:
+                pending.append(row)
+                conditioning_row = self.encode_row(row, header)
+                to_sample = [value is None for value in conditioning_row]
+                yield to_sample, conditioning_row
+
+        results = self._query_server.batch_sample(encode_rows(), count)
+        for samples in results:
+            row = pending.popleft()
+            yield row, [self.decode_row(sample, header) for sample in samples]
+
+    def relate(
+            self,
+            columns,
+            result_out=None,
+            sample_count=SAMPLE_COUNT,
+            tolerance=None):
         '''
         Compute pairwise related scores between all pairs (f1,f2) of columns
         where f1 in input columns and f2 in all_features.
@@ -351,6 +486,9 @@ class PreQL(object):
                 or None to return a csv string
             sample_count - number of samples in Monte Carlo computations;
                 increasing sample_count increases accuracy
+            tolerance - if given, sample adaptively until the standard error
+                of each entropy estimate is at most tolerance, using at most
+                sample_count samples
 
         Outputs:
             A csv with columns corresponding to input columns and one row
@@ -380,16 +518,37 @@ class PreQL(object):
                     query_feature_sets,
                     conditioning_row,
                     writer,
-                    sample_count)
+                    sample_count,
+                    tolerance)
             return writer.result()
 
+    def relate_array(
+            self,
+            columns,
+            sample_count=SAMPLE_COUNT,
+            tolerance=None):
+        '''
+        Like relate, but returns a pandas.DataFrame indexed and labeled by
+        columns rather than a csv.
+        '''
+        target_feature_sets = [self.encode_set([f]) for f in columns]
+        query_feature_sets = [self.encode_set([f]) for f in columns]
+        conditioning_row = self.encode_row(None)
+        return self._relate_frame(
+                target_feature_sets,
+                query_feature_sets,
+                conditioning_row,
+                sample_count,
+                tolerance)
+
     def refine(
             self,
             target_feature_sets=None,
             query_feature_sets=None,
             conditioning_row=None,
             result_out=None,
-            sample_count=SAMPLE_COUNT):
+            sample_count=SAMPLE_COUNT,
+            tolerance=None):
         '''
         Determine which queries would inform target features, in context.
 
@@ -409,6 +568,9 @@ class PreQL(object):
                 or None to return a csv string
             sample_count - number of samples in Monte Carlo computations;
                 increasing sample_count increases accuracy
+            tolerance - if given, sample adaptively until the standard error
+                of each entropy estimate is at most tolerance, using at most
+                sample_count samples
 
         Outputs:
             A csv with columns corresponding to query_feature_sets and
@@ -454,9 +616,97 @@ class PreQL(object):
                     query_feature_sets,
                     conditioning_row,
                     writer,
-                    sample_count)
+                    sample_count,
+                    tolerance)
             return writer.result()
 
+    def relate_matrix(self, sample_count=SAMPLE_COUNT, tile_size=None):
+        '''
+        Compute related scores between all pairs of features, as in
+        relate(feature_names), caching the result in the store.
+
+        Inputs:
+            sample_count - number of samples in Monte Carlo computations;
+                increasing sample_count increases accuracy
+            tile_size - number of features per entropy request tile
+
+        Outputs:
+            A symmetric float32 matrix whose (i, j) entry is the
+            relatedness of feature_names[i] and feature_names[j].
+            The matrix is memory-mapped from the store's query directory
+            and is reused until the dataset or samples change.
+        '''
+        paths = loom.store.get_paths(self._paths['root'], sample_count=None)
+        matrix_path = paths['query']['relate_matrix']
+        meta_path = paths['query']['relate_matrix_meta']
+        meta = {
+            'fingerprint': loom.store.get_fingerprint(paths),
+            'sample_count': sample_count,
+            'feature_names': self._feature_names,
+        }
+        if os.path.exists(meta_path) and json_load(meta_path) == meta:
+            return numpy.load(matrix_path, mmap_mode='r')
+
+        if tile_size is None:
+            tile_size = loom.query.DEFAULTS['tile_size']
+        feature_count = len(self._feature_names)
+        feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+        dependent = self._query_server.dependent
+
+        # write to a unique temp file, so concurrent callers do not collide
+        fd, temp_path = tempfile.mkstemp(
+                suffix='.npy',
+                dir=os.path.dirname(matrix_path))
+        os.close(fd)
+        try:
+            matrix = open_memmap(
+                    temp_path,
+                    mode='w+',
+                    dtype=numpy.float32,
+                    shape=(feature_count, feature_count))
+            matrix[:] = 0
+            matrix[numpy.diag_indices(feature_count)] = 1
+            for begin in xrange(0, feature_count, tile_size):
+                row_sets = feature_sets[begin: begin + tile_size]
+                tasks = []
+                for col_begin in xrange(begin, feature_count, tile_size):
+                    col_sets = feature_sets[col_begin: col_begin + tile_size]
+                    pairs = [
+                        (row_set, col_set)
+                        for row_set in row_sets
+                        for col_set in col_sets
+                        if min(row_set) < min(col_set)
+                        and dependent(row_set, col_set)
+                    ]
+                    if pairs:
+                        task_rows = sorted(set(r for r, _ in pairs), key=min)
+                        task_cols = sorted(set(c for _, c in pairs), key=min)
+                        tasks.append((task_rows, task_cols, pairs))
+                results = self._query_server.batch_entropy(
+                        [(rows, cols, None) for rows, cols, _ in tasks],
+                        sample_count=sample_count,
+                        tile_size=tile_size)
+                for (_, _, pairs), entropys in izip(tasks, results):
+                    # each tile's marginals share samples with its joints,
+                    # so their sampling errors mostly cancel in mi
+                    for row_set, col_set in pairs:
+                        mi = entropys[row_set].mean \
+                            + entropys[col_set].mean \
+                            - entropys[row_set | col_set].mean
+                        related = normalize_mutual_information(mi)
+                        i = min(row_set)
+                        j = min(col_set)
+                        matrix[i, j] = related
+                        matrix[j, i] = related
+                matrix.flush()
+            del matrix
+            os.rename(temp_path, matrix_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        json_dump(meta, meta_path)
+        return numpy.load(matrix_path, mmap_mode='r')
+
     def conditional_relate(self,
                            X=None,
                            Y=None,
@@ -499,6 +749,11 @@ class PreQL(object):
         # query_labels = map(min, query_feature_set)
         # conditional_labels = map(min, Z)
 
+        X_union = frozenset().union(*X_sets)
+        Y_union = frozenset().union(*Y_sets)
+        if not self._query_server.dependent(X_union, Y_union):
+            return normalize_mutual_information(0.0)
+
         new_target_sets = X_sets + Y_sets + Z_sets
         new_query_sets = [[X_sets, Z], [Y_sets, Z], [Z]]
         entropies = {}
@@ -523,7 +778,8 @@ class PreQL(object):
             observed_feature_sets=None,
             conditioning_row=None,
             result_out=None,
-            sample_count=SAMPLE_COUNT):
+            sample_count=SAMPLE_COUNT,
+            tolerance=None):
         '''
         Determine which observed features most inform target features,
             in context.
@@ -549,6 +805,9 @@ class PreQL(object):
                 or None to return a csv string
             sample_count - number of samples in Monte Carlo computations;
                 increasing sample_count increases accuracy
+            tolerance - if given, sample adaptively until the standard error
+                of each entropy estimate is at most tolerance, using at most
+                sample_count samples
 
         Outputs:
             A csv with columns corresponding to observed_feature_sets and
@@ -597,7 +856,8 @@ class PreQL(object):
                     observed_feature_sets,
                     conditioning_row,
                     writer,
-                    sample_count)
+                    sample_count,
+                    tolerance)
             return writer.result()
 
     def _relate(
@@ -606,10 +866,29 @@ class PreQL(object):
             query_feature_sets,
             conditioning_row,
             writer,
-            sample_count):
+            sample_count,
+            tolerance=None):
+        result = self._relate_frame(
+                target_feature_sets,
+                query_feature_sets,
+                conditioning_row,
+                sample_count,
+                tolerance)
+        writer.writerow([None] + list(result.columns))
+        for label, values in izip(result.index, result.values.tolist()):
+            writer.writerow([label] + values)
+
+    def _relate_frame(
+            self,
+            target_feature_sets,
+            query_feature_sets,
+            conditioning_row,
+            sample_count,
+            tolerance=None):
         '''
         Compute all pairwise related scores between target_set
-        and query_set
+        and query_set, returning a DataFrame indexed by target labels
+        with columns labeled by query labels
 
         In general it is assumed that all features in the target set
         and query set are unobserved in the conditioning row. If a feature
@@ -627,36 +906,99 @@ class PreQL(object):
         query_sets = map(self._cols_to_mask, query_feature_sets)
         target_labels = map(min, target_feature_sets)
         query_labels = map(min, query_feature_sets)
-        entropys = self._query_server.entropy(
-                row_sets=target_sets,
-                col_sets=query_sets,
-                conditioning_row=conditioning_row,
-                sample_count=sample_count)
-        writer.writerow([None] + query_labels)
-        for target_label, target_set in izip(target_labels, target_sets):
-            result_row = [target_label]
+        if tolerance is None:
+            budget = {'sample_count': sample_count}
+        else:
+            budget = {
+                'sample_count': min(sample_count, ADAPTIVE_SAMPLE_COUNT),
+                'tolerance': tolerance,
+                'max_sample_count': sample_count,
+            }
+        dependent = self._query_server.dependent
+
+        # Cells with observed features are estimated WRT a forgetful
+        # conditioning row; group these cells by that row.  Estimate other
+        # cells within connected components of structurally dependent
+        # feature sets, so both orders of a pair share one estimate.
+        component = {
+            feature_set: feature_set
+            for feature_set in target_sets + query_sets
+        }
+
+        def find(feature_set):
+            while component[feature_set] != feature_set:
+                feature_set = component[feature_set]
+            return feature_set
+
+        forgetful_keys = {}
+        forgetful_groups = {}
+        for target_set in target_sets:
             for query_set in query_sets:
+                if target_set == query_set:
+                    continue
+                if not dependent(target_set, query_set):
+                    continue
+                forgetful_conditioning_row = copy(conditioning_row)
+                for feature_index in target_set | query_set:
+                    forgetful_conditioning_row[feature_index] = None
+                if forgetful_conditioning_row == conditioning_row:
+                    component[find(target_set)] = find(query_set)
+                else:
+                    key = tuple(forgetful_conditioning_row)
+                    forgetful_keys[target_set, query_set] = key
+                    row_sets, col_sets = forgetful_groups.setdefault(
+                            key,
+                            ([], []))
+                    if target_set not in row_sets:
+                        row_sets.append(target_set)
+                    if query_set not in col_sets:
+                        col_sets.append(query_set)
+
+        blocks = {}
+        for target_set in target_sets:
+            blocks.setdefault(find(target_set), ([], []))[0].append(target_set)
+        for query_set in query_sets:
+            blocks.setdefault(find(query_set), ([], []))[1].append(query_set)
+        tasks = [
+            (block_targets, block_queries, conditioning_row)
+            for block_targets, block_queries in blocks.itervalues()
+            if len(set(block_targets + block_queries)) > 1
+        ]
+        block_count = len(tasks)
+        keys = forgetful_groups.keys()
+        for key in keys:
+            row_sets, col_sets = forgetful_groups[key]
+            tasks.append((row_sets, col_sets, list(key)))
+
+        results = self._query_server.batch_entropy(tasks, **budget)
+        entropys = {}
+        for result in results[:block_count]:
+            entropys.update(result)
+        forgetful_entropys = dict(izip(keys, results[block_count:]))
+
+        result = numpy.zeros((len(target_sets), len(query_sets)))
+        for i, target_set in enumerate(target_sets):
+            for j, query_set in enumerate(query_sets):
                 if target_set == query_set:
                     normalized_mi = 1.0
+                elif not dependent(target_set, query_set):
+                    normalized_mi = 0.0
                 else:
-                    forgetful_conditioning_row = copy(conditioning_row)
-                    for feature_index in target_set | query_set:
-                        forgetful_conditioning_row[feature_index] = None
-                    if forgetful_conditioning_row != conditioning_row:
-                        normalized_mi = self._normalized_mutual_information(
-                                target_set,
-                                query_set,
-                                entropys=None,
-                                conditioning_row=forgetful_conditioning_row,
-                                sample_count=sample_count)
+                    key = forgetful_keys.get((target_set, query_set))
+                    if key is None:
+                        cell_entropys = entropys
                     else:
-                        normalized_mi = self._normalized_mutual_information(
-                                target_set,
-                                query_set,
-                                entropys=entropys,
-                                sample_count=sample_count)
-                result_row.append(normalized_mi)
-            writer.writerow(result_row)
+                        cell_entropys = forgetful_entropys[key]
+                    normalized_mi = self._normalized_mutual_information(
+                            target_set,
+                            query_set,
+                            entropys=cell_entropys,
+                            **budget)
+                result[i, j] = normalized_mi
+        return pandas.DataFrame(
+                result,
+                index=target_labels,
+                columns=query_labels)
 
     def group(self, column, result_out=None):
         '''
@@ -692,7 +1034,7 @@ class PreQL(object):
     def _group(self, column, writer):
         root = self._query_server.root
         feature_pos = self._name_to_pos[column]
-        result = loom.group.group(root, feature_pos)
+        result = loom.group.group(root, feature_pos, cache=True)
         rowid_map = self.rowid_map
         writer.writerow(loom.group.Row._fields)
         for row in result:
@@ -712,16 +1054,25 @@ class PreQL(object):
             entries ij giving the similarity score between row i
             and row j.
         '''
+        result = self.similar_array(rows, rows2, row_limit)
+        with csv_output(result_out) as writer:
+            writer.writerows(result.tolist())
+            return writer.result()
+
+    def similar_array(self, rows, rows2=None, row_limit=None):
+        '''
+        Like similar, but returns a numpy array whose entry ij is the
+        similarity score between row i and row j, or nan if row j was not
+        among the row_limit most similar rows to row i.
+        '''
         rows = map(self.encode_row, rows)
         if rows2 is not None:
             rows2 = map(self.encode_row, rows2)
         else:
             rows2 = rows
-        with csv_output(result_out) as writer:
-            self._similar(rows, rows2, row_limit, writer)
-            return writer.result()
+        return self._similar(rows, rows2, row_limit)
 
-    def _similar(self, update_rows, score_rows, row_limit, writer):
+    def _similar(self, update_rows, score_rows, row_limit):
         score_ids = set()
         update_row_results = []
         for update_row in update_rows:
@@ -731,53 +1082,86 @@ class PreQL(object):
                     row_limit=row_limit)
             results_dict = dict(results)
             update_row_results.append(results_dict)
-            score_ids = score_ids.union(set(results_dict.keys()))
-        for results in update_row_results:
-            writer.writerow([results[_id] for _id in score_ids])
-
-    def search(self, row, row_limit=None, result_out=None):
+            score_ids.update(results_dict.iterkeys())
+        score_ids = sorted(score_ids)
+        result = numpy.empty((len(update_row_results), len(score_ids)))
+        result.fill(numpy.nan)
+        for i, results in enumerate(update_row_results):
+            for j, _id in enumerate(score_ids):
+                if _id in results:
+                    result[i, j] = results[_id]
+        return result
+
+    def search(self, row, row_limit=None, result_out=None, prune=False):
         '''
         Find the top n most similar rows to `row` in the dataset.
 
         Inputs:
             row - a data row or dict
+            prune - whether to only score rows sharing a group with `row`;
+                this is faster but approximate
 
         Outputs
             A csv file with with columns row_id, score, showing the
             top 1000 most search rows in the dataset, sorted by score
         '''
-        row = self.encode_row(row)
+        result = self.search_array(row, row_limit, prune)
         with csv_output(result_out) as writer:
-            self._search(row, row_limit, writer)
+            writer.writerow(('row_id', 'score'))
+            writer.writerows(izip(result['row_id'], result['score']))
             return writer.result()
 
-    def _search(self, row, row_limit, writer):
+    def search_array(self, row, row_limit=None, prune=False):
+        '''
+        Like search, but returns a pandas.DataFrame with columns
+        row_id, score rather than a csv.
+        '''
+        row = self.encode_row(row)
+        return self._search(row, row_limit, prune)
+
+    def _search(self, row, row_limit, prune=False):
         results = self._query_server.score_derivative(
                 row,
                 score_rows=None,
-                row_limit=row_limit)
+                row_limit=row_limit,
+                prune=prune)
         # FIXME map through erf
-        writer.writerow(('row_id', 'score'))
-        for row_id, score in results:
-            external_id = self.rowid_map[row_id]
-            writer.writerow((external_id, score))
+        rowid_map = self.rowid_map
+        return pandas.DataFrame(
+                {
+                    'row_id': [rowid_map[row_id] for row_id, _ in results],
+                    'score': [score for _, score in results],
+                },
+                columns=['row_id', 'score'])
 
     def cluster(
             self,
             rows_to_cluster=None,
             seed_rows=None,
             cluster_count=None,
-            nearest_neighbors=10):
+            nearest_neighbors=10,
+            sparse=False):
+        '''
+        Spectrally cluster seed_rows (sampled from the model by default),
+        then label each of rows_to_cluster by a vote among its
+        nearest_neighbors most similar seed rows.
+
+        If sparse is True, the affinity matrix keeps only each seed row's
+        nearest_neighbors most similar seed rows, and similarities are
+        computed in batches; this scales to many more seed rows.
+        '''
+        if sparse:
+            return self._cluster_sparse(
+                rows_to_cluster,
+                seed_rows,
+                cluster_count,
+                nearest_neighbors)
         if seed_rows is None:
             seed_rows = self._query_server.sample(
                     [None for _ in self.feature_names],
                     sample_count=SAMPLE_COUNT)
         row_limit = len(seed_rows) ** 2 + 1
-        similar_string = StringIO(self.similar(seed_rows, row_limit=row_limit))
-        similar = numpy.genfromtxt(
-                similar_string,
-                delimiter=',',
-                skip_header=0)
+        similar = self.similar_array(seed_rows, row_limit=row_limit)
         similar = similar.clip(0., 5.)
         similar = numpy.exp(similar)
         clustering = SpectralClustering(
@@ -790,14 +1174,10 @@ class PreQL(object):
         else:
             row_labels = []
             for row in rows_to_cluster:
-                similar_scores = self.similar(
+                similar_scores = self.similar_array(
                         [row],
                         seed_rows,
-                        row_limit=row_limit)
-                similar_scores = numpy.genfromtxt(
-                        StringIO(similar_scores),
-                        delimiter=',',
-                        skip_header=0)
+                        row_limit=row_limit)[0]
                 assert len(similar_scores) == len(labels)
                 label_scores = zip(similar_scores, labels)
                 top = sorted(label_scores, reverse=True)[:nearest_neighbors]
@@ -806,6 +1186,57 @@ class PreQL(object):
                 row_labels.append(top_label)
             return zip(row_labels, rows_to_cluster)
 
+    def _cluster_sparse(
+            self,
+            rows_to_cluster,
+            seed_rows,
+            cluster_count,
+            nearest_neighbors):
+        if seed_rows is None:
+            seed_rows = self._query_server.sample(
+                    [None for _ in self.feature_names],
+                    sample_count=SAMPLE_COUNT)
+            encoded_seed_rows = seed_rows
+        else:
+            encoded_seed_rows = map(self.encode_row, seed_rows)
+        seed_count = len(encoded_seed_rows)
+        row_limit = min(nearest_neighbors, seed_count)
+        neighbors = self._query_server.batch_score_derivative(
+            encoded_seed_rows,
+            encoded_seed_rows,
+            row_limit=row_limit)
+
+        rows = []
+        cols = []
+        scores = []
+        for i, results in enumerate(neighbors):
+            for j, score in results:
+                rows.append(i)
+                cols.append(j)
+                scores.append(score)
+        affinity = scipy.sparse.coo_matrix(
+            (numpy.exp(numpy.clip(scores, 0., 5.)), (rows, cols)),
+            shape=(seed_count, seed_count)).tocsr()
+        affinity = 0.5 * (affinity + affinity.T)
+        clustering = SpectralClustering(
+                n_clusters=cluster_count,
+                affinity='precomputed')
+        labels = clustering.fit_predict(affinity)
+
+        if rows_to_cluster is None:
+            return zip(labels, seed_rows)
+        else:
+            rows_to_cluster = list(rows_to_cluster)
+            neighbors = self._query_server.batch_score_derivative(
+                (self.encode_row(row) for row in rows_to_cluster),
+                encoded_seed_rows,
+                row_limit=row_limit)
+            row_labels = []
+            for results in neighbors:
+                label_counts = Counter(labels[j] for j, _ in results)
+                row_labels.append(label_counts.most_common(1)[0][0])
+            return zip(row_labels, rows_to_cluster)
+
 
 def normalize_mutual_information(mutual_info):
     '''
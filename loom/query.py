@@ -27,33 +27,49 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import uuid
+import threading
+from functools import partial
 from itertools import chain
+from itertools import islice
+from itertools import izip
+from collections import deque
 from collections import namedtuple
 import numpy
+from distributions.io.stream import open_compressed
 from distributions.io.stream import protobuf_stream_read
 from distributions.io.stream import protobuf_stream_write
+from loom.schema_pb2 import CrossCat
 from loom.schema_pb2 import ProductValue
 from loom.schema_pb2 import Row
 from loom.schema_pb2 import Query
 import loom.cFormat
 import loom.runner
+import loom.store
+from loom.util import LOG
 
 DEFAULTS = {
     'sample_sample_count': 10,
     'entropy_sample_count': 1000,
+    'entropy_max_sample_count': 10000,
     'mutual_information_sample_count': 1000,
     'similar_row_limit': 1000,
     'tile_size': 500,
+    'max_pending': 100,
+    'batch_size': 1000,
 }
 BUFFER_SIZE = 10
 
-Estimate = namedtuple('Estimate', ['mean', 'variance'], verbose=False)
+Estimate = namedtuple(
+    'Estimate',
+    ['mean', 'variance', 'sample_count'],
+    verbose=False)
+Estimate.__new__.__defaults__ = (None,)
 
 
 def get_estimate(samples):
     mean = numpy.mean(samples)
     variance = numpy.var(samples) / len(samples)
-    return Estimate(mean, variance)
+    return Estimate(mean, variance, len(samples))
 
 
 NONE = ProductValue.Observed.NONE
@@ -110,6 +126,17 @@ def load_data_rows(filename):
         ]
 
 
+def sample_to_protobuf(to_sample, conditioning_row, sample_count, message):
+    assert isinstance(message, Query.Sample.Request)
+    if sample_count is None:
+        sample_count = DEFAULTS['sample_sample_count']
+    assert len(to_sample) == len(conditioning_row)
+    data_row_to_protobuf(conditioning_row, message.data)
+    message.to_sample.sparsity = DENSE
+    message.to_sample.dense[:] = to_sample
+    message.sample_count = sample_count
+
+
 def feature_set_to_protobuf(feature_set, messages):
     message = messages.add()
     message.sparsity = SPARSE
@@ -117,14 +144,129 @@ def feature_set_to_protobuf(feature_set, messages):
         message.sparse.append(i)
 
 
+def check_response(response):
+    if response.error:
+        raise Exception('\n'.join(response.error))
+
+
+def parse_sample(to_sample, conditioning_row, response):
+    return parse_samples(to_sample, conditioning_row, response.sample)
+
+
+def parse_batch_sample(pairs, response):
+    responses = response.batch_sample.responses
+    assert len(responses) == len(pairs), responses
+    return [
+        parse_samples(to_sample, conditioning_row, sample_response)
+        for (to_sample, conditioning_row), sample_response
+        in izip(pairs, responses)
+    ]
+
+
+def parse_samples(to_sample, conditioning_row, sample_response):
+    samples = []
+    for sample in sample_response.samples:
+        data_out = protobuf_to_data_row(sample)
+        for i, val in enumerate(data_out):
+            if val is None:
+                assert to_sample[i] is False
+                data_out[i] = conditioning_row[i]
+        samples.append(data_out)
+    return samples
+
+
+def parse_score(response):
+    return response.score.score
+
+
+def parse_batch_score(response):
+    return numpy.array(response.batch_score.scores, dtype=numpy.float32)
+
+
+def parse_entropy(row_sets, col_sets, response):
+    means = response.entropy.means
+    variances = response.entropy.variances
+    sample_count = response.entropy.sample_count
+    size = len(row_sets) * len(col_sets)
+    assert len(means) == size, means
+    assert len(variances) == size, variances
+    means = iter(means)
+    variances = iter(variances)
+    return {
+        row_set | col_set: Estimate(
+            means.next(),
+            variances.next(),
+            sample_count)
+        for row_set in row_sets
+        for col_set in col_sets
+    }
+
+
+def parse_score_derivative(response):
+    ids = response.score_derivative.ids
+    score_diffs = response.score_derivative.score_diffs
+    return zip(ids, score_diffs)
+
+
+def parse_batch_score_derivative(response):
+    return [
+        zip(result.ids, result.score_diffs)
+        for result in response.batch_score_derivative.responses
+    ]
+
+
+def load_kind_coassignment(root):
+    '''
+    Return a boolean matrix whose (f1, f2) entry is True iff features f1 and
+    f2 share a kind in some sample.
+    '''
+    paths = loom.store.get_paths(root, sample_count=None)
+    coassigned = None
+    for sample in paths['samples']:
+        model = CrossCat()
+        with open_compressed(sample['model']) as f:
+            model.ParseFromString(f.read())
+        if coassigned is None:
+            feature_count = sum(len(kind.featureids) for kind in model.kinds)
+            coassigned = numpy.zeros((feature_count, feature_count), bool)
+        for kind in model.kinds:
+            featureids = list(kind.featureids)
+            coassigned[numpy.ix_(featureids, featureids)] = True
+    return coassigned
+
+
 class QueryServer(object):
     def __init__(self, protobuf_server):
         self.protobuf_server = protobuf_server
+        self._responses = {}
+        self._kind_coassignment = None
 
     @property
     def root(self):
         return self.protobuf_server.root
 
+    @property
+    def kind_coassignment(self):
+        '''
+        A boolean matrix whose (f1, f2) entry is True iff features f1 and f2
+        share a kind in some sample.  Features that never share a kind are
+        independent in each sample, so their mutual information is treated
+        as zero, ignoring the small dependence due to mixing over samples.
+        '''
+        if self._kind_coassignment is None:
+            self._kind_coassignment = load_kind_coassignment(self.root)
+        return self._kind_coassignment
+
+    def dependent(self, feature_set1, feature_set2):
+        '''
+        Whether any feature in feature_set1 shares a kind with any feature
+        in feature_set2 in some sample.
+        '''
+        coassigned = self.kind_coassignment
+        return any(coassigned[f1, f2]
+                   for f1 in feature_set1
+                   for f2 in feature_set2)
+
     def close(self):
         self.protobuf_server.close()
 
@@ -139,63 +281,125 @@ class QueryServer(object):
         request.id = str(uuid.uuid4())
         return request
 
-    def sample(self, to_sample, conditioning_row=None, sample_count=None):
-        if sample_count is None:
-            sample_count = DEFAULTS['sample_sample_count']
+    def _receive(self, request_id):
+        '''
+        Receive the response to a request, buffering any responses to other
+        requests; a multithreaded server may respond out of order.
+        '''
+        response = self._responses.pop(request_id, None)
+        while response is None:
+            response = self.protobuf_server.receive()
+            if response.id != request_id:
+                self._responses[response.id] = response
+                response = None
+        check_response(response)
+        return response
+
+    def _call(self, request, parse):
+        self.protobuf_server.send(request)
+        return parse(self._receive(request.id))
+
+    def _pipeline(self, calls, buffer_size=BUFFER_SIZE):
+        pending = deque()
+        for request, parse in calls:
+            self.protobuf_server.send(request)
+            pending.append((request.id, parse))
+            if len(pending) > buffer_size:
+                request_id, parse = pending.popleft()
+                yield parse(self._receive(request_id))
+        while pending:
+            request_id, parse = pending.popleft()
+            yield parse(self._receive(request_id))
+
+    def _sample_request(self, to_sample, conditioning_row, sample_count):
         if conditioning_row is None:
             conditioning_row = [None for _ in to_sample]
-        assert len(to_sample) == len(conditioning_row)
         request = self.request()
-        data_row_to_protobuf(conditioning_row, request.sample.data)
-        request.sample.to_sample.sparsity = DENSE
-        request.sample.to_sample.dense[:] = to_sample
-        request.sample.sample_count = sample_count
-        self.protobuf_server.send(request)
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
-        samples = []
-        for sample in response.sample.samples:
-            data_out = protobuf_to_data_row(sample)
-            for i, val in enumerate(data_out):
-                if val is None:
-                    assert to_sample[i] is False
-                    data_out[i] = conditioning_row[i]
-            samples.append(data_out)
-        return samples
-
-    def _send_score(self, row):
+        sample_to_protobuf(
+            to_sample,
+            conditioning_row,
+            sample_count,
+            request.sample)
+        return request, partial(parse_sample, to_sample, conditioning_row)
+
+    def _batch_sample_request(self, pairs, sample_count):
         request = self.request()
-        data_row_to_protobuf(row, request.score.data)
-        self.protobuf_server.send(request)
+        for to_sample, conditioning_row in pairs:
+            sample_to_protobuf(
+                to_sample,
+                conditioning_row,
+                sample_count,
+                request.batch_sample.requests.add())
+        return request, partial(parse_batch_sample, pairs)
 
-    def _receive_score(self):
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
-        return response.score.score
+    def batch_sample(self, pairs, sample_count=None, batch_size=None):
+        '''
+        Sample from the conditional distributions of many rows, given as an
+        iterable of (to_sample, conditioning_row) pairs; yield one list of
+        samples per pair.  Pairs are sent batch_size at a time, each batch
+        in one request.
+        '''
+        if batch_size is None:
+            batch_size = DEFAULTS['batch_size']
+        assert batch_size > 0, batch_size
+        pairs = iter(pairs)
+        batches = iter(lambda: list(islice(pairs, batch_size)), [])
+        calls = (
+            self._batch_sample_request(batch, sample_count)
+            for batch in batches
+        )
+        for samples in self._pipeline(calls):
+            for sample in samples:
+                yield sample
+
+    def sample(self, to_sample, conditioning_row=None, sample_count=None):
+        return self._call(*self._sample_request(
+            to_sample,
+            conditioning_row,
+            sample_count))
+
+    def _score_request(self, row):
+        request = self.request()
+        data_row_to_protobuf(row, request.score.data)
+        return request, parse_score
 
     def score(self, row):
-        self._send_score(row)
-        return self._receive_score()
+        return self._call(*self._score_request(row))
 
     def batch_score(self, rows, buffer_size=BUFFER_SIZE):
-        buffered = 0
+        calls = (self._score_request(row) for row in rows)
+        return self._pipeline(calls, buffer_size)
+
+    def _batch_score_request(self, rows):
+        request = self.request()
         for row in rows:
-            self._send_score(row)
-            if buffered < buffer_size:
-                buffered += 1
-            else:
-                yield self._receive_score()
-        for _ in xrange(buffered):
-            yield self._receive_score()
+            data_row_to_protobuf(row, request.batch_score.data.add())
+        return request, parse_batch_score
 
-    def _entropy(
+    def score_many(self, rows, batch_size=None):
+        '''
+        Score each of rows, returning a numpy array of scores.
+        Rows are sent batch_size at a time, each batch in one request.
+        '''
+        if batch_size is None:
+            batch_size = DEFAULTS['batch_size']
+        assert batch_size > 0, batch_size
+        rows = iter(rows)
+        batches = iter(lambda: list(islice(rows, batch_size)), [])
+        calls = (self._batch_score_request(batch) for batch in batches)
+        scores = list(self._pipeline(calls))
+        if not scores:
+            return numpy.zeros(0, dtype=numpy.float32)
+        return numpy.concatenate(scores)
+
+    def _entropy_request(
             self,
             row_sets,
             col_sets,
-            conditioning_row=None,
-            sample_count=None):
+            conditioning_row,
+            sample_count,
+            tolerance=None,
+            max_sample_count=None):
         row_sets = list(set(map(frozenset, row_sets)) | set([frozenset()]))
         col_sets = list(set(map(frozenset, col_sets)) | set([frozenset()]))
         if sample_count is None:
@@ -210,22 +414,31 @@ class QueryServer(object):
         for feature_set in col_sets:
             feature_set_to_protobuf(feature_set, request.entropy.col_sets)
         request.entropy.sample_count = sample_count
-        self.protobuf_server.send(request)
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
-        means = response.entropy.means
-        variances = response.entropy.variances
-        size = len(row_sets) * len(col_sets)
-        assert len(means) == size, means
-        assert len(variances) == size, variances
-        means = iter(means)
-        variances = iter(variances)
-        return {
-            row_set | col_set: Estimate(means.next(), variances.next())
-            for row_set in row_sets
-            for col_set in col_sets
-        }
+        if tolerance is not None:
+            assert tolerance > 0, tolerance
+            if max_sample_count is None:
+                max_sample_count = max(
+                    sample_count,
+                    DEFAULTS['entropy_max_sample_count'])
+            request.entropy.tolerance = tolerance
+            request.entropy.max_sample_count = max_sample_count
+        return request, partial(parse_entropy, row_sets, col_sets)
+
+    def _entropy(
+            self,
+            row_sets,
+            col_sets,
+            conditioning_row=None,
+            sample_count=None,
+            tolerance=None,
+            max_sample_count=None):
+        return self._call(*self._entropy_request(
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tolerance,
+            max_sample_count))
 
     def entropy(
             self,
@@ -233,23 +446,58 @@ class QueryServer(object):
             col_sets,
             conditioning_row=None,
             sample_count=None,
-            tile_size=None):
+            tile_size=None,
+            tolerance=None,
+            max_sample_count=None):
+        '''
+        Estimate the entropy of each union of a row_set and a col_set.
+        If tolerance is given, start with sample_count samples and keep
+        sampling until each estimate's standard error is at most tolerance
+        or max_sample_count samples have been drawn.
+        '''
+        return self.batch_entropy(
+            [(row_sets, col_sets, conditioning_row)],
+            sample_count,
+            tile_size,
+            tolerance,
+            max_sample_count)[0]
+
+    def batch_entropy(
+            self,
+            tasks,
+            sample_count=None,
+            tile_size=None,
+            tolerance=None,
+            max_sample_count=None):
+        '''
+        Estimate entropies for each of many (row_sets, col_sets,
+        conditioning_row) tasks, pipelining the tiled requests of all tasks.
+        Returns one dict of estimates per task, as from entropy.
+        '''
         if tile_size is None:
             tile_size = DEFAULTS['tile_size']
-        min_size = max(1, min(tile_size, len(row_sets), len(col_sets)))
-        tile_size = tile_size * tile_size / min_size
-        assert tile_size > 0, tile_size
-        result = {}
-        for i in xrange(0, len(row_sets), tile_size):
-            row_tile = row_sets[i: i + tile_size]
-            for j in xrange(0, len(col_sets), tile_size):
-                col_tile = col_sets[j: j + tile_size]
-                result.update(self._entropy(
-                    row_tile,
-                    col_tile,
-                    conditioning_row,
-                    sample_count))
-        return result
+        calls = []
+        owners = []
+        for owner, (row_sets, col_sets, conditioning_row) in enumerate(tasks):
+            min_size = max(1, min(tile_size, len(row_sets), len(col_sets)))
+            task_tile_size = tile_size * tile_size / min_size
+            assert task_tile_size > 0, task_tile_size
+            for i in xrange(0, len(row_sets), task_tile_size):
+                row_tile = row_sets[i: i + task_tile_size]
+                for j in xrange(0, len(col_sets), task_tile_size):
+                    col_tile = col_sets[j: j + task_tile_size]
+                    calls.append(self._entropy_request(
+                        row_tile,
+                        col_tile,
+                        conditioning_row,
+                        sample_count,
+                        tolerance,
+                        max_sample_count))
+                    owners.append(owner)
+        results = [{} for _ in tasks]
+        for owner, result in izip(owners, self._pipeline(calls)):
+            results[owner].update(result)
+        return results
 
     def mutual_information(
             self,
@@ -257,7 +505,9 @@ class QueryServer(object):
             feature_set2,
             entropys=None,
             conditioning_row=None,
-            sample_count=None):
+            sample_count=None,
+            tolerance=None,
+            max_sample_count=None):
         '''
         Estimate the mutual information between feature_set1
         and feature_set2 conditioned on conditioning_row
@@ -276,20 +526,45 @@ class QueryServer(object):
                 [feature_set1],
                 [feature_set2],
                 conditioning_row,
-                sample_count)
+                sample_count,
+                tolerance=tolerance,
+                max_sample_count=max_sample_count)
         mi = entropys[feature_set1].mean \
             + entropys[feature_set2].mean \
             - entropys[feature_union].mean
         variance = entropys[feature_set1].variance \
             + entropys[feature_set2].variance \
             + entropys[feature_union].variance
-        return Estimate(mi, variance)
+        return Estimate(mi, variance, entropys[feature_union].sample_count)
 
     def score_derivative(
             self,
             update_row,
             score_rows=None,
-            row_limit=None):
+            row_limit=None,
+            prune=False):
+        '''
+        Score how much adding update_row to the model increases the score
+        of each of score_rows (or of each dataset row if score_rows is None),
+        returning the row_limit best (id, score_diff) pairs.
+        If prune is True, only dataset rows sharing a group with update_row
+        in some kind of some sample are rescored; results are approximate.
+        Pruning computes baseline scores once per server, but only writes
+        them to disk if the query config sets cache_scores.
+        '''
+        return self._call(*self._score_derivative_request(
+            update_row,
+            score_rows,
+            row_limit,
+            prune))
+
+    def _score_derivative_request(
+            self,
+            update_row,
+            score_rows,
+            row_limit,
+            prune):
+        assert score_rows is None or not prune, 'cannot prune score_rows'
         row = Row()
         request = self.request()
         if row_limit is None:
@@ -303,18 +578,214 @@ class QueryServer(object):
                 added_diff.MergeFrom(row.diff)
 
         request.score_derivative.row_limit = row_limit
+        request.score_derivative.prune = prune
         data_row_to_protobuf(
             update_row,
             row.diff)
         request.score_derivative.update_data.MergeFrom(row.diff)
+        return request, parse_score_derivative
 
-        self.protobuf_server.send(request)
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
-        ids = response.score_derivative.ids
-        score_diffs = response.score_derivative.score_diffs
-        return zip(ids, score_diffs)
+    def batch_score_derivative(
+            self,
+            update_rows,
+            score_rows,
+            row_limit=None,
+            batch_size=None):
+        '''
+        Like score_derivative with fixed score_rows, but for many
+        update_rows; yield one list of the row_limit best (index, score_diff)
+        pairs per update row, where index is a position in score_rows.
+        Update rows are sent batch_size at a time, each batch in one request.
+        '''
+        if batch_size is None:
+            batch_size = DEFAULTS['batch_size']
+        assert batch_size > 0, batch_size
+        score_rows = list(score_rows)
+        assert score_rows, 'score_rows must be nonempty'
+        update_rows = iter(update_rows)
+        batches = iter(lambda: list(islice(update_rows, batch_size)), [])
+        calls = (
+            self._batch_score_derivative_request(batch, score_rows, row_limit)
+            for batch in batches
+        )
+        for results in self._pipeline(calls):
+            for result in results:
+                yield result
+
+    def _batch_score_derivative_request(
+            self,
+            update_rows,
+            score_rows,
+            row_limit):
+        request = self.request()
+        if row_limit is None:
+            row_limit = DEFAULTS['similar_row_limit']
+        message = request.batch_score_derivative
+        for data_row in score_rows:
+            data_row_to_protobuf(data_row, message.score_data.add())
+        for data_row in update_rows:
+            data_row_to_protobuf(data_row, message.update_data.add())
+        message.row_limit = row_limit
+        return request, parse_batch_score_derivative
+
+
+class Future(object):
+    '''
+    The eventual result of a request sent by an AsyncQueryServer.
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('timed out waiting for response')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class AsyncQueryServer(QueryServer):
+    '''
+    A QueryServer that keeps up to max_pending requests in flight.
+
+    The *_async methods return a Future rather than blocking on a response;
+    a background thread matches responses to futures by request id.
+    Sending blocks while max_pending requests are awaiting responses,
+    so many threads can safely share one server process.
+    If the server process dies, every pending future fails with the error
+    that stopped the reader, and later submissions raise that error.
+    '''
+    def __init__(self, protobuf_server, max_pending=None):
+        if max_pending is None:
+            max_pending = DEFAULTS['max_pending']
+        assert max_pending > 0, max_pending
+        super(AsyncQueryServer, self).__init__(protobuf_server)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._error = None
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def close(self):
+        super(AsyncQueryServer, self).close()
+        self._reader.join()
+
+    def _read_responses(self):
+        try:
+            while True:
+                response = self.protobuf_server.receive()
+                with self._pending_lock:
+                    pending = self._pending.pop(response.id, None)
+                if pending is None:
+                    LOG('ignoring response to unknown request {}'.format(
+                        response.id))
+                    continue
+                future, parse = pending
+                self._slots.release()
+                try:
+                    check_response(response)
+                    future.set_result(parse(response))
+                except Exception as e:
+                    future.set_exception(e)
+        except Exception as e:
+            # the server has exited, so no more responses will arrive
+            with self._pending_lock:
+                self._error = e
+                pending = self._pending.values()
+                self._pending.clear()
+            for future, _ in pending:
+                self._slots.release()
+                future.set_exception(e)
+
+    def submit(self, request, parse):
+        future = Future()
+        self._slots.acquire()
+        with self._pending_lock:
+            if self._error is not None:
+                self._slots.release()
+                raise self._error
+            self._pending[request.id] = (future, parse)
+        try:
+            with self._send_lock:
+                self.protobuf_server.send(request)
+        except Exception:
+            with self._pending_lock:
+                if self._pending.pop(request.id, None) is not None:
+                    self._slots.release()
+            raise
+        return future
+
+    def _call(self, request, parse):
+        return self.submit(request, parse).result()
+
+    def _pipeline(self, calls, buffer_size=BUFFER_SIZE):
+        pending = deque()
+        for request, parse in calls:
+            pending.append(self.submit(request, parse))
+            if len(pending) > buffer_size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def sample_async(
+            self,
+            to_sample,
+            conditioning_row=None,
+            sample_count=None):
+        return self.submit(*self._sample_request(
+            to_sample,
+            conditioning_row,
+            sample_count))
+
+    def score_async(self, row):
+        return self.submit(*self._score_request(row))
+
+    def score_many_async(self, rows):
+        return self.submit(*self._batch_score_request(rows))
+
+    def entropy_async(
+            self,
+            row_sets,
+            col_sets,
+            conditioning_row=None,
+            sample_count=None,
+            tolerance=None,
+            max_sample_count=None):
+        return self.submit(*self._entropy_request(
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tolerance,
+            max_sample_count))
+
+    def score_derivative_async(
+            self,
+            update_row,
+            score_rows=None,
+            row_limit=None,
+            prune=False):
+        return self.submit(*self._score_derivative_request(
+            update_row,
+            score_rows,
+            row_limit,
+            prune))
 
 
 class ProtobufServer(object):
@@ -354,3 +825,13 @@ class ProtobufServer(object):
 def get_server(root, config=None, debug=False, profile=None):
     protobuf_server = ProtobufServer(root, config, debug, profile)
     return QueryServer(protobuf_server)
+
+
+def get_async_server(
+        root,
+        config=None,
+        debug=False,
+        profile=None,
+        max_pending=None):
+    protobuf_server = ProtobufServer(root, config, debug, profile)
+    return AsyncQueryServer(protobuf_server, max_pending)
@@ -206,6 +206,7 @@ def shuffle(
         'samples.0.model',
         'samples.0.groups',
         'samples.0.assign',
+        'samples.0.assign_columnar',
         'samples.0.infer_log'])
 def infer(
         config_in,
@@ -218,6 +219,7 @@ def infer(
         model_out=None,
         groups_out=None,
         assign_out=None,
+        assign_columnar_out=None,
         checkpoint_out=None,
         log_out=None,
         debug=False,
@@ -232,6 +234,7 @@ def infer(
     model_out = optional_file(model_out)
     groups_out = optional_file(groups_out)
     assign_out = optional_file(assign_out)
+    assign_columnar_out = optional_file(assign_columnar_out)
     checkpoint_out = optional_file(checkpoint_out)
     log_out = optional_file(log_out)
 
@@ -240,7 +243,8 @@ def infer(
             'infer',
             config_in, rows_in, tares_in,
             model_in, groups_in, assign_in, checkpoint_in,
-            model_out, groups_out, assign_out, checkpoint_out, log_out,
+            model_out, groups_out, assign_out, assign_columnar_out,
+            checkpoint_out, log_out,
         ],
         debug=debug,
         profile=profile,
@@ -248,7 +252,10 @@ def infer(
             config_in, rows_in, tares_in,
             model_in, groups_in, assign_in, checkpoint_in,
         ],
-        outfiles=[model_out, groups_out, assign_out, checkpoint_out, log_out])
+        outfiles=[
+            model_out, groups_out, assign_out, assign_columnar_out,
+            checkpoint_out, log_out,
+        ])
 
 
 @parsable.command
@@ -258,7 +265,8 @@ def infer(
         'ingest.rows',
         'samples.0.model',
         'samples.0.groups',
-        'samples.0.assign'],
+        'samples.0.assign',
+        'samples.0.assign_columnar'],
     role='test')
 def generate(
         config_in,
@@ -267,6 +275,7 @@ def generate(
         model_out=None,
         groups_out=None,
         assign_out=None,
+        assign_columnar_out=None,
         debug=False,
         profile=None):
     '''
@@ -275,17 +284,20 @@ def generate(
     model_out = optional_file(model_out)
     groups_out = optional_file(groups_out)
     assign_out = optional_file(assign_out)
+    assign_columnar_out = optional_file(assign_columnar_out)
 
     check_call_files(
         command=[
             'generate',
             config_in, model_in,
-            rows_out, model_out, groups_out, assign_out,
+            rows_out, model_out, groups_out, assign_out, assign_columnar_out,
         ],
         debug=debug,
         profile=profile,
         infiles=[config_in, model_in],
-        outfiles=[rows_out, model_out, groups_out, assign_out])
+        outfiles=[
+            rows_out, model_out, groups_out, assign_out, assign_columnar_out,
+        ])
 
 
 @parsable.command
@@ -297,21 +309,24 @@ def mix(config_in,
         model_out,
         groups_out,
         assign_out,
+        assign_columnar_out=None,
         debug=False,
         profile=None):
     '''
     Generate additional samples of a dataset.
     '''
+    assign_columnar_out = optional_file(assign_columnar_out)
+
     check_call_files(
         command=[
             'mix',
             config_in, rows_in, model_in, groups_in, assign_in,
-            model_out, groups_out, assign_out,
+            model_out, groups_out, assign_out, assign_columnar_out,
         ],
         debug=debug,
         profile=profile,
         infiles=[config_in, rows_in, model_in, groups_in, assign_in],
-        outfiles=[model_out, groups_out, assign_out])
+        outfiles=[model_out, groups_out, assign_out, assign_columnar_out])
 
 
 @parsable.command
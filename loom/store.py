@@ -43,7 +43,9 @@ BASENAMES = {
         'schema': 'schema.json.gz',
         'rows_csv': 'rows_csv',
         'rowids': 'rowids.csv.gz',
+        'rowid_index': 'rowid_index',
         'encoding': 'encoding.json.gz',
+        'encoding_index': 'encoding_index',
         'rows': 'rows.pbs.gz',
         'schema_row': 'schema.pb.gz',
         'tares': 'tares.pbs.gz',
@@ -56,6 +58,7 @@ BASENAMES = {
         'model': 'model.pb.gz',
         'groups': 'groups',
         'assign': 'assign.pbs.gz',
+        'assign_columnar': 'assign.columnar',
         'infer_log': 'infer_log.pbs',
     },
     'consensus': {
@@ -67,6 +70,10 @@ BASENAMES = {
     'query': {
         'config': 'config.pb.gz',
         'query_log': 'query_log.pbs',
+        'baseline_scores': 'baseline_scores.pbs.gz',
+        'relate_matrix': 'relate_matrix.npy',
+        'relate_matrix_meta': 'relate_matrix.json',
+        'groupings': 'groupings',
     },
 }
 
@@ -102,6 +109,28 @@ def get_sample_path(root, seed):
     return os.path.join(root, 'samples', 'sample.{:d}'.format(seed))
 
 
+def get_fingerprint(paths):
+    '''
+    Summarize the files that determine query results, so that caches under
+    paths['query'] can be invalidated when the dataset or samples change.
+    This must match loom::store::get_fingerprint(-) in src/store.hpp
+    '''
+    lines = []
+    filenames = [paths['ingest']['tares'], paths['ingest']['diffs']]
+    for sample in paths['samples']:
+        filenames += [sample['model'], sample['assign']]
+    for filename in filenames:
+        if os.path.exists(filename):
+            info = os.stat(filename)
+            lines.append('{} {} {}\n'.format(
+                filename,
+                info.st_size,
+                int(info.st_mtime)))
+        else:
+            lines.append('{} missing\n'.format(filename))
+    return ''.join(lines)
+
+
 def join_paths(*args):
     args, paths = args[:-1], args[-1]
     return {
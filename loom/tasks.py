@@ -103,6 +103,7 @@ def ingest(
         schema=None,
         rows_csv=None,
         id_field=None,
+        max_dpd_symbols=None,
         debug=False):
     '''
     Ingest dataset with optional json config.
@@ -111,6 +112,9 @@ def ingest(
         schema          Json schema file, e.g., {"feature1": "nich"}
         rows_csv        File or directory of csv files or csv.gz files
         id_field        Column name of id field in input csv
+        max_dpd_symbols If set, keep only this many of the most frequent
+                        values of each dpd feature, counted approximately
+                        in bounded memory; rarer values are unobserved
         debug           Whether to run debug versions of C++ code
     Environment variables:
         LOOM_THREADS    Number of concurrent ingest tasks
@@ -134,23 +138,35 @@ def ingest(
         schema_in=schema,
         schema_row_out=paths['ingest']['schema_row'])
 
-    LOG('making encoding')
-    loom.format.make_encoding(
-        schema_in=schema,
-        rows_in=rows_csv,
-        encoding_out=paths['ingest']['encoding'])
-
-    LOG('importing rows')
-    loom.format.import_rows(
-        encoding_in=paths['ingest']['encoding'],
-        rows_csv_in=rows_csv,
-        rows_out=paths['ingest']['rows'])
-
-    LOG('importing rowids')
-    loom.format.import_rowids(
-        rows_csv_in=rows_csv,
-        rowids_out=paths['ingest']['rowids'],
-        id_field=id_field)
+    # decompress once, rather than once per pass over the rows
+    ingest_dir = os.path.dirname(paths['ingest']['version'])
+    with loom.format.decompress_csv(rows_csv, ingest_dir) as rows_csv_raw:
+
+        LOG('making encoding')
+        loom.format.make_encoding(
+            schema_in=schema,
+            rows_in=rows_csv_raw,
+            encoding_out=paths['ingest']['encoding'],
+            max_dpd_symbols=max_dpd_symbols)
+
+        LOG('making encoding index')
+        loom.format.make_encoding_index(
+            encoding_in=paths['ingest']['encoding'],
+            encoding_index_out=paths['ingest']['encoding_index'])
+
+        LOG('importing rows')
+        loom.format.import_rows(
+            encoding_in=paths['ingest']['encoding_index'],
+            rows_csv_in=rows_csv_raw,
+            rows_out=paths['ingest']['rows'])
+
+        LOG('importing rowids')
+        loom.format.import_rowids(
+            rows_csv_in=rows_csv_raw,
+            rowids_out=paths['ingest']['rowids'],
+            id_field=id_field,
+            rowid_index_out=paths['ingest']['rowid_index'],
+            name=os.path.basename(rows_csv))
 
     LOG('making tare rows')
     loom.runner.tare(
@@ -170,6 +186,71 @@ def ingest(
     loom.config.config_dump({}, paths['query']['config'])
 
 
+@parsable.command
+def fused_ingest(
+        name,
+        schema_csv='schema.csv',
+        rows_csv='rows.csv.gz',
+        debug=False):
+    '''
+    Transform and ingest a fluent dataset, like transform followed by ingest,
+    but reading rows_csv only twice and not writing transformed csv files.
+    Arguments:
+        name            A unique identifier for ingest + inference
+        schema_csv      Schema file with columns [feature_name, datatype];
+                        see transform
+        rows_csv        File or directory of csv files or csv.gz files
+        debug           Whether to run debug versions of C++ code
+    Environment variables:
+        LOOM_THREADS    Number of concurrent ingest tasks
+        LOOM_VERBOSITY  Verbosity level
+    '''
+    if not os.path.exists(schema_csv):
+        raise LoomError('Missing schema_csv file: {}'.format(schema_csv))
+    if not os.path.exists(rows_csv):
+        raise LoomError('Missing rows_csv file: {}'.format(rows_csv))
+
+    paths = loom.store.get_paths(name)
+    with open_compressed(paths['ingest']['version'], 'w') as f:
+        f.write(loom.__version__)
+
+    LOG('transforming and importing rows')
+    loom.transforms.transform_import(
+        schema_in=schema_csv,
+        rows_in=rows_csv,
+        schema_out=paths['ingest']['schema'],
+        transforms_out=paths['ingest']['transforms'],
+        encoding_out=paths['ingest']['encoding'],
+        rows_out=paths['ingest']['rows'],
+        rowids_out=paths['ingest']['rowids'],
+        tares_out=paths['ingest']['tares'])
+
+    LOG('making schema row')
+    loom.format.make_schema_row(
+        schema_in=paths['ingest']['schema'],
+        schema_row_out=paths['ingest']['schema_row'])
+
+    LOG('making encoding index')
+    loom.format.make_encoding_index(
+        encoding_in=paths['ingest']['encoding'],
+        encoding_index_out=paths['ingest']['encoding_index'])
+
+    LOG('making rowid index')
+    loom.format.make_rowid_index(
+        rowids_in=paths['ingest']['rowids'],
+        rowid_index_out=paths['ingest']['rowid_index'])
+
+    tare_count = sum(1 for _ in protobuf_stream_load(paths['ingest']['tares']))
+    LOG('sparsifying rows WRT {} tare rows'.format(tare_count))
+    loom.runner.sparsify(
+        schema_row_in=paths['ingest']['schema_row'],
+        tares_in=paths['ingest']['tares'],
+        rows_in=paths['ingest']['rows'],
+        rows_out=paths['ingest']['diffs'],
+        debug=debug)
+    loom.config.config_dump({}, paths['query']['config'])
+
+
 @parsable.command
 def infer(
         name,
@@ -249,6 +330,7 @@ def infer_one(name, seed=0, config=None, debug=False):
         model_out=sample['model'],
         groups_out=sample['groups'],
         assign_out=sample['assign'],
+        assign_columnar_out=sample['assign_columnar'],
         log_out=sample['infer_log'],
         debug=debug)
 
@@ -285,7 +367,9 @@ def make_consensus(name, config=None, debug=False):
 @loom.documented.transform(
     inputs=[
         'ingest.encoding',
+        'ingest.encoding_index',
         'ingest.rowids',
+        'ingest.rowid_index',
         'query.config',
         'samples.0.model',
         'samples.0.groups',
@@ -304,7 +388,6 @@ def query(name, config=None, debug=False, profile=None):
     LOG('starting query server')
     server = loom.preql.get_server(
         paths['root'],
-        paths['ingest']['encoding'],
         config=config,
         debug=debug,
         profile=profile)
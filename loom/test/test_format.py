@@ -27,10 +27,23 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import shutil
+import mock
+import cPickle as pickle
+from itertools import izip
+from itertools import izip_longest
+from StringIO import StringIO
+import numpy
+import pandas
 from nose.tools import assert_equal
+from nose.tools import assert_false
+from nose.tools import assert_true
+from distributions.dbg.models import dpd
 from distributions.fileutil import tempdir
+from distributions.io.stream import open_compressed
 from distributions.io.stream import protobuf_stream_load
 from distributions.tests.util import assert_close
+import loom.cFormat
 import loom.format
 import loom.util
 from loom.test.util import for_each_dataset
@@ -91,6 +104,215 @@ def test_load_decoder():
         assert_equal(decode(value), key)
 
 
+def test_load_row_encoder():
+    encoders = [
+        {'name': 'flag', 'model': 'bb'},
+        loom.format.EXAMPLE_CATEGORICAL_ENCODER,
+        {'name': 'count', 'model': 'gp'},
+        {'name': 'real', 'model': 'nich'},
+    ]
+    rows_csv = (
+        'ignored,real,count,day-of-week,flag\r\n'
+        '"a, ""quoted""\nvalue", 1.5 ,3,Monday,true\r\n'
+        ',,,"Friday",0\n'
+        'x,-2e3,0,,'
+    )
+    expected = [
+        {
+            'observed': [True, True, True, True],
+            'booleans': [True],
+            'counts': [0, 3],
+            'reals': [1.5],
+        },
+        {
+            'observed': [True, True, False, False],
+            'booleans': [False],
+            'counts': [4],
+            'reals': [],
+        },
+        {
+            'observed': [False, False, True, True],
+            'booleans': [],
+            'counts': [0],
+            'reals': [-2e3],
+        },
+    ]
+    encoder = loom.format.load_row_encoder(encoders)
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rows_pbs = os.path.abspath('rows.pbs.gz')
+        row_count = encoder.dump_csv(StringIO(rows_csv), rows_pbs, 10, 2)
+        assert_equal(row_count, len(expected))
+        actual = [
+            row.dump()
+            for row in loom.cFormat.row_stream_load(rows_pbs)
+        ]
+    assert_equal([row['id'] for row in actual], [10, 12, 14])
+    assert_equal([row['data'] for row in actual], expected)
+
+
+def test_load_column_encoder():
+    encoder = loom.format.EXAMPLE_CATEGORICAL_ENCODER
+    encode = loom.format.load_column_encoder(encoder)
+    keys = encoder['symbols'].keys()
+    column = pandas.Series(keys + [None], dtype=object)
+    expected = [encoder['symbols'][key] for key in keys] + [None]
+    assert_equal(encode(column), expected)
+
+
+def test_load_column_decoder():
+    encoder = loom.format.EXAMPLE_CATEGORICAL_ENCODER
+    decode = loom.format.load_column_decoder(encoder)
+    keys = encoder['symbols'].keys()
+    values = [encoder['symbols'][key] for key in keys] + [None]
+    column = decode(values)
+    assert_equal(column[:-1].tolist(), keys)
+    assert_true(pandas.isnull(column.iloc[-1]))
+
+
+def test_heavy_hitter_encoder_builder():
+    heavy = ['a'] * 40 + ['b'] * 30 + ['c'] * 20
+    rare = ['x{}'.format(i) for i in xrange(30)]
+    values = [value for pair in izip_longest(heavy, rare) for value in pair]
+    values = [value for value in values if value is not None]
+    Builder = loom.format.HeavyHitterEncoderBuilder
+    builder = Builder('word', 'dpd', 3)
+    for value in values:
+        builder.add_value(value)
+    assert_true(len(builder.counts) <= 6)
+    encoder = builder.build()
+    other = loom.format.OTHER_DECODE
+    expected = {'a': 0, 'b': 1, 'c': 2, other: dpd.OTHER}
+    assert_equal(encoder['symbols'], expected)
+    assert_true(encoder['truncated'])
+
+    half = len(values) / 2
+    parts = [Builder('word', 'dpd', 3), Builder('word', 'dpd', 3)]
+    for part, part_values in izip(parts, [values[:half], values[half:]]):
+        for value in part_values:
+            part.add_value(value)
+    merged = pickle.loads(pickle.dumps(parts[0]))
+    merged += pickle.loads(pickle.dumps(parts[1]))
+    assert_equal(merged.build(), encoder)
+
+    encode = loom.format.load_encoder(encoder)
+    assert_equal(encode('b'), 1)
+    assert_equal(encode('x0'), dpd.OTHER)
+    encode = loom.format.load_column_encoder(encoder)
+    column = pandas.Series(['b', 'x0', None], dtype=object)
+    assert_equal(encode(column), [1, dpd.OTHER, None])
+
+
+def test_load_row_encoder_truncated():
+    encoders = [{
+        'name': 'word',
+        'model': 'dpd',
+        'symbols': {'a': 0, loom.format.OTHER_DECODE: dpd.OTHER},
+        'truncated': True,
+    }]
+    encoder = loom.format.load_row_encoder(encoders)
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rows_pbs = os.path.abspath('rows.pbs.gz')
+        encoder.dump_csv(StringIO('word\na\nunknown\n'), rows_pbs)
+        actual = [
+            row.dump()['data']
+            for row in loom.cFormat.row_stream_load(rows_pbs)
+        ]
+    assert_equal([row['observed'] for row in actual], [[True], [False]])
+    assert_equal([row['counts'] for row in actual], [[0], []])
+
+
+@for_each_dataset
+def test_encoding_index(encoding, **unused):
+    encoders = loom.format.load_encoders(encoding)
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        encoding_index = os.path.abspath('encoding_index')
+        loom.format.make_encoding_index(
+            encoding_in=encoding,
+            encoding_index_out=encoding_index)
+        assert_found(encoding_index)
+        assert_true(
+            loom.format.is_encoding_index_current(encoding, encoding_index))
+        indexed_encoders = loom.format.load_encoders(encoding_index)
+        assert_equal(len(indexed_encoders), len(encoders))
+        for encoder, indexed in izip(encoders, indexed_encoders):
+            assert_equal(indexed['name'], encoder['name'])
+            assert_equal(indexed['model'], encoder['model'])
+            if 'symbols' not in encoder:
+                continue
+            symbols = encoder['symbols']
+            assert_equal(dict(indexed['symbols'].iteritems()), symbols)
+            encode = loom.format.load_encoder(indexed)
+            decode = loom.format.load_decoder(indexed)
+            for key, value in symbols.iteritems():
+                assert_equal(encode(key), value)
+                assert_equal(decode(value), key)
+            keys = symbols.keys()
+            column = pandas.Series(keys + [None], dtype=object)
+            encode = loom.format.load_column_encoder(indexed)
+            values = encode(column)
+            assert_equal(values, [symbols[key] for key in keys] + [None])
+            decode = loom.format.load_column_decoder(indexed)
+            assert_equal(decode(values)[:-1].tolist(), keys)
+
+
+@for_each_dataset
+def test_encoding_index_stale(encoding, **unused):
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        encoding_copy = os.path.abspath('encoding.json.gz')
+        shutil.copyfile(encoding, encoding_copy)
+        encoding_index = os.path.abspath('encoding_index')
+        current = loom.format.is_encoding_index_current
+        assert_true(not current(encoding_copy, encoding_index))
+        loom.format.make_encoding_index(
+            encoding_in=encoding_copy,
+            encoding_index_out=encoding_index)
+        assert_true(current(encoding_copy, encoding_index))
+        mtime = os.path.getmtime(encoding_copy) + 10
+        os.utime(encoding_copy, (mtime, mtime))
+        assert_true(not current(encoding_copy, encoding_index))
+
+
+@for_each_dataset
+def test_rowid_index(rowids, rowid_index, **unused):
+    with loom.util.csv_reader(rowids) as reader:
+        pairs = [(int(internal_id), external_id)
+                 for internal_id, external_id in reader]
+    for index in [
+            loom.format.RowidIndex(rowid_index),
+            loom.format.RowidDict(rowids)]:
+        assert_equal(len(index), len(pairs))
+        for internal_id, external_id in pairs:
+            assert_equal(index[internal_id], external_id)
+            assert_equal(index.find(external_id), internal_id)
+
+
+@for_each_dataset
+def test_make_rowid_index_blocks(rowids, rowid_index, **unused):
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rowid_index_out = os.path.abspath('rowid_index')
+        loom.format.make_rowid_index(rowids, rowid_index_out, block_size=7)
+        for basename in loom.format.ROWID_INDEX_BASENAMES.itervalues():
+            expected = numpy.load(os.path.join(rowid_index, basename))
+            actual = numpy.load(os.path.join(rowid_index_out, basename))
+            assert_equal(actual.dtype, expected.dtype)
+            assert_equal(actual.tolist(), expected.tolist())
+
+
+def test_make_rowid_index_order():
+    pairs = [(5, 'b'), (2, 'ab'), (9, ''), (0, 'a'), (7, 'a b'), (3, 'ba')]
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rowids = os.path.abspath('rowids.csv')
+        rowid_index = os.path.abspath('rowid_index')
+        with loom.util.csv_writer(rowids) as writer:
+            writer.writerows(pairs)
+        loom.format.make_rowid_index(rowids, rowid_index, block_size=4)
+        index = loom.format.RowidIndex(rowid_index)
+        assert_equal(len(index), len(pairs))
+        for internal_id, external_id in pairs:
+            assert_equal(index[internal_id], external_id)
+            assert_equal(index.find(external_id), internal_id)
+
+
 @for_each_dataset
 def test_import_rows(encoding, rows, rows_csv, **unused):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
@@ -105,6 +327,86 @@ def test_import_rows(encoding, rows, rows_csv, **unused):
         assert_equal(actual_count, expected_count)
 
 
+@for_each_dataset
+def test_import_rows_chunks(encoding, rows, **unused):
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rows_csv = os.path.abspath('rows_csv')
+        loom.format.export_rows(
+            encoding_in=encoding,
+            rows_in=rows,
+            rows_csv_out=rows_csv)
+        rows_csv_gz = os.path.join(rows_csv, 'rows.0.csv.gz')
+        rows_csv_raw = os.path.abspath('rows.csv')
+        with open_compressed(rows_csv_gz, 'rb') as f_in:
+            with open(rows_csv_raw, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        expected_pbs = os.path.abspath('expected.pbs.gz')
+        loom.format.import_rows(
+            encoding_in=encoding,
+            rows_csv_in=rows_csv_raw,
+            rows_out=expected_pbs)
+        expected = load_rows(expected_pbs)
+        for rows_csv_in in [rows_csv_raw, rows_csv_gz]:
+            expected_rowids_csv = os.path.abspath('expected_rowids.csv.gz')
+            loom.format.import_rowids(
+                rows_csv_in=rows_csv_in,
+                rowids_out=expected_rowids_csv)
+            with loom.util.csv_reader(expected_rowids_csv) as reader:
+                expected_rowids = [row[1] for row in reader]
+            rows_pbs = os.path.abspath('rows.pbs.gz')
+            rowids_csv = os.path.abspath('rowids.csv.gz')
+            with mock.patch('loom.util.CSV_CHUNK_SIZE', new=1000):
+                loom.format.import_rows(
+                    encoding_in=encoding,
+                    rows_csv_in=rows_csv_in,
+                    rows_out=rows_pbs)
+                loom.format.import_rowids(
+                    rows_csv_in=rows_csv_in,
+                    rowids_out=rowids_csv)
+            actual = load_rows(rows_pbs)
+            assert_equal(len(actual), len(expected))
+            ids = [row.id for row in actual]
+            assert_equal(len(set(ids)), len(ids))
+            with loom.util.csv_reader(rowids_csv) as reader:
+                rowids = list(reader)
+            assert_equal([int(row[0]) for row in rowids], ids)
+            assert_equal([row[1] for row in rowids], expected_rowids)
+            expected_data = [row.diff for row in expected]
+            actual_data = [row.diff for row in actual]
+            assert_close(actual_data, expected_data)
+
+
+@for_each_dataset
+def test_decompress_csv(encoding, rows, **unused):
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rows_csv = os.path.abspath('rows_csv')
+        loom.format.export_rows(
+            encoding_in=encoding,
+            rows_in=rows,
+            rows_csv_out=rows_csv)
+        rows_csv_gz = os.path.join(rows_csv, 'rows.0.csv.gz')
+        expected_rowids_csv = os.path.abspath('expected_rowids.csv.gz')
+        loom.format.import_rowids(
+            rows_csv_in=rows_csv_gz,
+            rowids_out=expected_rowids_csv)
+        with loom.util.csv_reader(expected_rowids_csv) as reader:
+            expected = list(reader)
+        dirname = os.path.abspath('raw')
+        os.mkdir(dirname)
+        with loom.format.decompress_csv(rows_csv_gz, dirname) as rows_csv_raw:
+            assert_false(loom.util.is_compressed(rows_csv_raw))
+            for chunk_size in [1000, loom.util.CSV_CHUNK_SIZE]:
+                rowids_csv = os.path.abspath('rowids.csv.gz')
+                with mock.patch('loom.util.CSV_CHUNK_SIZE', new=chunk_size):
+                    loom.format.import_rowids(
+                        rows_csv_in=rows_csv_raw,
+                        rowids_out=rowids_csv,
+                        name=os.path.basename(rows_csv_gz))
+                with loom.util.csv_reader(rowids_csv) as reader:
+                    assert_equal(list(reader), expected)
+        assert_equal(os.listdir(dirname), [])
+
+
 @for_each_dataset
 def test_export_rows(encoding, rows, **unused):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
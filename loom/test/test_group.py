@@ -28,16 +28,77 @@
 
 import os
 import copy
+import shutil
 from itertools import izip
 import pymetis
+from distributions.fileutil import tempdir
 from distributions.io.stream import json_load
 import distributions.lp.clustering
 import loom.group
+from loom.cFormat import assignment_stream_load
+from loom.cFormat import assignment_stream_load_array
+from loom.test.util import for_each_dataset
 from loom.group import METIS_ARGS_TEMPFILE
 from loom.group import find_consensus_grouping
 from nose.tools import assert_almost_equal
 from nose.tools import assert_equal
 from nose.tools import assert_set_equal
+from nose.tools import assert_true
+
+
+@for_each_dataset
+def test_assignment_stream_load_array(assign, **unused):
+    rowids, groupids = assignment_stream_load_array(assign)
+    assignments = [a.dump() for a in assignment_stream_load(assign)]
+    assert_equal(rowids.tolist(), [a['rowid'] for a in assignments])
+    assert_equal(groupids.tolist(), [a['groupids'] for a in assignments])
+
+
+@for_each_dataset
+def test_columnar_assignments(assign, assign_columnar, **unused):
+    rowids, groupids = assignment_stream_load_array(assign)
+    assignments = loom.group.ColumnarAssignments(assign_columnar)
+    assert_equal(assignments.rowids.tolist(), rowids.tolist())
+    for kindid in xrange(assignments.kind_count):
+        expected = groupids[:, kindid]
+        assert_equal(assignments.groupids(kindid).tolist(), expected.tolist())
+        for rowid, groupid in izip(rowids[:10], expected[:10]):
+            group = set(assignments.neighbors(kindid, rowid).tolist())
+            assert_equal(group, set(rowids[expected == groupid].tolist()))
+
+
+@for_each_dataset
+def test_is_columnar_current(assign, assign_columnar, **unused):
+    with tempdir():
+        sample = {
+            'assign': os.path.abspath('assign.pbs.gz'),
+            'assign_columnar': os.path.abspath('assign.columnar'),
+        }
+        shutil.copyfile(assign, sample['assign'])
+        assert_true(not loom.group.is_columnar_current(sample))
+        shutil.copyfile(assign_columnar, sample['assign_columnar'])
+        assert_true(loom.group.is_columnar_current(sample))
+        mtime = os.path.getmtime(sample['assign']) + 10
+        os.utime(sample['assign'], (mtime, mtime))
+        assert_true(not loom.group.is_columnar_current(sample))
+
+
+def test_grouping_cache():
+    grouping = [
+        loom.group.Row(row_id=1, group_id=0, confidence=0.5),
+        loom.group.Row(row_id=3, group_id=1, confidence=1.0),
+    ]
+    with tempdir():
+        filename = loom.group.get_grouping_path(os.path.abspath('g'), [0, 2])
+        assert_equal(loom.group.load_grouping(filename, 'a'), None)
+        loom.group.dump_grouping(grouping, filename, 'a')
+        assert_equal(os.listdir(os.path.dirname(filename)), [
+            os.path.basename(filename)])
+        assert_equal(loom.group.load_grouping(filename, 'a'), grouping)
+        assert_equal(loom.group.load_grouping(filename, 'b'), None)
+        with open(filename, 'wb') as f:
+            f.write('truncated')
+        assert_equal(loom.group.load_grouping(filename, 'a'), None)
 
 
 def test_metis():
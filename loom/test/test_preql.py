@@ -135,6 +135,65 @@ def test_predict_pandas(root, rows_csv, schema, **unused):
         assert_equal(result_df.shape[1], 1 + feature_count)
 
 
+@for_each_dataset
+def test_predict_frame(root, rows_csv, schema, **unused):
+    feature_count = len(json_load(schema))
+    with loom.preql.get_server(root, debug=True) as preql:
+        rows_filename = os.path.join(rows_csv, os.listdir(rows_csv)[0])
+        with open_compressed(rows_filename) as f:
+            rows_df = pandas.read_csv(
+                f,
+                converters=preql.converters,
+                index_col='_id')
+        row_count = rows_df.shape[0]
+        result_df = preql.predict_frame(rows_df, COUNT)
+        assert_equal(result_df.shape, (row_count * COUNT, feature_count))
+        assert_equal(list(result_df.columns), list(rows_df.columns))
+        assert_equal(set(result_df.index), set(rows_df.index))
+
+
+@for_each_dataset
+def test_encode_frame(root, rows_csv, **unused):
+    rows = load_rows_csv(rows_csv)
+    header = rows.pop(0)
+    rows = rows[0:10]
+    with loom.preql.get_server(root, debug=True) as preql:
+        expected = [preql.encode_row(row, header) for row in rows]
+        actual = preql.encode_frame(pandas.DataFrame(rows, columns=header))
+        assert_equal(actual, expected)
+        decoded = preql.decode_frame(actual)
+        assert_equal(list(decoded.columns), preql.feature_names)
+        for row, (_, decoded_row) in izip(actual, decoded.iterrows()):
+            expected_row = preql.decode_row(row)
+            for expected_value, value in izip(expected_row, decoded_row):
+                if expected_value is None:
+                    assert_true(pandas.isnull(value))
+                else:
+                    assert_equal(value, expected_value)
+
+
+@for_each_dataset
+def test_encode_frame_numeric(root, encoding, **unused):
+    encoders = json_load(encoding)
+    reals = [e['name'] for e in encoders if e['model'] == 'nich']
+    counts = [e['name'] for e in encoders if e['model'] == 'gp']
+    if not (reals and counts):
+        raise SkipTest('no real and count features')
+    real_values = [0.12345678901234567, -1.0000000000000002e-7, numpy.nan]
+    count_values = [3, numpy.nan, 0]
+    frame = pandas.DataFrame({
+        reals[0]: real_values,
+        counts[0]: count_values,
+    })
+    assert_equal(frame[counts[0]].dtype, numpy.float64)
+    with loom.preql.get_server(root, debug=True) as preql:
+        rows = preql.encode_frame(frame)
+        real_pos = preql.feature_names.index(reals[0])
+        count_pos = preql.feature_names.index(counts[0])
+        assert_equal([row[real_pos] for row in rows], real_values[:2] + [None])
+        assert_equal([row[count_pos] for row in rows], [3, None, 0])
+
+
 @for_each_dataset
 def test_relate(root, **unused):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
@@ -156,6 +215,29 @@ def test_relate(root, **unused):
                 assert_close(zmatrix, zmatrix.T)
 
 
+@for_each_dataset
+def test_relate_structural_zeros(root, **unused):
+    with loom.preql.get_server(root, debug=True) as preql:
+        result_string = preql.relate(preql.feature_names, sample_count=10)
+        result_df = pandas.read_csv(StringIO(result_string), index_col=0)
+        coassigned = preql._query_server.kind_coassignment
+        for i, j in zip(*numpy.where(~coassigned)):
+            assert_equal(result_df.iloc[i, j], 0.0)
+
+
+@for_each_dataset
+def test_relate_matrix(root, **unused):
+    with loom.preql.get_server(root, debug=True) as preql:
+        feature_count = len(preql.feature_names)
+        matrix = preql.relate_matrix(sample_count=10, tile_size=2)
+        assert_equal(matrix.shape, (feature_count, feature_count))
+        assert_equal(matrix.dtype, numpy.float32)
+        assert_close(numpy.array(matrix), numpy.array(matrix).T)
+        assert_close(numpy.diag(matrix), numpy.ones(feature_count))
+        cached = preql.relate_matrix(sample_count=10, tile_size=2)
+        assert_close(numpy.array(cached), numpy.array(matrix))
+
+
 @for_each_dataset
 def test_relate_pandas(root, rows_csv, schema, **unused):
     feature_count = len(json_load(schema))
@@ -169,6 +251,19 @@ def test_relate_pandas(root, rows_csv, schema, **unused):
         assert_equal(result_df.shape[1], feature_count)
 
 
+@for_each_dataset
+def test_relate_array(root, **unused):
+    with loom.preql.get_server(root, debug=True) as preql:
+        feature_names = preql.feature_names
+        result_df = preql.relate_array(feature_names, sample_count=10)
+        assert_equal(list(result_df.index), feature_names)
+        assert_equal(list(result_df.columns), feature_names)
+        assert_close(result_df.values, result_df.values.T)
+        result_string = preql.relate(feature_names, sample_count=10)
+        expected_df = pandas.read_csv(StringIO(result_string), index_col=0)
+        assert_equal(expected_df.shape, result_df.shape)
+
+
 @for_each_dataset
 def test_refine_with_conditions(root, rows_csv, **unused):
     with loom.preql.get_server(root, debug=True) as preql:
@@ -314,6 +409,16 @@ def test_group_pandas(root, rows_csv, rows, **unused):
             assert_equal(result_df.shape[1], 2)
 
 
+@for_each_dataset
+def test_group_cache(root, groupings, **unused):
+    with loom.preql.get_server(root, debug=True) as preql:
+        feature = preql.feature_names[0]
+        expected = preql.group(feature)
+        assert_true(os.listdir(groupings))
+        actual = preql.group(feature)
+        assert_equal(actual, expected)
+
+
 @for_each_dataset
 def test_search_runs(root, rows_csv, **unused):
     rows = load_rows_csv(rows_csv)
@@ -347,3 +452,54 @@ def test_similar_runs(root, rows_csv, **unused):
         with loom.preql.get_server(root, debug=True) as preql:
             search_csv = 'search.csv'
             preql.similar(rows, result_out=search_csv)
+
+
+@for_each_dataset
+def test_search_array(root, rows_csv, **unused):
+    rows = load_rows_csv(rows_csv)
+    header = rows.pop(0)
+    id_pos = header.index('_id') if '_id' in header else None
+    row = rows[0]
+    if id_pos is not None:
+        row.pop(id_pos)
+    with loom.preql.get_server(root, debug=True) as preql:
+        result_df = preql.search_array(row, row_limit=5)
+        assert_equal(list(result_df.columns), ['row_id', 'score'])
+        assert_true(result_df.shape[0] <= 5)
+
+
+@for_each_dataset
+def test_cluster_sparse(root, rows_csv, **unused):
+    rows = load_rows_csv(rows_csv)
+    header = rows.pop(0)
+    id_pos = header.index('_id') if '_id' in header else None
+    if id_pos is not None:
+        for row in rows:
+            row.pop(id_pos)
+    seed_rows = rows[0:20]
+    rows_to_cluster = rows[20:30]
+    with loom.preql.get_server(root, debug=True) as preql:
+        result = preql.cluster(
+            rows_to_cluster,
+            seed_rows,
+            cluster_count=2,
+            nearest_neighbors=5,
+            sparse=True)
+        assert_equal(len(result), len(rows_to_cluster))
+        for label, row in result:
+            assert_true(label in (0, 1))
+
+
+@for_each_dataset
+def test_similar_array(root, rows_csv, **unused):
+    rows = load_rows_csv(rows_csv)
+    header = rows.pop(0)
+    id_pos = header.index('_id') if '_id' in header else None
+    rows = rows[0:10]
+    if id_pos is not None:
+        for row in rows:
+            row.pop(id_pos)
+    with loom.preql.get_server(root, debug=True) as preql:
+        result = preql.similar_array(rows)
+        assert_equal(result.ndim, 2)
+        assert_equal(result.shape[0], len(rows))
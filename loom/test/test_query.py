@@ -27,19 +27,27 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from itertools import izip
+import os
+import signal
+import numpy
 from nose.tools import assert_equal
 from nose.tools import assert_set_equal
 from nose.tools import assert_not_equal
+from nose.tools import assert_raises
 from nose.tools import assert_true
 from distributions.dbg.random import sample_bernoulli
+from distributions.tests.util import assert_close
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
+from distributions.io.stream import protobuf_stream_dump
+from distributions.io.stream import protobuf_stream_load
 from distributions.fileutil import tempdir
-from loom.schema_pb2 import ProductValue, CrossCat, Query
+from loom.schema_pb2 import ProductValue, CrossCat, Query, LogMessage
 from loom.test.util import for_each_dataset
 import loom.query
 from loom.query import protobuf_to_data_row
 import loom.config
+import loom.runner
 from loom.test.util import load_rows
 
 NONE = ProductValue.Observed.NONE
@@ -182,6 +190,44 @@ def test_batch_score(root, model, rows, **unused):
         assert_equal(len(scores), len(rows))
 
 
+@for_each_dataset
+def test_score_many(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    with loom.query.get_server(root, debug=True) as server:
+        rows = [
+            protobuf_to_data_row(request.score.data)
+            for request in requests
+        ]
+        expected = numpy.array([server.score(row) for row in rows])
+        for batch_size in [1, 3, len(rows)]:
+            scores = server.score_many(rows, batch_size=batch_size)
+            assert_equal(scores.shape, (len(rows),))
+            assert_close(scores, expected)
+        assert_equal(len(server.score_many([])), 0)
+
+
+@for_each_dataset
+def test_batch_sample(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'sample')
+    pairs = [
+        (
+            request.sample.to_sample.dense[:],
+            protobuf_to_data_row(request.sample.data),
+        )
+        for request in requests
+    ]
+    with loom.query.get_server(root, debug=True) as server:
+        for batch_size in [1, 3, len(pairs)]:
+            results = list(server.batch_sample(pairs, 2, batch_size))
+            assert_equal(len(results), len(pairs))
+            for (to_sample, conditioning_row), samples in izip(pairs, results):
+                assert_equal(len(samples), 2)
+                for sample in samples:
+                    for i, value in enumerate(sample):
+                        if not to_sample[i]:
+                            assert_equal(value, conditioning_row[i])
+
+
 @for_each_dataset
 def test_score_derivative_runs(root, rows, **unused):
     with loom.query.get_server(root, debug=True) as server:
@@ -208,6 +254,177 @@ def test_score_derivative_against_existing_runs(root, rows, **unused):
         assert len(results) == 1
 
 
+@for_each_dataset
+def test_score_derivative_cache_rows(root, rows, **unused):
+    rows = load_rows(rows)
+    target_row = protobuf_to_data_row(rows[0].diff)
+    results = []
+    for cache_rows in [False, True]:
+        with tempdir():
+            config = {'seed': 0, 'query': {'cache_rows': cache_rows}}
+            loom.config.config_dump(config, 'config.pb.gz')
+            with loom.query.get_server(root, 'config.pb.gz') as server:
+                results.append(server.score_derivative(target_row))
+    assert_equal(len(results[0]), len(rows))
+    assert_equal(results[0], results[1])
+
+
+@for_each_dataset
+def test_score_derivative_cache_scores(root, rows, baseline_scores, **unused):
+    rows = load_rows(rows)
+    target_row = protobuf_to_data_row(rows[0].diff)
+    results = []
+    with tempdir():
+        for cache_scores in [False, True, True]:
+            config = {'seed': 0, 'query': {'cache_scores': cache_scores}}
+            loom.config.config_dump(config, 'config.pb.gz')
+            with loom.query.get_server(root, 'config.pb.gz') as server:
+                results.append((
+                    server.score_derivative(target_row),
+                    server.score_derivative(target_row, row_limit=1),
+                ))
+    assert_equal(len(results[0][0]), len(rows))
+    assert_equal(len(results[0][1]), 1)
+    for cached in results[1:]:
+        assert_equal(cached, results[0])
+    cached = list(protobuf_stream_load(baseline_scores))
+    assert_true(cached, 'baseline scores were not cached')
+    assert_equal(cached[0].row_count, len(rows))
+
+
+def get_mtime(filename):
+    return os.path.getmtime(filename) if os.path.exists(filename) else None
+
+
+@for_each_dataset
+def test_score_derivative_prune(root, rows, baseline_scores, **unused):
+    rows = load_rows(rows)
+    rowids = set(row.id for row in rows)
+    target_row = protobuf_to_data_row(rows[0].diff)
+    mtime = get_mtime(baseline_scores)
+    with loom.query.get_server(root, debug=True) as server:
+        results = server.score_derivative(target_row, prune=True)
+        assert_true(len(results) <= len(rows))
+        ids = [rowid for rowid, _ in results]
+        assert_true(set(ids) <= rowids)
+        scores = [score for _, score in results]
+        assert_equal(scores, sorted(scores, reverse=True))
+    # without cache_scores, pruning must not touch the cached baseline
+    assert_equal(get_mtime(baseline_scores), mtime)
+
+
+@for_each_dataset
+def test_threads(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'mixed')
+    with tempdir():
+        config = {'query': {'threads': 4}}
+        loom.config.config_dump(config, 'config.pb.gz')
+        with loom.query.get_server(root, 'config.pb.gz') as server:
+            score_rows = [
+                protobuf_to_data_row(request.score.data)
+                for request in requests
+                if request.HasField('score')
+            ]
+            scores = list(server.batch_score(score_rows))
+            assert_equal(len(scores), len(score_rows))
+            target_row = protobuf_to_data_row(load_rows(rows)[0].diff)
+            results = server.score_derivative(target_row, row_limit=1)
+            assert_equal(len(results), 1)
+            for request in requests:
+                if request.HasField('sample'):
+                    to_sample = request.sample.to_sample.dense[:]
+                    data = protobuf_to_data_row(request.sample.data)
+                    samples = server.sample(to_sample, data, sample_count=1)
+                    assert_equal(len(samples), 1)
+
+
+def serve_requests(root, requests, config):
+    '''
+    Serve requests in a single query server process, returning the list of
+    responses and the final QueryStatus from the query log.
+    '''
+    with tempdir():
+        loom.config.config_dump(config, 'config.pb.gz')
+        requests_in = os.path.abspath('requests.pbs')
+        responses_out = os.path.abspath('responses.pbs')
+        log_out = os.path.abspath('query_log.pbs')
+        protobuf_stream_dump(
+            [request.SerializeToString() for request in requests],
+            requests_in)
+        loom.runner.query(
+            root_in=root,
+            requests_in=requests_in,
+            config_in=os.path.abspath('config.pb.gz'),
+            responses_out=responses_out,
+            log_out=log_out)
+        responses = map(
+            Query.Response.FromString,
+            protobuf_stream_load(responses_out))
+        messages = map(LogMessage.FromString, protobuf_stream_load(log_out))
+    statuses = [m.query_status for m in messages if m.HasField('query_status')]
+    assert_equal(len(statuses), 1)
+    return responses, statuses[0]
+
+
+@for_each_dataset
+def test_posterior_cache(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'sample')
+    for request in requests:
+        request.sample.sample_count = 3
+    results = {}
+    for cache_size, repeat in [(0, 2), (len(requests), 1), (len(requests), 2)]:
+        results[cache_size, repeat] = serve_requests(
+            root,
+            [request for request in requests for _ in xrange(repeat)],
+            {'seed': 0, 'query': {'posterior_cache_size': cache_size}})
+    uncached, _ = results[0, 2]
+    cached, status = results[len(requests), 2]
+    assert_equal(cached, uncached)
+    _, single_status = results[len(requests), 1]
+    assert_true(single_status.posterior_cache_misses > 0)
+    assert_equal(status.posterior_cache_misses,
+                 single_status.posterior_cache_misses)
+    # each repeated request must hit the cache
+    hits = status.posterior_cache_hits - single_status.posterior_cache_hits
+    assert_true(hits >= len(requests), hits)
+
+
+@for_each_dataset
+def test_async(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'mixed')
+    with loom.query.get_async_server(root, max_pending=4) as server:
+        futures = []
+        for request in requests:
+            if request.HasField('sample'):
+                to_sample = request.sample.to_sample.dense[:]
+                data = protobuf_to_data_row(request.sample.data)
+                future = server.sample_async(to_sample, data, sample_count=1)
+                futures.append((future, server.sample(to_sample, data, 1)))
+            if request.HasField('score'):
+                data = protobuf_to_data_row(request.score.data)
+                futures.append((server.score_async(data), server.score(data)))
+        for future, expected in futures:
+            result = future.result()
+            assert_equal(type(result), type(expected))
+            if isinstance(result, list):
+                assert_equal(len(result), len(expected))
+
+
+@for_each_dataset
+def test_async_server_death(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    data = protobuf_to_data_row(requests[0].score.data)
+    with loom.query.get_async_server(root, max_pending=4) as server:
+        proc = server.protobuf_server.proc
+        proc.send_signal(signal.SIGSTOP)
+        futures = [server.score_async(data) for _ in xrange(4)]
+        proc.kill()
+        for future in futures:
+            assert_raises(Exception, future.result, 60)
+            assert_true(future.done())
+        assert_raises(Exception, server.score_async, data)
+
+
 @for_each_dataset
 def test_seed(root, model, rows, **unused):
     requests = get_example_requests(model, rows, 'mixed')
@@ -245,3 +462,48 @@ def test_tiled_entropy(root, schema, **unused):
             print 'tile_size = {}'.format(tile_size)
             actual = set(server.entropy(tile_size=tile_size, **kwargs))
             assert_set_equal(expected, actual)
+
+
+@for_each_dataset
+def test_adaptive_entropy(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    with loom.query.get_server(root, debug=True) as server:
+        for tolerance in [1e-6, 1e6]:
+            entropys = server.entropy(
+                row_sets=feature_sets,
+                col_sets=feature_sets,
+                sample_count=10,
+                tolerance=tolerance,
+                max_sample_count=40)
+            for estimate in entropys.itervalues():
+                assert_true(10 <= estimate.sample_count <= 40)
+                if tolerance > 1:
+                    assert_equal(estimate.sample_count, 10)
+
+
+@for_each_dataset
+def test_kind_coassignment(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    with loom.query.get_server(root, debug=True) as server:
+        coassigned = server.kind_coassignment
+        assert_equal(coassigned.shape, (feature_count, feature_count))
+        assert_true(coassigned.diagonal().all())
+        assert_true((coassigned == coassigned.T).all())
+
+
+@for_each_dataset
+def test_batch_entropy(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    conditioning_row = [None] * feature_count
+    with loom.query.get_server(root, debug=True) as server:
+        tasks = [
+            (feature_sets[:1], feature_sets, None),
+            (feature_sets, feature_sets[1:], conditioning_row),
+        ]
+        results = server.batch_entropy(tasks, sample_count=10, tile_size=2)
+        assert_equal(len(results), len(tasks))
+        for (row_sets, col_sets, _), result in izip(tasks, results):
+            expected = server.entropy(row_sets, col_sets, sample_count=10)
+            assert_set_equal(set(result), set(expected))
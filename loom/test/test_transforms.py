@@ -28,8 +28,12 @@
 
 import os
 import numpy.random
+import pandas
 from itertools import izip
+from nose.tools import assert_equal
 from distributions.fileutil import tempdir
+from distributions.io.stream import json_load
+from distributions.io.stream import protobuf_stream_load
 import loom.store
 import loom.transforms
 import loom.tasks
@@ -75,3 +79,93 @@ def test_transforms():
         loom.tasks.transform(name, schema_csv, rows_csv)
         loom.tasks.ingest(name)
         loom.tasks.infer(name, sample_count=1)
+
+
+def normalize_cell(value):
+    '''Compares cells across row and frame transforms, up to type.'''
+    if value is None or pandas.isnull(value):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def assert_frame_matches_rows(frame, rows):
+    assert_equal(len(frame), len(rows))
+    for actual, expected in izip(frame.itertuples(index=False), rows):
+        assert_equal(
+            map(normalize_cell, actual),
+            map(normalize_cell, expected))
+
+
+def get_frame(header, rows):
+    return pandas.DataFrame(
+        {name: [row[i] or None for row in rows]
+         for i, name in enumerate(header)},
+        columns=header)
+
+
+def test_frame_matches_rows():
+    with tempdir() as temp:
+        schema_csv = os.path.join(temp, 'schema.csv')
+        rows_csv = os.path.join(temp, 'rows.csv')
+        schema_json = os.path.join(temp, 'schema.json.gz')
+        transforms_pickle = os.path.join(temp, 'transforms.pickle.gz')
+        generate_example(schema_csv, rows_csv)
+        loom.transforms.make_transforms(
+            schema_in=schema_csv,
+            rows_in=rows_csv,
+            schema_out=schema_json,
+            transforms_out=transforms_pickle)
+        transform = loom.transforms.load_transforms(transforms_pickle)
+        features = sorted(json_load(schema_json).iterkeys())
+        with loom.util.csv_reader(rows_csv) as reader:
+            header = reader.next()
+            rows = list(reader)
+
+    forward_rows = [
+        transform.forward_row(header, features, row)
+        for row in rows
+    ]
+    forward_frame = transform.forward_frame(features, get_frame(header, rows))
+    assert_frame_matches_rows(forward_frame, forward_rows)
+
+    # decoded rows are strings, with None for missing cells
+    decoded_rows = [
+        [None if value is None else loom.transforms.get_csv_value(value)
+         for value in row]
+        for row in forward_rows
+    ]
+    backward_rows = [
+        transform.backward_row(features, header, row)
+        for row in decoded_rows
+    ]
+    decoded_frame = get_frame(features, decoded_rows)
+    backward_frame = transform.backward_frame(header, decoded_frame)
+    assert_frame_matches_rows(backward_frame, backward_rows)
+
+
+def test_fused_ingest():
+    name = 'test_transforms.test_fused_ingest'
+    fused_name = 'test_transforms.test_fused_ingest.fused'
+    with tempdir() as temp:
+        schema_csv = os.path.join(temp, 'schema.csv')
+        rows_csv = os.path.join(temp, 'rows.csv.gz')
+        generate_example(schema_csv, rows_csv)
+        loom.tasks.transform(name, schema_csv, rows_csv)
+        loom.tasks.ingest(name)
+        loom.tasks.fused_ingest(fused_name, schema_csv, rows_csv)
+
+    paths = loom.store.get_paths(name)['ingest']
+    fused_paths = loom.store.get_paths(fused_name)['ingest']
+    assert_equal(
+        json_load(fused_paths['schema']),
+        json_load(paths['schema']))
+    assert_equal(
+        json_load(fused_paths['encoding']),
+        json_load(paths['encoding']))
+    for key in ['rows', 'diffs']:
+        assert_equal(
+            list(protobuf_stream_load(fused_paths[key])),
+            list(protobuf_stream_load(paths[key])))
@@ -28,21 +28,36 @@
 
 import os
 import re
+import copy
+import shutil
 import datetime
 import dateutil.parser
+from itertools import compress
 from itertools import izip
 from collections import Counter
 from contextlib2 import ExitStack
 from distributions.io.stream import json_dump
 from distributions.io.stream import json_load
+from distributions.io.stream import protobuf_stream_dump
+from distributions.fileutil import tempdir
+import numpy
+import pandas
 import loom.util
 from loom.util import cp_ns
 from loom.util import LOG
+from loom.util import LoomError
 from loom.util import parallel_map
 from loom.util import pickle_dump
 from loom.util import pickle_load
+from loom.format import DefaultEncoderBuilder
+from loom.format import ENCODER_BUILDERS
+from loom.format import get_encoder_rank
 from loom.format import load_encoder
 from loom.format import load_decoder
+from loom.format import TRUTHY
+import loom.cFormat
+import loom.schema
+import loom.schema_pb2
 import loom.documented
 import parsable
 parsable = parsable.Parsable()
@@ -79,6 +94,22 @@ def get_row_dict(header, row):
     return {key: value for key, value in izip(header, row) if value}
 
 
+def get_column(frame, name):
+    '''Returns frame[name] as an object column, or an all-null column.'''
+    if name in frame:
+        return frame[name].astype(object)
+    else:
+        return pandas.Series(None, index=frame.index, dtype=object)
+
+
+def get_bool_column(flags):
+    '''Decodes a boolean column to '0', '1' strings.'''
+    return pandas.Series(
+        numpy.where(flags, '1', '0'),
+        index=flags.index,
+        dtype=object)
+
+
 class TransformSequence(object):
     def __init__(self, transforms):
         self.transforms = transforms
@@ -106,6 +137,22 @@ class TransformSequence(object):
             t.backward(row_dict)
         return [row_dict.get(key) for key in header_out]
 
+    def forward_frame(self, header_out, frame):
+        '''
+        Like forward_row, but transforms a pandas.DataFrame column-wise.
+        By convention, missing values are null rather than empty strings.
+        '''
+        frame = frame.copy()
+        for t in self.transforms:
+            t.forward_frame(frame)
+        return frame.reindex(columns=header_out)
+
+    def backward_frame(self, header_out, frame):
+        frame = frame.copy()
+        for t in reversed(self.transforms):
+            t.backward_frame(frame)
+        return frame.reindex(columns=header_out)
+
 
 def load_transforms(filename):
     transforms = pickle_load(filename) if os.path.exists(filename) else []
@@ -135,6 +182,14 @@ class StringTransform(object):
     def backward(self, row_dict):
         pass
 
+    def forward_frame(self, frame):
+        feature_name = self.feature_name
+        if feature_name in frame:
+            frame[feature_name] = get_column(frame, feature_name).str.lower()
+
+    def backward_frame(self, frame):
+        pass
+
 
 class PercentTransform(object):
     def __init__(self, feature_name):
@@ -158,6 +213,20 @@ class PercentTransform(object):
             value = '{}%'.format(float(row_dict[feature_name]) * 1e2)
             row_dict[feature_name] = value
 
+    def forward_frame(self, frame):
+        feature_name = self.feature_name
+        if feature_name in frame:
+            column = get_column(frame, feature_name)
+            value = column.str.replace('%', '').astype(float) * 1e-2
+            frame[feature_name] = value
+
+    def backward_frame(self, frame):
+        feature_name = self.feature_name
+        if feature_name in frame:
+            value = frame[feature_name].astype(float) * 1e2
+            value = value.map('{}%'.format).where(value.notnull())
+            frame[feature_name] = value
+
 
 class PresenceTransform(object):
     def __init__(self, feature_name):
@@ -181,10 +250,26 @@ class PresenceTransform(object):
 
     def backward(self, row_dict):
         if self.present_name in row_dict:
-            if encode_bool(row_dict[self.present_name]):
+            present = encode_bool(row_dict[self.present_name])
+            if present and self.value_name in row_dict:
                 row_dict[self.feature_name] = row_dict[self.value_name]
             else:
-                del row_dict[self.feature_name]  # nonmonotone
+                row_dict.pop(self.feature_name, None)  # nonmonotone
+
+    def forward_frame(self, frame):
+        column = get_column(frame, self.feature_name)
+        present = column.notnull()
+        frame[self.present_name] = get_bool_column(present)
+        frame[self.value_name] = column
+
+    def backward_frame(self, frame):
+        if self.present_name in frame:
+            flag = get_column(frame, self.present_name)
+            present = flag.isin(TRUTHY)
+            absent = flag.notnull() & ~present
+            column = get_column(frame, self.feature_name)
+            column = column.where(~present, get_column(frame, self.value_name))
+            frame[self.feature_name] = column.where(~absent)
 
 
 class SparseRealTransform(object):
@@ -219,6 +304,26 @@ class SparseRealTransform(object):
             else:
                 row_dict[self.feature_name] = self.tare_value
 
+    def forward_frame(self, frame):
+        feature_name = self.feature_name
+        if feature_name in frame:
+            value = get_column(frame, feature_name).astype(float)
+            present = value.notnull()
+            # compare exactly as forward() does, value-by-value
+            nonzero = value.astype(object) == self.tare_value
+            frame[self.nonzero_name] = get_bool_column(nonzero).where(present)
+            frame[self.value_name] = value.where(nonzero)
+
+    def backward_frame(self, frame):
+        if self.nonzero_name in frame:
+            flag = get_column(frame, self.nonzero_name)
+            nonzero = flag.isin(TRUTHY)
+            zero = flag.notnull() & ~nonzero
+            value = get_column(frame, self.value_name)
+            column = get_column(frame, self.feature_name)
+            column = column.where(~(nonzero & value.notnull()), value)
+            frame[self.feature_name] = column.where(~zero, self.tare_value)
+
 
 # ----------------------------------------------------------------------------
 # text transform
@@ -286,17 +391,51 @@ class TextTransform(object):
             if row_dict.get(feature_name, False)
         ])
 
+    def forward_frame(self, frame):
+        if self.feature_name in frame or self.allow_empty:
+            column = get_column(frame, self.feature_name)
+            if self.allow_empty:
+                present = pandas.Series(True, index=frame.index)
+            else:
+                present = column.notnull()
+            word_sets = column.fillna('').map(get_word_set)
+            for feature_name, word in self.features:
+                flags = word_sets.map(lambda word_set: word in word_set)
+                frame[feature_name] = get_bool_column(flags).where(present)
+
+    def backward_frame(self, frame):
+        words = [word for _, word in self.features]
+        flags = numpy.array([
+            get_column(frame, feature_name).notnull().values
+            for feature_name, _ in self.features
+        ], dtype=bool).reshape(len(words), len(frame))
+        frame[self.feature_name] = [
+            ' '.join(compress(words, row_flags))
+            for row_flags in flags.T
+        ]
+
 
 # ----------------------------------------------------------------------------
 # date transform
 
 EPOCH = dateutil.parser.parse('2014-03-31')  # arbitrary (Loom's birthday)
+EPOCH_NS = pandas.Timestamp(EPOCH).value
 
 
 def days_between(start, end):
     return (end - start).total_seconds() / (24 * 60 * 60)
 
 
+def days_between_ns(start_ns, end_ns):
+    '''
+    Like days_between, but for int64 arrays of nanosecond timestamps.
+    This rounds exactly as timedelta.total_seconds does, via microseconds,
+    for spans shorter than 2**53 microseconds (about 285 years).
+    '''
+    microseconds = (end_ns - start_ns) // 1000
+    return microseconds / 1e6 / (24 * 60 * 60)
+
+
 class DateTransform(object):
     def __init__(self, feature_name, relatives):
         self.feature_name = feature_name
@@ -355,6 +494,41 @@ class DateTransform(object):
             date = EPOCH + datetime.timedelta(days_since_epoch)
             row_dict[self.feature_name] = str(date)
 
+    def forward_frame(self, frame):
+        if self.feature_name in frame:
+            column = get_column(frame, self.feature_name).dropna()
+            dates = pandas.DatetimeIndex(
+                column.map(dateutil.parser.parse).tolist())
+            index = column.index
+            days = days_between_ns(EPOCH_NS, dates.asi8)
+
+            abs_names = self.abs_names
+            frame[abs_names['absolute']] = pandas.Series(days, index=index)
+            frame[abs_names['mod.year']] = pandas.Series(dates.month, index)
+            frame[abs_names['mod.month']] = pandas.Series(dates.day, index)
+            frame[abs_names['mod.week']] = pandas.Series(dates.weekday, index)
+            frame[abs_names['mod.day']] = pandas.Series(dates.hour, index)
+
+            for relative, rel_name in self.rel_names.iteritems():
+                if relative in frame:
+                    other = get_column(frame, relative).reindex(index)
+                    other = other.dropna()
+                    other_dates = pandas.DatetimeIndex(
+                        other.map(dateutil.parser.parse).tolist())
+                    ends = dates.asi8[index.isin(other.index)]
+                    rel_days = days_between_ns(other_dates.asi8, ends)
+                    frame[rel_name] = pandas.Series(rel_days, other.index)
+
+    def backward_frame(self, frame):
+        abs_name = self.abs_names['absolute']
+        if abs_name in frame:
+            days = get_column(frame, abs_name).dropna().astype(float)
+            dates = days.map(
+                lambda d: str(EPOCH + datetime.timedelta(d)))
+            column = get_column(frame, self.feature_name)
+            column.loc[dates.index] = dates
+            frame[self.feature_name] = column
+
 
 # ----------------------------------------------------------------------------
 # building transforms
@@ -372,12 +546,15 @@ def load_schema(schema_csv):
     return fluent_schema
 
 
-def build_transforms(rows_in, transforms, builders):
+def get_rows_files(rows_in):
     if os.path.isdir(rows_in):
-        filenames = [os.path.join(rows_in, f) for f in os.listdir(rows_in)]
+        return sorted(os.path.join(rows_in, f) for f in os.listdir(rows_in))
     else:
-        filenames = [rows_in]
-    for filename in filenames:
+        return [rows_in]
+
+
+def build_transforms(rows_in, transforms, builders):
+    for filename in get_rows_files(rows_in):
         with loom.util.csv_reader(filename) as reader:
             header = reader.next()
             for row in reader:
@@ -389,12 +566,11 @@ def build_transforms(rows_in, transforms, builders):
     return [builder.build() for builder in builders]
 
 
-@loom.documented.transform(
-    inputs=['schema_csv', 'rows_csv'],
-    outputs=['ingest.schema', 'ingest.transforms'])
-@parsable.command
-def make_transforms(schema_in, rows_in, schema_out, transforms_out):
-    fluent_schema = load_schema(schema_in)
+def parse_fluent_schema(fluent_schema):
+    '''
+    Returns (basic_schema, pre_transforms, transforms, builders, id_field),
+    where basic_schema excludes the features of transforms and builders.
+    '''
     basic_schema = {}
     pre_transforms = []
     transforms = []
@@ -434,6 +610,17 @@ def make_transforms(schema_in, rows_in, schema_out, transforms_out):
         else:
             basic_type = FLUENT_TO_BASIC[fluent_type]
             basic_schema[feature_name] = basic_type
+    return basic_schema, pre_transforms, transforms, builders, id_field
+
+
+@loom.documented.transform(
+    inputs=['schema_csv', 'rows_csv'],
+    outputs=['ingest.schema', 'ingest.transforms'])
+@parsable.command
+def make_transforms(schema_in, rows_in, schema_out, transforms_out):
+    fluent_schema = load_schema(schema_in)
+    basic_schema, pre_transforms, transforms, builders, id_field = \
+        parse_fluent_schema(fluent_schema)
     if builders:
         transforms += build_transforms(rows_in, pre_transforms, builders)
     for transform in transforms:
@@ -491,6 +678,262 @@ def transform_rows(schema_in, transforms_in, rows_in, rows_out, id_field=None):
         parallel_map(_transform_rows, tasks)
 
 
+# ----------------------------------------------------------------------------
+# fused transforming + importing
+
+TARE_MAX_COUNT = 16  # as in Differ::CountSummary in src/differ.hpp
+
+
+def get_csv_value(value):
+    '''Formats a transformed value as it would read back from a csv file.'''
+    if isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value).strip()
+
+
+def _make_ingest_stats((transforms, builders, schema, rows_in)):
+    builders = copy.deepcopy(builders)
+    encoder_builders = [
+        ENCODER_BUILDERS[model](name, model)
+        for name, model in sorted(schema.iteritems())
+        if model in ENCODER_BUILDERS
+    ]
+    with loom.util.csv_reader(rows_in) as reader:
+        header = reader.next()
+        for row in reader:
+            row_dict = get_row_dict(header, row)
+            for transform in transforms:
+                transform.forward(row_dict)
+            for builder in builders:
+                builder.add_row(row_dict)
+            for encoder_builder in encoder_builders:
+                value = row_dict.get(encoder_builder.name)
+                if value is not None:
+                    value = get_csv_value(value)
+                    if value:
+                        encoder_builder.add_value(value)
+    return builders, encoder_builders
+
+
+def _import_ingest_file(args):
+    (
+        transform,
+        encoders,
+        id_field,
+        rows_in,
+        rows_out,
+        rowids_out,
+        id_offset,
+        id_stride,
+    ) = args
+    message = loom.cFormat.Row()
+    add_field = {
+        'booleans': message.add_booleans,
+        'counts': message.add_counts,
+        'reals': message.add_reals,
+    }
+    schema = []
+    summaries = []
+    for encoder in encoders:
+        field = loom.schema.MODEL_TO_DATATYPE[encoder['model']]
+        if field == 'booleans':
+            summary = [0, 0]
+        elif field == 'counts':
+            summary = [0] * TARE_MAX_COUNT
+        else:
+            summary = None  # do not sparsify reals
+        summaries.append(summary)
+        schema.append((
+            encoder['name'],
+            add_field[field],
+            load_encoder(encoder),
+            summary))
+    row_count = [0]
+
+    with ExitStack() as stack:
+        with_ = stack.enter_context
+        reader = with_(loom.util.csv_reader(rows_in))
+        writer = with_(loom.util.csv_writer(rowids_out))
+        header = reader.next()
+        header_length = len(header)
+        if id_field is None:
+            basename = os.path.basename(rows_in)
+            get_rowid = lambda i, row: '{}:{}'.format(basename, i)
+        else:
+            pos = header.index(id_field)
+            get_rowid = lambda i, row: row[pos]
+
+        def rows():
+            for i, row in enumerate(reader):
+                if len(row) != header_length:
+                    raise LoomError('row {} has wrong length {}:\n{}'.format(
+                        i, len(row), row))
+                message.id = id_offset + id_stride * i
+                writer.writerow((message.id, get_rowid(i, row)))
+                row_dict = get_row_dict(header, row)
+                for t in transform.transforms:
+                    t.forward(row_dict)
+                for name, add, encode, summary in schema:
+                    value = row_dict.get(name)
+                    if value is not None:
+                        value = get_csv_value(value)
+                    observed = bool(value)
+                    message.add_observed(observed)
+                    if observed:
+                        value = encode(value)
+                        add(value)
+                        if summary is not None and value < len(summary):
+                            summary[value] += 1
+                row_count[0] += 1
+                yield message
+                message.Clear()
+
+        loom.cFormat.row_stream_dump(rows(), rows_out)
+    return summaries, row_count[0]
+
+
+def make_tare(encoders, summaries, row_count):
+    '''
+    Make a tare row from value counts, as the loom.runner.tare command would.
+    '''
+    tare = loom.schema_pb2.ProductValue()
+    tare.observed.sparsity = loom.schema_pb2.ProductValue.Observed.DENSE
+    count_threshold = 0.5 * row_count
+    for encoder, summary in izip(encoders, summaries):
+        is_dense = False
+        if summary is not None:
+            mode = max(xrange(len(summary)), key=summary.__getitem__)
+            is_dense = (summary[mode] > count_threshold)
+        tare.observed.dense.append(is_dense)
+        if is_dense:
+            field = loom.schema.MODEL_TO_DATATYPE[encoder['model']]
+            if field == 'booleans':
+                mode = bool(mode)
+            getattr(tare, field).append(mode)
+    return tare
+
+
+@loom.documented.transform(
+    inputs=['schema_csv', 'rows_csv'],
+    outputs=[
+        'ingest.schema',
+        'ingest.transforms',
+        'ingest.encoding',
+        'ingest.rows',
+        'ingest.rowids',
+        'ingest.tares',
+    ])
+@parsable.command
+def transform_import(
+        schema_in,
+        rows_in,
+        schema_out,
+        transforms_out,
+        encoding_out,
+        rows_out,
+        rowids_out,
+        tares_out):
+    '''
+    Transform and import fluent csv rows without writing transformed csv.
+    This makes one statistics pass over rows_in to build text transforms and
+    categorical encoders, then one pass to encode rows, rowids and tares.
+    rows_in can be a csv file or a directory containing csv files.
+    Returns the id field, if any.
+    '''
+    fluent_schema = load_schema(schema_in)
+    basic_schema, pre_transforms, transforms, builders, id_field = \
+        parse_fluent_schema(fluent_schema)
+    for transform in transforms:
+        basic_schema.update(transform.get_schema())
+    files_in = map(os.path.abspath, get_rows_files(rows_in))
+    if not files_in:
+        raise LoomError('no files in {}'.format(rows_in))
+
+    LOG('gathering statistics')
+    partial_stats = parallel_map(_make_ingest_stats, [
+        (transforms, builders, basic_schema, file_in)
+        for file_in in files_in
+    ])
+    builders, encoder_builders = partial_stats[0]
+    for other_builders, other_encoder_builders in partial_stats[1:]:
+        for builder, other in izip(builders, other_builders):
+            builder.counts.update(other.counts)
+        for builder, other in izip(encoder_builders, other_encoder_builders):
+            assert builder.name == other.name
+            builder += other
+    for builder in builders:
+        transform = builder.build()
+        transforms.append(transform)
+        basic_schema.update(transform.get_schema())
+    json_dump(basic_schema, schema_out)
+    pickle_dump(transforms, transforms_out)
+    LOG('transformed {} -> {} features'.format(
+        len(fluent_schema),
+        len(basic_schema)))
+
+    name_to_encoder = {
+        builder.name: builder.build()
+        for builder in encoder_builders
+    }
+    encoders = [
+        name_to_encoder.get(name) or DefaultEncoderBuilder(name, model).build()
+        for name, model in basic_schema.iteritems()
+    ]
+    encoders.sort(key=get_encoder_rank)
+    json_dump(encoders, encoding_out)
+
+    LOG('importing rows')
+    transform = TransformSequence(transforms)
+    rows_out = os.path.abspath(rows_out)
+    rowids_out = os.path.abspath(rowids_out)
+    part_count = len(files_in)
+    tasks = []
+    parts_out = []
+    with tempdir():
+        for i, file_in in enumerate(files_in):
+            part_rows_out = os.path.abspath(
+                'part.{}.{}'.format(i, os.path.basename(rows_out)))
+            part_rowids_out = os.path.abspath(
+                'part.{}.{}'.format(i, os.path.basename(rowids_out)))
+            parts_out.append((part_rows_out, part_rowids_out))
+            tasks.append((
+                transform,
+                encoders,
+                id_field,
+                file_in,
+                part_rows_out,
+                part_rowids_out,
+                i,
+                part_count,
+            ))
+        partial_summaries = parallel_map(_import_ingest_file, tasks)
+        # It is safe use open instead of open_compressed even for .gz files;
+        # see http://stackoverflow.com/questions/8005114
+        with open(rows_out, 'wb') as rows, open(rowids_out, 'wb') as rowids:
+            for part_rows_out, part_rowids_out in parts_out:
+                for part_out, whole in [
+                        (part_rows_out, rows),
+                        (part_rowids_out, rowids)]:
+                    with open(part_out, 'rb') as part:
+                        shutil.copyfileobj(part, whole)
+                    os.remove(part_out)
+
+    summaries, row_count = partial_summaries[0]
+    for other_summaries, other_row_count in partial_summaries[1:]:
+        for summary, other in izip(summaries, other_summaries):
+            if summary is not None:
+                for value, count in enumerate(other):
+                    summary[value] += count
+        row_count += other_row_count
+    tare = make_tare(encoders, summaries, row_count)
+    if any(tare.observed.dense):
+        protobuf_stream_dump([tare.SerializeToString()], tares_out)
+    else:
+        protobuf_stream_dump([], tares_out)
+    return id_field
+
+
 def make_fake_transforms(transforms_out):
     pickle_dump([], transforms_out)
 
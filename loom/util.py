@@ -30,10 +30,12 @@ import os
 import sys
 import csv
 import shutil
+import itertools
 import tempfile
 import traceback
 import contextlib
 import multiprocessing
+from collections import namedtuple
 import cPickle as pickle
 import simplejson as json
 from google.protobuf.descriptor import FieldDescriptor
@@ -47,6 +49,16 @@ parsable = parsable.Parsable()
 THREADS = int(os.environ.get('LOOM_THREADS', multiprocessing.cpu_count()))
 VERBOSITY = int(os.environ.get('LOOM_VERBOSITY', 1))
 
+CSV_CHUNK_SIZE = 64 * 2 ** 20  # bytes per chunk when splitting csv files
+CSV_SCAN_SIZE = 2 ** 20  # bytes per read when scanning for record boundaries
+
+
+# A byte range [begin, end) of an uncompressed csv file, starting at row
+# first_row of the original file named name (ignoring the header).
+CsvChunk = namedtuple(
+    'CsvChunk',
+    ['filename', 'begin', 'end', 'first_row', 'name'])
+
 
 class LoomError(Exception):
     pass
@@ -169,6 +181,123 @@ def csv_reader(filename):
         yield csv.reader(f)
 
 
+def is_compressed(filename):
+    return filename.endswith('.gz') or filename.endswith('.bz2')
+
+
+def _count_records(block, pos, end, quoted):
+    '''
+    Returns (records, quoted), where records is the number of newlines
+    outside quoted fields in block[pos:end] and quoted the final parity.
+    '''
+    if block.find('"', pos, end) == -1:
+        records = 0 if quoted else block.count('\n', pos, end)
+        return records, quoted
+    records = 0
+    while True:
+        newline = block.find('\n', pos, end)
+        if newline == -1:
+            break
+        quoted = (quoted + block.count('"', pos, newline)) % 2
+        records += not quoted
+        pos = newline + 1
+    quoted = (quoted + block.count('"', pos, end)) % 2
+    return records, quoted
+
+
+def split_csv_file(filename, chunk_size=None, name=None):
+    '''
+    Split an uncompressed csv file into byte ranges of at least chunk_size
+    bytes (except the last), each ending at a record boundary, i.e. just
+    after a newline outside of any quoted field.  The header is excluded.
+    Returns a list of CsvChunks, named name (default the file's basename).
+    This reads the file once, counting quotes to track quoted newlines
+    and counting records to find the first row of each chunk.
+    '''
+    assert not is_compressed(filename), filename
+    if chunk_size is None:
+        chunk_size = CSV_CHUNK_SIZE
+    if name is None:
+        name = os.path.basename(filename)
+    boundaries = []  # (offset, number of records before offset)
+    target = 0  # the first boundary ends the header
+    quoted = 0  # parity of quotes seen so far
+    records = 0  # records seen so far, including the header
+    offset = 0
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(CSV_SCAN_SIZE)
+            if not block:
+                break
+            pos = 0
+            end = len(block)
+            while pos < end:
+                start = target - offset
+                if start > pos:
+                    if start >= end:
+                        break
+                    count, quoted = _count_records(block, pos, start, quoted)
+                    records += count
+                    pos = start
+                newline = block.find('\n', pos)
+                if newline == -1:
+                    break
+                quoted = (quoted + block.count('"', pos, newline)) % 2
+                pos = newline + 1
+                if not quoted:
+                    records += 1
+                    boundaries.append((offset + pos, records))
+                    target = offset + pos + chunk_size
+            count, quoted = _count_records(block, pos, end, quoted)
+            records += count
+            offset += end
+    if boundaries and boundaries[-1][0] < offset:
+        boundaries.append((offset, records))
+    return [
+        CsvChunk(filename, begin, end, header_and_rows - 1, name)
+        for (begin, header_and_rows), (end, _)
+        in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def _iter_lines(f, size):
+    while size > 0:
+        line = f.readline()
+        if not line:
+            break
+        size -= len(line)
+        yield line
+
+
+@contextlib.contextmanager
+def open_csv_chunk(chunk):
+    '''
+    Open a CsvChunk as returned by split_csv_file.
+    Yields (f, header, size), where f is positioned at chunk.begin and
+    size = chunk.end - chunk.begin bytes remain to be read.
+    '''
+    with open(chunk.filename, 'rb') as f:
+        header = csv.reader(iter(f.readline, '')).next()
+        f.seek(chunk.begin)
+        yield f, header, chunk.end - chunk.begin
+
+
+@contextlib.contextmanager
+def csv_chunk_reader(chunk):
+    '''
+    Like csv_reader, but chunk may also be a CsvChunk byte range of an
+    uncompressed csv file, as returned by split_csv_file.
+    The header is read from the start of the file.
+    '''
+    if isinstance(chunk, basestring):
+        with csv_reader(chunk) as reader:
+            yield reader
+    else:
+        with open_csv_chunk(chunk) as (f, header, size):
+            reader = csv.reader(_iter_lines(f, size))
+            yield itertools.chain([header], reader)
+
+
 @contextlib.contextmanager
 def csv_writer(filename):
     with open_compressed(filename, 'wb') as f:
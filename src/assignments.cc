@@ -27,6 +27,9 @@
 // USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 #include <loom/assignments.hpp>
+#include <algorithm>
+#include <fstream>
+#include <limits>
 #include <unordered_map>
 #include <distributions/trivial_hash.hpp>
 #include <loom/protobuf.hpp>
@@ -65,15 +68,13 @@ void Assignments::load (const char * filename)
     }
 }
 
-void Assignments::dump (
-        const char * filename,
-        const std::vector<std::vector<uint32_t>> & sorted_to_globals) const
-{
-    const size_t row_count = this->row_count();
-    const size_t kind_count = this->kind_count();
+typedef distributions::TrivialHash<Assignments::Value> Hash;
+typedef std::unordered_map<Assignments::Value, Assignments::Value, Hash> Map;
 
-    typedef distributions::TrivialHash<Value> Hash;
-    typedef std::unordered_map<Value, Value, Hash> Map;
+static std::vector<Map> get_global_to_sorteds (
+        const std::vector<std::vector<uint32_t>> & sorted_to_globals)
+{
+    const size_t kind_count = sorted_to_globals.size();
     std::vector<Map> global_to_sorteds(kind_count);
     for (size_t k = 0; k < kind_count; ++k) {
         Map & global_to_sorted = global_to_sorteds[k];
@@ -83,6 +84,18 @@ void Assignments::dump (
             global_to_sorted[sorted_to_global[g]] = g;
         }
     }
+    return global_to_sorteds;
+}
+
+void Assignments::dump (
+        const char * filename,
+        const std::vector<std::vector<uint32_t>> & sorted_to_globals) const
+{
+    const size_t row_count = this->row_count();
+    const size_t kind_count = this->kind_count();
+    LOOM_ASSERT_EQ(sorted_to_globals.size(), kind_count);
+    const std::vector<Map> global_to_sorteds =
+        get_global_to_sorteds(sorted_to_globals);
 
     protobuf::OutFile file(filename);
     protobuf::Assignment assignment;
@@ -100,4 +113,95 @@ void Assignments::dump (
     }
 }
 
+void Assignments::dump_columnar (
+        const char * filename,
+        const std::vector<std::vector<uint32_t>> & sorted_to_globals) const
+{
+    const size_t row_count = this->row_count();
+    const size_t kind_count = this->kind_count();
+    LOOM_ASSERT_EQ(sorted_to_globals.size(), kind_count);
+    const std::vector<Map> global_to_sorteds =
+        get_global_to_sorteds(sorted_to_globals);
+
+    std::vector<uint64_t> rowids(keys_.begin(), keys_.end());
+    std::vector<std::vector<uint32_t>> groupids(kind_count);
+    for (size_t k = 0; k < kind_count; ++k) {
+        const Map & global_to_sorted = global_to_sorteds[k];
+        auto & column = groupids[k];
+        column.reserve(row_count);
+        for (uint32_t global : values_[k]) {
+            auto i = global_to_sorted.find(global);
+            LOOM_ASSERT1(i != global_to_sorted.end(), "bad id: " << global);
+            column.push_back(i->second);
+        }
+    }
+
+    columnar_assignments_dump(filename, rowids, groupids);
+}
+
+template<class T>
+inline void write_array (std::ofstream & file, const std::vector<T> & array)
+{
+    file.write(
+        reinterpret_cast<const char *>(array.data()),
+        sizeof(T) * array.size());
+}
+
+void columnar_assignments_dump (
+        const char * filename,
+        const std::vector<uint64_t> & rowids,
+        const std::vector<std::vector<uint32_t>> & groupids)
+{
+    const uint64_t row_count = rowids.size();
+    const uint64_t kind_count = groupids.size();
+    LOOM_ASSERT_LE(row_count, std::numeric_limits<uint32_t>::max());
+
+    // build an inverted index from (kind, group) to row positions
+    std::vector<uint64_t> group_counts(kind_count, 0);
+    std::vector<uint64_t> offsets;
+    std::vector<uint32_t> positions;
+    positions.reserve(kind_count * row_count);
+    for (size_t k = 0; k < kind_count; ++k) {
+        const auto & column = groupids[k];
+        LOOM_ASSERT_EQ(column.size(), row_count);
+        uint64_t group_count = 0;
+        for (uint32_t groupid : column) {
+            group_count = std::max<uint64_t>(group_count, groupid + 1);
+        }
+        group_counts[k] = group_count;
+
+        std::vector<uint64_t> kind_offsets(group_count + 1, 0);
+        for (uint32_t groupid : column) {
+            ++kind_offsets[groupid + 1];
+        }
+        for (size_t g = 0; g < group_count; ++g) {
+            kind_offsets[g + 1] += kind_offsets[g];
+        }
+        std::vector<uint32_t> kind_positions(row_count);
+        std::vector<uint64_t> next(kind_offsets.begin(), kind_offsets.end());
+        for (size_t r = 0; r < row_count; ++r) {
+            kind_positions[next[column[r]]++] = r;
+        }
+        offsets.insert(offsets.end(), kind_offsets.begin(), kind_offsets.end());
+        positions.insert(
+            positions.end(),
+            kind_positions.begin(),
+            kind_positions.end());
+    }
+
+    std::ofstream file(filename, std::ios::out | std::ios::binary);
+    LOOM_ASSERT(file, "failed to open " << filename);
+    file.write(COLUMNAR_ASSIGNMENTS_MAGIC, 8);
+    file.write(reinterpret_cast<const char *>(&row_count), sizeof(uint64_t));
+    file.write(reinterpret_cast<const char *>(&kind_count), sizeof(uint64_t));
+    write_array(file, group_counts);
+    write_array(file, rowids);
+    write_array(file, offsets);
+    for (const auto & column : groupids) {
+        write_array(file, column);
+    }
+    write_array(file, positions);
+    LOOM_ASSERT(file, "failed to write " << filename);
+}
+
 } // namespace loom
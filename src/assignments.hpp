@@ -92,6 +92,9 @@ public:
     void dump (
             const char * filename,
             const std::vector<std::vector<uint32_t>> & sorted_to_globals) const;
+    void dump_columnar (
+            const char * filename,
+            const std::vector<std::vector<uint32_t>> & sorted_to_globals) const;
     Queue<Value> & packed_add () { return values_.packed_add(); }
     void packed_remove (size_t i) { values_.packed_remove(i); }
 
@@ -116,4 +119,25 @@ private:
     distributions::Packed_<Queue<Value>> values_;
 };
 
+// An uncompressed columnar assignments file, suitable for memory mapping,
+// has layout:
+//   char magic[8] = COLUMNAR_ASSIGNMENTS_MAGIC
+//   uint64_t row_count
+//   uint64_t kind_count
+//   uint64_t group_counts[kind_count]
+//   uint64_t rowids[row_count]
+//   uint64_t offsets[kind_count][group_counts[k] + 1]  (ragged)
+//   uint32_t groupids[kind_count][row_count]
+//   uint32_t positions[kind_count][row_count]
+// where for each kind k, positions[k][offsets[k][g]:offsets[k][g+1]] are
+// the positions in rowids of rows assigned to group g.
+// This must match loom.group.ColumnarAssignments
+
+static const char COLUMNAR_ASSIGNMENTS_MAGIC[9] = "loomcas1";
+
+void columnar_assignments_dump (
+        const char * filename,
+        const std::vector<uint64_t> & rowids,
+        const std::vector<std::vector<uint32_t>> & groupids);
+
 } // namespace loom
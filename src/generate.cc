@@ -32,6 +32,7 @@
 
 const char * help_message =
 "Usage: generate CONFIG_IN MODEL_IN ROWS_OUT MODEL_OUT GROUPS_OUT ASSIGN_OUT"
+"\n  ASSIGN_COLUMNAR_OUT"
 "\nArguments:"
 "\n  CONFIG_IN     filename of config (e.g. config.pb.gz)"
 "\n  MODEL_IN      filename of model (e.g. model.pb.gz)"
@@ -41,6 +42,9 @@ const char * help_message =
 "\n                or --none to discard groups"
 "\n  ASSIGN_OUT    filename of assignments stream (e.g. assign.pbs.gz)"
 "\n                or --none to discard assignments"
+"\n  ASSIGN_COLUMNAR_OUT"
+"\n                filename of uncompressed columnar assignments"
+"\n                (e.g. assign.columnar) or --none to not write them"
 "\nNotes:"
 "\n  Any filename can end with .gz to indicate gzip compression."
 "\n  Any filename can be '-' or '-.gz' to indicate stdin/stdout."
@@ -57,6 +61,7 @@ int main (int argc, char ** argv)
     const char * model_out = args.pop_optional_file();
     const char * groups_out = args.pop_optional_file();
     const char * assign_out = args.pop_optional_file();
+    const char * assign_columnar_out = args.pop_optional_file();
     args.done();
 
     const auto config = loom::protobuf_load<loom::protobuf::Config>(config_in);
@@ -64,7 +69,7 @@ int main (int argc, char ** argv)
     loom::Loom engine(rng, config, model_in);
 
     engine.generate(rng, rows_out);
-    engine.dump(model_out, groups_out, assign_out);
+    engine.dump(model_out, groups_out, assign_out, assign_columnar_out);
 
     return 0;
 }
@@ -33,7 +33,7 @@
 
 const char * help_message =
 "Usage: infer CONFIG_IN ROWS_IN MODEL_IN GROUPS_IN ASSIGN_IN TARES_IN"
-"\n  MODEL_OUT GROUPS_OUT ASSIGN_OUT LOG_OUT"
+"\n  MODEL_OUT GROUPS_OUT ASSIGN_OUT ASSIGN_COLUMNAR_OUT LOG_OUT"
 "\nArguments:"
 "\n  CONFIG_IN         filename of config (e.g. config.pb.gz)"
 "\n  ROWS_IN           filename of input dataset stream (e.g. rows.pbs.gz)"
@@ -51,6 +51,9 @@ const char * help_message =
 "\n                    or --none to discard groups"
 "\n  ASSIGN_OUT        filename of assignments stream (e.g. assign.pbs.gz)"
 "\n                    or --none to discard assignments"
+"\n  ASSIGN_COLUMNAR_OUT"
+"\n                    filename of uncompressed columnar assignments"
+"\n                    (e.g. assign.columnar) or --none to not write them"
 "\n  CHECKPOINT_OUT    filename of checkpoint state (e.g. checkpoint.pb.gz)"
 "\n                    or --none if not running from checkpoint"
 "\n  LOG_OUT           filename of log (e.g. log.pbs.gz)"
@@ -77,6 +80,7 @@ int main (int argc, char ** argv)
     const char * model_out = args.pop_optional_file();
     const char * groups_out = args.pop_optional_file();
     const char * assign_out = args.pop_optional_file();
+    const char * assign_columnar_out = args.pop_optional_file();
     const char * checkpoint_out = args.pop_optional_file();
     const char * log_out = args.pop_optional_file();
     args.done();
@@ -96,11 +100,11 @@ int main (int argc, char ** argv)
     if (config.schedule().extra_passes() > 0) {
 
         engine.infer_multi_pass(rng, rows_in, checkpoint_in, checkpoint_out);
-        engine.dump(model_out, groups_out, assign_out);
+        engine.dump(model_out, groups_out, assign_out, assign_columnar_out);
 
     } else {
 
-        engine.infer_single_pass(rng, rows_in, assign_out);
+        engine.infer_single_pass(rng, rows_in, assign_out, assign_columnar_out);
         engine.dump(model_out, groups_out);
     }
 
@@ -27,6 +27,7 @@
 // USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 #include <loom/loom.hpp>
+#include <memory>
 #include <loom/cat_kernel.hpp>
 #include <loom/cat_pipeline.hpp>
 #include <loom/hyper_kernel.hpp>
@@ -90,13 +91,14 @@ Loom::Loom (
 void Loom::dump (
         const char * model_out,
         const char * groups_out,
-        const char * assign_out) const
+        const char * assign_out,
+        const char * assign_columnar_out) const
 {
     if (model_out) {
         cross_cat_.model_dump(model_out);
     }
 
-    if (groups_out or assign_out) {
+    if (groups_out or assign_out or assign_columnar_out) {
         std::vector<std::vector<uint32_t>> sorted_to_globals =
             cross_cat_.get_sorted_groupids();
 
@@ -107,26 +109,51 @@ void Loom::dump (
         if (assign_out) {
             assignments_.dump(assign_out, sorted_to_globals);
         }
+
+        if (assign_columnar_out) {
+            assignments_.dump_columnar(assign_columnar_out, sorted_to_globals);
+        }
     }
 }
 
 void Loom::infer_single_pass (
         rng_t & rng,
         const char * rows_in,
-        const char * assign_out)
+        const char * assign_out,
+        const char * assign_columnar_out)
 {
     protobuf::InFile rows(rows_in);
     protobuf::Row row;
     CatKernel cat_kernel(config_.kernels().cat(), cross_cat_);
 
-    if (assign_out) {
+    if (assign_out or assign_columnar_out) {
 
-        protobuf::OutFile assignments(assign_out);
+        std::unique_ptr<protobuf::OutFile> assignments;
+        if (assign_out) {
+            assignments.reset(new protobuf::OutFile(assign_out));
+        }
         protobuf::Assignment assignment;
+        const size_t kind_count = cross_cat_.kinds.size();
+        std::vector<uint64_t> rowids;
+        std::vector<std::vector<uint32_t>> groupids(kind_count);
 
         while (rows.try_read_stream(row)) {
             cat_kernel.add_row(rng, row, assignment);
-            assignments.write_stream(assignment);
+            if (assignments) {
+                assignments->write_stream(assignment);
+            }
+            if (assign_columnar_out) {
+                rowids.push_back(assignment.rowid());
+                for (size_t k = 0; k < kind_count; ++k) {
+                    groupids[k].push_back(assignment.groupids(k));
+                }
+            }
+        }
+
+        // close the stream first, so the columnar file is never older
+        assignments.reset();
+        if (assign_columnar_out) {
+            columnar_assignments_dump(assign_columnar_out, rowids, groupids);
         }
 
     } else {
@@ -58,12 +58,14 @@ public:
     void dump (
             const char * model_out = nullptr,
             const char * groups_out = nullptr,
-            const char * assign_out = nullptr) const;
+            const char * assign_out = nullptr,
+            const char * assign_columnar_out = nullptr) const;
 
     void infer_single_pass (
             rng_t & rng,
             const char * rows_in,
-            const char * assign_out = nullptr);
+            const char * assign_out = nullptr,
+            const char * assign_columnar_out = nullptr);
 
     void infer_multi_pass (
             rng_t & rng,
@@ -32,7 +32,7 @@
 
 const char * help_message =
 "Usage: generate CONFIG_IN ROWS_IN MODEL_IN GROUPS_IN ASSIGN_IN"
-"\n  MODEL_OUT GROUPS_OUT ASSIGN_OUT"
+"\n  MODEL_OUT GROUPS_OUT ASSIGN_OUT ASSIGN_COLUMNAR_OUT"
 "\nArguments:"
 "\n  CONFIG_IN     filename of config (e.g. config.pb.gz)"
 "\n  ROWS_IN       filename of input dataset stream (e.g. rows.pbs.gz)"
@@ -42,6 +42,9 @@ const char * help_message =
 "\n  MODEL_OUT     filename of output model (e.g. model.pb.gz)"
 "\n  GROUPS_OUT    dirname of output per-kind group files"
 "\n  ASSIGN_OUT    filename of output assignments stream (e.g. assign.pbs.gz)"
+"\n  ASSIGN_COLUMNAR_OUT"
+"\n                filename of uncompressed columnar assignments"
+"\n                (e.g. assign.columnar) or --none to not write them"
 "\nNotes:"
 "\n  Any filename can end with .gz to indicate gzip compression."
 "\n  Any filename can be '-' or '-.gz' to indicate stdin/stdout."
@@ -60,6 +63,7 @@ int main (int argc, char ** argv)
     const char * model_out = args.pop();
     const char * groups_out = args.pop();
     const char * assign_out = args.pop();
+    const char * assign_columnar_out = args.pop_optional_file();
     args.done();
 
     const auto config = loom::protobuf_load<loom::protobuf::Config>(config_in);
@@ -67,7 +71,7 @@ int main (int argc, char ** argv)
     loom::Loom engine(rng, config, model_in, groups_in, assign_in);
 
     engine.mix(rng, rows_in);
-    engine.dump(model_out, groups_out, assign_out);
+    engine.dump(model_out, groups_out, assign_out, assign_columnar_out);
 
     return 0;
 }
@@ -64,14 +64,13 @@ int main (int argc, char ** argv)
     }
 
     const auto paths = loom::store::get_paths(root_in);
-    const char * rows_in = paths.ingest.diffs.c_str();
 
     const bool load_groups = true;
     const bool load_assign = false;
     const bool load_tares = true;
     loom::MultiLoom engine(root_in, load_groups, load_assign, load_tares);
     const auto config = loom::protobuf_load<loom::protobuf::Config>(config_in);
-    loom::QueryServer server(engine.cross_cats(), config, rows_in);
+    loom::QueryServer server(engine.cross_cats(), config, paths);
     loom::rng_t rng(config.seed());
 
     server.serve(rng, requests_in, responses_out);
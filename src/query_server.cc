@@ -26,10 +26,18 @@
 // TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 // USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+#include <cstdio>
+#include <fstream>
+#include <unistd.h>
+#include <deque>
+#include <thread>
+#include <omp.h>
 #include <loom/query_server.hpp>
 #include <loom/compressed_vector.hpp>
 #include <loom/scorer.hpp>
 #include <loom/cat_kernel.hpp>
+#include <loom/assignments.hpp>
+#include <loom/logger.hpp>
 
 namespace loom
 {
@@ -39,31 +47,294 @@ void QueryServer::serve (
         const char * requests_in,
         const char * responses_out)
 {
+    const size_t thread_count = config_.query().threads();
+    if (thread_count > 1) {
+        serve_parallel(rng, requests_in, responses_out, thread_count);
+        return;
+    }
+
     protobuf::InFile query_stream(requests_in);
     protobuf::OutFile response_stream(responses_out);
     protobuf::Query::Request request;
     protobuf::Query::Response response;
 
+    size_t request_count = 0;
     while (query_stream.try_read_stream(request)) {
         Timer::Scope timer(timer_);
-        response.Clear();
-        response.set_id(request.id());
-        Errors & errors = * response.mutable_error();
-        if (request.has_sample() and validate(request.sample(), errors)) {
-            call(rng, request.sample(), * response.mutable_sample());
+        handle(rng, request, response);
+        response_stream.write_stream(response);
+        response_stream.flush();
+        ++request_count;
+    }
+    log_status(request_count);
+}
+
+void QueryServer::serve_parallel (
+        rng_t & rng,
+        const char * requests_in,
+        const char * responses_out,
+        size_t thread_count)
+{
+    protobuf::InFile query_stream(requests_in);
+    protobuf::OutFile response_stream(responses_out);
+    std::mutex response_mutex;
+    size_t request_count = 0;
+
+    const size_t queue_capacity = 2 * thread_count;
+    std::deque<Query::Request *> queue;
+    std::mutex queue_mutex;
+    std::condition_variable queue_changed;
+    bool done = false;
+
+    // split OpenMP threads among workers, so that parallel calls like
+    // batch_score and entropy do not oversubscribe cores thread_count-fold
+    const int omp_thread_count =
+        std::max(1, omp_get_max_threads() / static_cast<int>(thread_count));
+
+    std::vector<std::thread> workers;
+    for (size_t i = 0; i < thread_count; ++i) {
+        const auto seed = rng();
+        workers.push_back(std::thread([&, seed](){
+            omp_set_num_threads(omp_thread_count);
+            rng_t rng(seed);
+            Query::Response response;
+            while (true) {
+                Query::Request * request;
+                {
+                    std::unique_lock<std::mutex> lock(queue_mutex);
+                    queue_changed.wait(lock, [&](){
+                        return done or not queue.empty();
+                    });
+                    if (queue.empty()) {
+                        break;
+                    }
+                    request = queue.front();
+                    queue.pop_front();
+                }
+                queue_changed.notify_all();
+
+                handle(rng, * request, response);
+                delete request;
+
+                // responses are written in order of completion
+                std::unique_lock<std::mutex> lock(response_mutex);
+                response_stream.write_stream(response);
+                response_stream.flush();
+                ++request_count;
+            }
+        }));
+    }
+
+    while (true) {
+        auto * request = new Query::Request();
+        if (not query_stream.try_read_stream(* request)) {
+            delete request;
+            break;
         }
-        if (request.has_score() and validate(request.score(), errors)) {
-            call(rng, request.score(), * response.mutable_score());
+        std::unique_lock<std::mutex> lock(queue_mutex);
+        queue_changed.wait(lock, [&](){
+            return queue.size() < queue_capacity;
+        });
+        queue.push_back(request);
+        lock.unlock();
+        queue_changed.notify_all();
+    }
+
+    {
+        std::unique_lock<std::mutex> lock(queue_mutex);
+        done = true;
+    }
+    queue_changed.notify_all();
+    for (auto & worker : workers) {
+        worker.join();
+    }
+    log_status(request_count);
+}
+
+void QueryServer::handle (
+        rng_t & rng,
+        const Query::Request & request,
+        Query::Response & response) const
+{
+    // score_derivative temporarily modifies the model and lazy caches,
+    // so it runs exclusively; all other calls can run concurrently
+    const bool exclusive =
+        request.has_score_derivative() or
+        request.has_batch_score_derivative();
+    SharedMutexLock lock(mutex_, exclusive);
+
+    response.Clear();
+    response.set_id(request.id());
+    Errors & errors = * response.mutable_error();
+    if (request.has_sample() and validate(request.sample(), errors)) {
+        call(rng, request.sample(), * response.mutable_sample());
+    }
+    if (request.has_score() and validate(request.score(), errors)) {
+        call(rng, request.score(), * response.mutable_score());
+    }
+    if (request.has_batch_sample() and
+        validate(request.batch_sample(), errors))
+    {
+        call(rng, request.batch_sample(), * response.mutable_batch_sample());
+    }
+    if (request.has_batch_score() and
+        validate(request.batch_score(), errors))
+    {
+        call(rng, request.batch_score(), * response.mutable_batch_score());
+    }
+    if (request.has_entropy() and validate(request.entropy(), errors)) {
+        call(rng, request.entropy(), * response.mutable_entropy());
+    }
+    if (request.has_score_derivative() and
+        validate(request.score_derivative(), errors))
+    {
+        call(
+            rng,
+            request.score_derivative(),
+            * response.mutable_score_derivative());
+    }
+    if (request.has_batch_score_derivative() and
+        validate(request.batch_score_derivative(), errors))
+    {
+        call(
+            rng,
+            request.batch_score_derivative(),
+            * response.mutable_batch_score_derivative());
+    }
+}
+
+void QueryServer::log_status (size_t request_count) const
+{
+    logger([&](Logger::Message & message){
+        auto & status = * message.mutable_query_status();
+        status.set_request_count(request_count);
+        if (posterior_cache_.capacity()) {
+            status.set_posterior_cache_hits(posterior_cache_.hits());
+            status.set_posterior_cache_misses(posterior_cache_.misses());
         }
-        if (request.has_entropy() and validate(request.entropy(), errors)) {
-            call(rng, request.entropy(), * response.mutable_entropy());
+    });
+}
+
+void QueryServer::load_rows ()
+{
+    const size_t row_count =
+        protobuf::InFile::stream_stats(rows_in_).message_count;
+    row_ids_.clear();
+    row_data_.clear();
+    row_offsets_.assign(1, 0);
+    row_ids_.reserve(row_count);
+    row_offsets_.reserve(row_count + 1);
+
+    // store serialized diffs in one buffer, avoiding per-message overhead
+    protobuf::InFile rows(rows_in_);
+    protobuf::Row row;
+    while (rows.try_read_stream(row)) {
+        row_ids_.push_back(row.id());
+        row.diff().AppendToString(&row_data_);
+        row_offsets_.push_back(row_data_.size());
+    }
+    row_data_.shrink_to_fit();
+    LOOM_ASSERT_EQ(row_ids_.size(), row_count);
+    rows_cached_ = true;
+}
+
+bool QueryServer::load_baseline (const std::string & fingerprint) const
+{
+    const char * filename = paths_.query.baseline_scores.c_str();
+    if (not std::ifstream(filename)) {
+        return false;
+    }
+
+    const size_t row_count = this->row_count();
+    protobuf::InFile file(filename);
+    protobuf::RowScores chunk;
+    if (not file.try_read_stream(chunk) or
+        chunk.fingerprint() != fingerprint or
+        not chunk.has_row_count() or
+        chunk.row_count() != row_count)
+    {
+        return false;
+    }
+
+    baseline_ids_.clear();
+    baseline_scores_.clear();
+    do {
+        LOOM_ASSERT_EQ(chunk.ids_size(), chunk.scores_size());
+        baseline_ids_.insert(
+            baseline_ids_.end(),
+            chunk.ids().begin(),
+            chunk.ids().end());
+        baseline_scores_.insert(
+            baseline_scores_.end(),
+            chunk.scores().begin(),
+            chunk.scores().end());
+    } while (file.try_read_stream(chunk));
+
+    if (baseline_ids_.size() != row_count or
+        baseline_scores_.size() != row_count)
+    {
+        baseline_ids_.clear();
+        baseline_scores_.clear();
+        return false;
+    }
+    return true;
+}
+
+void QueryServer::dump_baseline (const std::string & fingerprint) const
+{
+    if (not std::ifstream(paths_.query.root)) {
+        return;
+    }
+
+    // write to a temp file and rename, so readers never see partial files
+    const std::string & filename = paths_.query.baseline_scores;
+    const std::string temp = filename + ".temp." + std::to_string(getpid());
+    const size_t chunk_size = 1UL << 16;
+    const size_t row_count = baseline_ids_.size();
+    {
+        protobuf::OutFile file(temp.c_str());
+        protobuf::RowScores chunk;
+        chunk.set_fingerprint(fingerprint);
+        chunk.set_row_count(row_count);
+        file.write_stream(chunk);
+        for (size_t begin = 0; begin < row_count; begin += chunk_size) {
+            const size_t end = std::min(row_count, begin + chunk_size);
+            chunk.Clear();
+            for (size_t i = begin; i < end; ++i) {
+                chunk.add_ids(baseline_ids_[i]);
+                chunk.add_scores(baseline_scores_[i]);
+            }
+            file.write_stream(chunk);
         }
-        if (request.has_score_derivative() and validate(request.score_derivative(), errors)) {
-            call(rng, request.score_derivative(), * response.mutable_score_derivative());
+    }
+    if (std::rename(temp.c_str(), filename.c_str()) != 0) {
+        std::remove(temp.c_str());
+    }
+}
+
+// not threadsafe
+void QueryServer::update_baseline (rng_t & rng) const
+{
+    if (baseline_cached_) {
+        return;
+    }
+
+    // only cache_scores persists the baseline; prune keeps it in memory
+    const bool persist = config_.query().cache_scores();
+    const std::string fingerprint =
+        persist ? store::get_fingerprint(paths_) : std::string();
+    if (not (persist and load_baseline(fingerprint))) {
+        baseline_ids_.clear();
+        baseline_scores_.clear();
+        for_each_row([&](uint64_t id, const ProductValue::Diff & diff){
+            baseline_ids_.push_back(id);
+            baseline_scores_.push_back(score(rng, diff));
+        });
+        if (persist) {
+            dump_baseline(fingerprint);
         }
-        response_stream.write_stream(response);
-        response_stream.flush();
     }
+    baseline_cached_ = true;
 }
 
 bool QueryServer::validate (
@@ -88,44 +359,109 @@ bool QueryServer::validate (
     return true;
 }
 
-void QueryServer::call (
+QueryServer::PosteriorCache::Value QueryServer::PosteriorCache::find (
+        const std::string & key)
+{
+    std::unique_lock<std::mutex> lock(mutex_);
+    auto i = index_.find(key);
+    if (i == index_.end()) {
+        ++misses_;
+        return Value();
+    } else {
+        ++hits_;
+        lru_.splice(lru_.begin(), lru_, i->second);
+        return i->second->second;
+    }
+}
+
+void QueryServer::PosteriorCache::insert (
+        const std::string & key,
+        const Value & value)
+{
+    std::unique_lock<std::mutex> lock(mutex_);
+    if (index_.find(key) != index_.end()) {
+        return;
+    }
+    lru_.emplace_front(key, value);
+    index_[key] = lru_.begin();
+    while (lru_.size() > capacity_) {
+        index_.erase(lru_.back().first);
+        lru_.pop_back();
+    }
+}
+
+void QueryServer::compute_posterior (
         rng_t & rng,
-        const Query::Sample::Request & request,
-        Query::Sample::Response & response) const
+        const ProductValue::Diff & data,
+        Posterior & posterior) const
 {
     const size_t latent_count = cross_cats_.size();
-    std::vector<std::vector<VectorFloat>> latent_kind_scores(latent_count);
-    VectorFloat latent_scores(latent_count, 0.f);
-    {
-        std::vector<ProductValue::Diff> conditional_diffs;
-        for (size_t l = 0; l < latent_count; ++l) {
-            const auto & cross_cat = * cross_cats_[l];
-            auto & kind_scores = latent_kind_scores[l];
-            cross_cat.splitter.split(request.data(), conditional_diffs);
+    auto & latent_kind_scores = posterior.kind_probs;
+    auto & latent_scores = posterior.latent_probs;
+    latent_kind_scores.resize(latent_count);
+    latent_scores.resize(latent_count);
+    std::fill(latent_scores.begin(), latent_scores.end(), 0.f);
 
-            const size_t kind_count = cross_cat.kinds.size();
-            kind_scores.resize(kind_count);
-            for (size_t k = 0; k < kind_count; ++k) {
-                const ProductValue::Diff & diff = conditional_diffs[k];
-                auto & kind = cross_cat.kinds[k];
-                const ProductModel & model = kind.model;
-                auto & mixture = kind.mixture;
-                auto & scores = kind_scores[k];
-
-                if (diff.tares_size()) {
-                    mixture.score_diff(model, diff, scores, rng);
-                } else {
-                    mixture.score_value(model, diff.pos(), scores, rng);
-                }
+    std::vector<ProductValue::Diff> conditional_diffs;
+    for (size_t l = 0; l < latent_count; ++l) {
+        const auto & cross_cat = * cross_cats_[l];
+        auto & kind_scores = latent_kind_scores[l];
+        cross_cat.splitter.split(data, conditional_diffs);
+
+        const size_t kind_count = cross_cat.kinds.size();
+        kind_scores.resize(kind_count);
+        for (size_t k = 0; k < kind_count; ++k) {
+            const ProductValue::Diff & diff = conditional_diffs[k];
+            auto & kind = cross_cat.kinds[k];
+            const ProductModel & model = kind.model;
+            auto & mixture = kind.mixture;
+            auto & scores = kind_scores[k];
 
-                latent_scores[l] += distributions::log_sum_exp(scores);
-                distributions::scores_to_probs(scores);
+            if (diff.tares_size()) {
+                mixture.score_diff(model, diff, scores, rng);
+            } else {
+                mixture.score_value(model, diff.pos(), scores, rng);
             }
+
+            latent_scores[l] += distributions::log_sum_exp(scores);
+            distributions::scores_to_probs(scores);
         }
+    }
 
-        distributions::scores_to_probs(latent_scores);
+    distributions::scores_to_probs(latent_scores);
+}
+
+std::shared_ptr<const QueryServer::Posterior> QueryServer::get_posterior (
+        rng_t & rng,
+        const ProductValue::Diff & data) const
+{
+    if (not posterior_cache_.capacity()) {
+        auto * posterior = new Posterior();
+        compute_posterior(rng, data, * posterior);
+        return std::shared_ptr<const Posterior>(posterior);
     }
 
+    const std::string key = data.SerializeAsString();
+    if (auto cached = posterior_cache_.find(key)) {
+        return cached;
+    }
+    auto * posterior = new Posterior();
+    compute_posterior(rng, data, * posterior);
+    std::shared_ptr<const Posterior> result(posterior);
+    posterior_cache_.insert(key, result);
+    return result;
+}
+
+void QueryServer::call (
+        rng_t & rng,
+        const Query::Sample::Request & request,
+        Query::Sample::Response & response) const
+{
+    const size_t latent_count = cross_cats_.size();
+    const auto posterior = get_posterior(rng, request.data());
+    const auto & latent_kind_scores = posterior->kind_probs;
+    const auto & latent_scores = posterior->latent_probs;
+
     const size_t sample_count = request.sample_count();
     std::vector<size_t> latent_counts(latent_count, 0);
     for (size_t s = 0; s < sample_count; ++s) {
@@ -170,6 +506,37 @@ void QueryServer::call (
     }
 }
 
+bool QueryServer::validate (
+        const Query::BatchSample::Request & request,
+        Errors & errors) const
+{
+    for (const auto & sample_request : request.requests()) {
+        if (not validate(sample_request, errors)) {
+            return false;
+        }
+    }
+
+    return true;
+}
+
+void QueryServer::call (
+        rng_t & rng,
+        const Query::BatchSample::Request & request,
+        Query::BatchSample::Response & response) const
+{
+    const size_t request_count = request.requests_size();
+    for (size_t i = 0; i < request_count; ++i) {
+        response.add_responses();
+    }
+    const auto seed = rng();
+
+    #pragma omp parallel for if(config_.query().parallel())
+    for (size_t i = 0; i < request_count; ++i) {
+        rng_t rng(seed + i);
+        call(rng, request.requests(i), * response.mutable_responses(i));
+    }
+}
+
 bool QueryServer::validate (
         const Query::Score::Request & request,
         Errors & errors) const
@@ -188,10 +555,9 @@ bool QueryServer::validate (
     return true;
 }
 
-void QueryServer::call (
+float QueryServer::score (
         rng_t & rng,
-        const Query::Score::Request & request,
-        Query::Score::Response & response) const
+        const ProductValue::Diff & data) const
 {
     // not freed
     static thread_local std::vector<ProductValue::Diff> *
@@ -207,7 +573,7 @@ void QueryServer::call (
         const auto & cross_cat = * cross_cats_[l];
         float & score = latent_scores[l];
 
-        cross_cat.splitter.split(request.data(), *partial_diffs);
+        cross_cat.splitter.split(data, *partial_diffs);
 
         const size_t kind_count = cross_cat.kinds.size();
         for (size_t k = 0; k < kind_count; ++k) {
@@ -226,9 +592,57 @@ void QueryServer::call (
             }
         }
     }
-    float score = distributions::log_sum_exp(latent_scores)
-                - distributions::fast_log(latent_count);
-    response.set_score(score);
+    return distributions::log_sum_exp(latent_scores)
+         - distributions::fast_log(latent_count);
+}
+
+void QueryServer::call (
+        rng_t & rng,
+        const Query::Score::Request & request,
+        Query::Score::Response & response) const
+{
+    response.set_score(score(rng, request.data()));
+}
+
+bool QueryServer::validate (
+        const Query::BatchScore::Request & request,
+        Errors & errors) const
+{
+    for (const auto & data : request.data()) {
+        if (not schema().is_valid(data)) {
+            * errors.Add() = "invalid request.batch_score.data";
+            return false;
+        }
+        for (auto id : data.tares()) {
+            if (id >= tares().size()) {
+                * errors.Add() = "invalid request.batch_score.data.tares";
+                return false;
+            }
+        }
+    }
+
+    return true;
+}
+
+void QueryServer::call (
+        rng_t & rng,
+        const Query::BatchScore::Request & request,
+        Query::BatchScore::Response & response) const
+{
+    const size_t row_count = request.data_size();
+    VectorFloat scores(row_count);
+    const auto seed = rng();
+
+    #pragma omp parallel for if(config_.query().parallel())
+    for (size_t i = 0; i < row_count; ++i) {
+        rng_t rng(seed + i);
+        scores[i] = score(rng, request.data(i));
+    }
+
+    response.mutable_scores()->Reserve(row_count);
+    for (float row_score : scores) {
+        response.add_scores(row_score);
+    }
 }
 
 bool QueryServer::validate (
@@ -261,6 +675,16 @@ bool QueryServer::validate (
         * errors.Add() = "invalid request.entropy.sample_count";
         return false;
     }
+    if (request.tolerance() < 0) {
+        * errors.Add() = "invalid request.entropy.tolerance";
+        return false;
+    }
+    if (request.tolerance() > 0 and
+        request.max_sample_count() < request.sample_count())
+    {
+        * errors.Add() = "invalid request.entropy.max_sample_count";
+        return false;
+    }
 
     return true;
 }
@@ -278,18 +702,23 @@ public:
 
     Accum ()
     {
-        static rng_t rng;
+        static thread_local rng_t rng;
         static Shared shared;
         group_.init(shared, rng);
     }
 
     void add (float x)
     {
-        static rng_t rng;
+        static thread_local rng_t rng;
         static Shared shared;
         group_.add_value(shared, x, rng);
     }
 
+    size_t count () const
+    {
+        return group_.count;
+    }
+
     float mean () const
     {
         return group_.mean;
@@ -327,7 +756,6 @@ void QueryServer::call (
         });
     }
     LOOM_ASSERT1(validate(sample_request, errors), errors);
-    call(rng, sample_request, sample_response);
 
     Query::Score::Request score_request;
     Query::Score::Response score_response;
@@ -375,30 +803,58 @@ void QueryServer::call (
         }
     }
 
-    std::vector<Accum> accums(task_count);
-    #pragma omp parallel if(config_.query().parallel())
-    {
-        VectorFloat scores(latent_count);
-        for (const auto & sample : sample_response.samples()) {
-
-            #pragma omp barrier
-            #pragma omp for
-            for (size_t l = 0; l < latent_count; ++l) {
-                scorers[l]->set_value(sample.pos(), rng);
-            }
+    // in adaptive mode, double the sample count each round
+    // until every cell's standard error is within tolerance
+    const float tolerance = request.tolerance();
+    const size_t max_sample_count =
+        tolerance > 0 ? request.max_sample_count() : request.sample_count();
+    const float max_variance = tolerance * tolerance;
+    size_t sample_count = 0;
+    size_t round_size = request.sample_count();
 
-            #pragma omp barrier
-            #pragma omp for
-            for (size_t t = 0; t < task_count; ++t) {
+    std::vector<Accum> accums(task_count);
+    while (round_size) {
+        sample_request.set_sample_count(round_size);
+        sample_response.Clear();
+        call(rng, sample_request, sample_response);
+        sample_count += round_size;
+
+        #pragma omp parallel if(config_.query().parallel())
+        {
+            VectorFloat scores(latent_count);
+            for (const auto & sample : sample_response.samples()) {
+
+                #pragma omp barrier
+                #pragma omp for
                 for (size_t l = 0; l < latent_count; ++l) {
-                    scores[l] = scorers[l]->get_score(t);
+                    scorers[l]->set_value(sample.pos(), rng);
+                }
+
+                #pragma omp barrier
+                #pragma omp for
+                for (size_t t = 0; t < task_count; ++t) {
+                    for (size_t l = 0; l < latent_count; ++l) {
+                        scores[l] = scorers[l]->get_score(t);
+                    }
+                    float score =
+                        score_shift - distributions::log_sum_exp(scores);
+
+                    // FIXME this should be atomic
+                    accums[t].add(score);
                 }
-                float score = score_shift - distributions::log_sum_exp(scores);
+            }
+        }
 
-                // FIXME this should be atomic
-                accums[t].add(score);
+        bool converged = true;
+        for (const auto & accum : accums) {
+            if (accum.variance() > max_variance * accum.count()) {
+                converged = false;
+                break;
             }
         }
+        round_size = converged
+                   ? 0
+                   : std::min(sample_count, max_sample_count - sample_count);
     }
 
     for (auto scorer : scorers) {
@@ -407,8 +863,9 @@ void QueryServer::call (
     for (size_t i = 0; i < cell_count; ++i) {
         const Accum & accum = accums[tasks.unique_id(i)];
         response.add_means(accum.mean());
-        response.add_variances(accum.variance() / request.sample_count());
+        response.add_variances(accum.variance() / sample_count);
     }
+    response.set_sample_count(sample_count);
 }
 
 bool QueryServer::validate (
@@ -425,6 +882,10 @@ bool QueryServer::validate (
             return false;
         }
     }
+    if (request.prune() and request.score_data_size()) {
+        * errors.Add() = "invalid request.score_derivative.prune";
+        return false;
+    }
     for (const ProductValue::Diff & score_data : request.score_data()) {
         if (not schema().is_valid(score_data)) {
             * errors.Add() = "invalid request.score_derivative.score_data";
@@ -441,6 +902,165 @@ bool QueryServer::validate (
     return true;
 }
 
+bool QueryServer::validate (
+        const Query::BatchScoreDerivative::Request & request,
+        Errors & errors) const
+{
+    if (request.score_data_size() == 0) {
+        * errors.Add() = "invalid request.batch_score_derivative.score_data";
+        return false;
+    }
+    for (const ProductValue::Diff & score_data : request.score_data()) {
+        if (not schema().is_valid(score_data)) {
+            * errors.Add() =
+                "invalid request.batch_score_derivative.score_data";
+            return false;
+        }
+        for (auto id : score_data.tares()) {
+            if (id >= tares().size()) {
+                * errors.Add() =
+                    "invalid request.batch_score_derivative.score_data";
+                return false;
+            }
+        }
+    }
+    for (const ProductValue::Diff & update_data : request.update_data()) {
+        if (not schema().is_valid(update_data)) {
+            * errors.Add() =
+                "invalid request.batch_score_derivative.update_data";
+            return false;
+        }
+        for (auto id : update_data.tares()) {
+            if (id >= tares().size()) {
+                * errors.Add() =
+                    "invalid request.batch_score_derivative.update_data";
+                return false;
+            }
+        }
+    }
+
+    return true;
+}
+
+namespace
+{
+// Keeps the highest-scoring items seen so far, in a bounded min-heap.
+class TopK
+{
+public:
+
+    typedef std::pair<uint64_t, float> Item;
+
+    explicit TopK (size_t capacity) : capacity_(capacity) {}
+
+    void push (uint64_t id, float score)
+    {
+        if (heap_.size() < capacity_) {
+            heap_.push_back(Item(id, score));
+            std::push_heap(heap_.begin(), heap_.end(), greater);
+        } else if (capacity_ and score > heap_.front().second) {
+            std::pop_heap(heap_.begin(), heap_.end(), greater);
+            heap_.back() = Item(id, score);
+            std::push_heap(heap_.begin(), heap_.end(), greater);
+        }
+    }
+
+    // sorts by decreasing score, after which push() is invalid
+    const std::vector<Item> & sorted ()
+    {
+        std::sort_heap(heap_.begin(), heap_.end(), greater);
+        return heap_;
+    }
+
+private:
+
+    static bool greater (const Item & x, const Item & y)
+    {
+        return x.second > y.second;
+    }
+
+    const size_t capacity_;
+    std::vector<Item> heap_;
+};
+} // anonymous namespace
+
+// not threadsafe
+void QueryServer::update_group_index () const
+{
+    if (group_index_cached_) {
+        return;
+    }
+
+    const size_t latent_count = cross_cats_.size();
+    LOOM_ASSERT_EQ(paths_.samples.size(), latent_count);
+    group_index_.resize(latent_count);
+    Assignments assignments;
+    std::vector<size_t> counts;
+    std::vector<size_t> cursors;
+    for (size_t l = 0; l < latent_count; ++l) {
+        const size_t kind_count = cross_cats_[l]->kinds.size();
+        assignments.init(kind_count);
+        assignments.load(paths_.samples[l].assign.c_str());
+        const size_t row_count = assignments.row_count();
+        const auto & rowids = assignments.rowids();
+
+        auto & kind_indices = group_index_[l];
+        kind_indices.resize(kind_count);
+        for (size_t k = 0; k < kind_count; ++k) {
+            const auto & groupids = assignments.groupids(k);
+            counts.clear();
+            for (auto groupid : groupids) {
+                if (groupid >= counts.size()) {
+                    counts.resize(groupid + 1, 0);
+                }
+                ++counts[groupid];
+            }
+
+            GroupIndex & index = kind_indices[k];
+            const size_t group_count = counts.size();
+            index.offsets.resize(group_count + 1);
+            index.offsets[0] = 0;
+            for (size_t g = 0; g < group_count; ++g) {
+                index.offsets[g + 1] = index.offsets[g] + counts[g];
+            }
+            cursors.assign(index.offsets.begin(), index.offsets.end() - 1);
+            index.rowids.resize(row_count);
+            for (size_t r = 0; r < row_count; ++r) {
+                index.rowids[cursors[groupids[r]]++] = rowids[r];
+            }
+        }
+    }
+    group_index_cached_ = true;
+}
+
+void QueryServer::get_candidates (
+        const std::vector<protobuf::Assignment> & assignments,
+        std::unordered_set<uint64_t> & candidates) const
+{
+    candidates.clear();
+    const size_t latent_count = cross_cats_.size();
+    for (size_t l = 0; l < latent_count; ++l) {
+        const auto & cross_cat = * cross_cats_[l];
+        const size_t kind_count = cross_cat.kinds.size();
+        for (size_t k = 0; k < kind_count; ++k) {
+            const auto & kind = cross_cat.kinds[k];
+            if (kind.featureids.empty()) {
+                continue;
+            }
+            // loaded groups keep their global ids, which match assign files
+            const auto & id_tracker = kind.mixture.id_tracker;
+            const size_t groupid =
+                id_tracker.packed_to_global(assignments[l].groupids(k));
+            const GroupIndex & index = group_index_[l][k];
+            if (groupid + 1 < index.offsets.size()) {
+                candidates.insert(
+                    index.rowids.begin() + index.offsets[groupid],
+                    index.rowids.begin() + index.offsets[groupid + 1]);
+            }
+        }
+    }
+}
+
 // not threadsafe
 void QueryServer::call (
         rng_t & rng,
@@ -448,102 +1068,154 @@ void QueryServer::call (
         Query::ScoreDerivative::Response & response) const
 {
     const size_t latent_count = cross_cats_.size();
+    const size_t score_count = request.score_data_size();
+    const bool prune = request.prune();
+    const bool use_baseline =
+        (config_.query().cache_scores() or prune) and score_count == 0;
+    if (use_baseline) {
+        update_baseline(rng);
+    }
+    if (prune) {
+        update_group_index();
+    }
+    const size_t row_count = this->row_count();
 
-    Query::Score::Request score_request;
-    Query::Score::Response score_response;
-
-    protobuf::Assignment assignment;
-    protobuf::Row row;
-
-    std::vector<protobuf::Assignment> assignments;
+    std::vector<protobuf::Assignment> assignments(latent_count);
     std::vector<CatKernel *> cat_kernels;
+    for (const auto * cross_cat : cross_cats_) {
+        cat_kernels.push_back(
+            new CatKernel(
+                config_.kernels().cat(),
+                * const_cast<CrossCat*>(cross_cat)));
+    }
 
     protobuf::Row update_row;
     update_row.set_id(0);
     * update_row.mutable_diff() = request.update_data();
 
+    std::vector<float> local_base_scores;
+    if (score_count) {
+        local_base_scores.reserve(score_count);
+        for (size_t i = 0; i < score_count; ++i) {
+            local_base_scores.push_back(score(rng, request.score_data(i)));
+        }
+    } else if (not use_baseline) {
+        local_base_scores.reserve(row_count);
+        for_each_row([&](uint64_t, const ProductValue::Diff & diff){
+            local_base_scores.push_back(score(rng, diff));
+        });
+    }
+    const std::vector<float> & base_scores =
+        use_baseline ? baseline_scores_ : local_base_scores;
+
+    for (size_t l = 0; l < latent_count; ++l) {
+        cat_kernels[l]->add_row(rng, update_row, assignments[l]);
+    }
 
-    //FIXME is there a better way to get the row count?
-    size_t row_count = 0;
-    protobuf::InFile all_rows(rows_in_);
-    while (all_rows.try_read_stream(row)) {
-        row_count++;
+    std::unordered_set<uint64_t> candidates;
+    if (prune) {
+        get_candidates(assignments, candidates);
     }
 
+    TopK top_k(request.row_limit());
+    if (score_count) {
+        for (size_t i = 0; i < score_count; ++i) {
+            float diff = score(rng, request.score_data(i)) - base_scores[i];
+            top_k.push(i, diff * row_count);
+        }
+    } else {
+        size_t i = 0;
+        for_each_row([&](uint64_t id, const ProductValue::Diff & diff){
+            const size_t pos = i++;
+            LOOM_ASSERT1(
+                not use_baseline or baseline_ids_[pos] == id,
+                "row order changed");
+            if (prune and not candidates.count(id)) {
+                return;
+            }
+            float score_diff = score(rng, diff) - base_scores[pos];
+            top_k.push(id, score_diff * row_count);
+        });
+        LOOM_ASSERT_EQ(i, base_scores.size());
+    }
+
+    for (size_t l = 0; l < latent_count; ++l) {
+        cat_kernels[l]->remove_row(rng, update_row, assignments[l]);
+        delete cat_kernels[l];
+    }
+
+    for (const auto & score_diff : top_k.sorted()) {
+        response.add_ids(score_diff.first);
+        response.add_score_diffs(score_diff.second);
+    }
+}
+
+
+// not threadsafe
+void QueryServer::call (
+        rng_t & rng,
+        const Query::BatchScoreDerivative::Request & request,
+        Query::BatchScoreDerivative::Response & response) const
+{
+    const size_t latent_count = cross_cats_.size();
+    const size_t score_count = request.score_data_size();
+    const size_t row_count = this->row_count();
+    const bool parallel = config_.query().parallel();
+
+    // base scores are shared by all update rows
+    std::vector<float> base_scores(score_count);
+    const auto base_seed = rng();
+    #pragma omp parallel for if(parallel)
+    for (size_t i = 0; i < score_count; ++i) {
+        rng_t rng(base_seed + i);
+        base_scores[i] = score(rng, request.score_data(i));
+    }
+
+    std::vector<protobuf::Assignment> assignments(latent_count);
+    std::vector<CatKernel *> cat_kernels;
     for (const auto * cross_cat : cross_cats_) {
         cat_kernels.push_back(
             new CatKernel(
                 config_.kernels().cat(),
                 * const_cast<CrossCat*>(cross_cat)));
-        assignments.push_back(assignment);
     }
 
-    typedef std::pair<int, float> ScoreDiff;
-    std::vector<ScoreDiff> score_diffs;
-
-    {
-        if (request.score_data_size() == 0) {
-            protobuf::InFile all_rows(rows_in_);
-            while (all_rows.try_read_stream(row)) {
-                * score_request.mutable_data() = row.diff();
-                call(rng, score_request, score_response);
-                score_diffs.push_back(
-                    std::make_pair(row.id(), -score_response.score()));
-            }
+    protobuf::Row update_row;
+    update_row.set_id(0);
+    std::vector<float> score_diffs(score_count);
+    response.mutable_responses()->Reserve(request.update_data_size());
+    for (const auto & update_data : request.update_data()) {
+        * update_row.mutable_diff() = update_data;
+        for (size_t l = 0; l < latent_count; ++l) {
+            cat_kernels[l]->add_row(rng, update_row, assignments[l]);
         }
-        else {
-            for (size_t i = 0; i < request.score_data_size(); i++) {
-                * score_request.mutable_data() = request.score_data(i);
-                call(rng, score_request, score_response);
-                score_diffs.push_back(
-                    std::make_pair(i, -score_response.score()));
-            }
+
+        // the model is only read while scoring, so rows score in parallel
+        const auto seed = rng();
+        #pragma omp parallel for if(parallel)
+        for (size_t i = 0; i < score_count; ++i) {
+            rng_t rng(seed + i);
+            score_diffs[i] =
+                score(rng, request.score_data(i)) - base_scores[i];
         }
-    }
 
-    for (size_t i = 0; i < latent_count; ++i){
-        cat_kernels[i]->add_row(rng, update_row, assignments[i]);
-    }
+        for (size_t l = 0; l < latent_count; ++l) {
+            cat_kernels[l]->remove_row(rng, update_row, assignments[l]);
+        }
 
-    {
-        int i = 0;
-        if (request.score_data_size() == 0) {
-            protobuf::InFile all_rows(rows_in_);
-            while (all_rows.try_read_stream(row)) {
-                * score_request.mutable_data() = row.diff();
-                call(rng, score_request, score_response);
-                score_diffs[i].second += score_response.score();
-                score_diffs[i].second *= row_count;
-                i++;
-            }
+        TopK top_k(request.row_limit());
+        for (size_t i = 0; i < score_count; ++i) {
+            top_k.push(i, score_diffs[i] * row_count);
         }
-        else {
-            for (size_t i = 0; i < request.score_data_size(); i++) {
-                * score_request.mutable_data() = request.score_data(i);
-                call(rng, score_request, score_response);
-                score_diffs[i].second += score_response.score();
-                score_diffs[i].second *= row_count;
-                i++;
-            }
+        auto & result = * response.add_responses();
+        for (const auto & score_diff : top_k.sorted()) {
+            result.add_ids(score_diff.first);
+            result.add_score_diffs(score_diff.second);
         }
     }
 
-    for (size_t i = 0; i < latent_count; ++i) {
-        cat_kernels[i]->remove_row(rng, update_row, assignments[i]);
-        delete cat_kernels[i];
-    }
-
-    std::sort(score_diffs.begin(), score_diffs.end(),
-            [](const ScoreDiff & a, const ScoreDiff & b) {
-                return a.second > b.second;
-            });
-    if (score_diffs.size() > request.row_limit()) {
-        score_diffs.resize(request.row_limit());
-    }
-
-    for (const auto & score_diff : score_diffs) {
-        response.add_ids(score_diff.first);
-        response.add_score_diffs(score_diff.second);
+    for (auto * cat_kernel : cat_kernels) {
+        delete cat_kernel;
     }
 }
 
@@ -28,12 +28,100 @@
 
 #pragma once
 
+#include <list>
+#include <memory>
+#include <unordered_map>
+#include <unordered_set>
+#include <mutex>
+#include <condition_variable>
 #include <loom/timer.hpp>
 #include <loom/cross_cat.hpp>
+#include <loom/protobuf_stream.hpp>
+#include <loom/store.hpp>
 
 namespace loom
 {
 
+// A readers-writer lock that prefers writers.
+class SharedMutex : noncopyable
+{
+public:
+
+    SharedMutex () : reader_count_(0), writer_count_(0), writing_(false) {}
+
+    void lock_shared ()
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        changed_.wait(lock, [&](){ return writer_count_ == 0; });
+        ++reader_count_;
+    }
+
+    void unlock_shared ()
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        if (--reader_count_ == 0) {
+            changed_.notify_all();
+        }
+    }
+
+    void lock ()
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        ++writer_count_;
+        changed_.wait(lock, [&](){
+            return reader_count_ == 0 and not writing_;
+        });
+        writing_ = true;
+    }
+
+    void unlock ()
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        --writer_count_;
+        writing_ = false;
+        changed_.notify_all();
+    }
+
+private:
+
+    std::mutex mutex_;
+    std::condition_variable changed_;
+    size_t reader_count_;
+    size_t writer_count_;
+    bool writing_;
+};
+
+// holds a SharedMutex exclusively or shared until destroyed
+class SharedMutexLock : noncopyable
+{
+public:
+
+    SharedMutexLock (SharedMutex & mutex, bool exclusive) :
+        mutex_(mutex),
+        exclusive_(exclusive)
+    {
+        if (exclusive_) {
+            mutex_.lock();
+        } else {
+            mutex_.lock_shared();
+        }
+    }
+
+    ~SharedMutexLock ()
+    {
+        if (exclusive_) {
+            mutex_.unlock();
+        } else {
+            mutex_.unlock_shared();
+        }
+    }
+
+private:
+
+    SharedMutex & mutex_;
+    const bool exclusive_;
+};
+
 class QueryServer
 {
 public:
@@ -44,12 +132,27 @@ public:
     QueryServer (
             const std::vector<const CrossCat *> & cross_cats,
             const protobuf::Config & config,
-            const char * rows_in) :
+            const store::Paths & paths) :
         config_(config),
         cross_cats_(cross_cats),
-        rows_in_(rows_in)
+        paths_(paths),
+        rows_in_(paths_.ingest.diffs.c_str()),
+        rows_cached_(false),
+        row_ids_(),
+        row_data_(),
+        row_offsets_(),
+        baseline_cached_(false),
+        baseline_ids_(),
+        baseline_scores_(),
+        group_index_cached_(false),
+        group_index_(),
+        posterior_cache_(config_.query().posterior_cache_size()),
+        mutex_()
     {
         LOOM_ASSERT(not cross_cats_.empty(), "no cross cats found");
+        if (config_.query().cache_rows()) {
+            load_rows();
+        }
     }
 
     void serve (
@@ -59,20 +162,109 @@ public:
 
 private:
 
+    void serve_parallel (
+            rng_t & rng,
+            const char * requests_in,
+            const char * responses_out,
+            size_t thread_count);
+
+    void handle (
+            rng_t & rng,
+            const Query::Request & request,
+            Query::Response & response) const;
+
+    void log_status (size_t request_count) const;
+
+    // per-latent, per-kind group probabilities given conditioning data
+    struct Posterior
+    {
+        std::vector<std::vector<VectorFloat>> kind_probs;
+        VectorFloat latent_probs;
+    };
+
+    // A bounded LRU cache of posteriors keyed by serialized conditioning data.
+    class PosteriorCache : noncopyable
+    {
+    public:
+
+        explicit PosteriorCache (size_t capacity) :
+            capacity_(capacity),
+            hits_(0),
+            misses_(0)
+        {
+        }
+
+        typedef std::shared_ptr<const Posterior> Value;
+
+        Value find (const std::string & key);
+        void insert (const std::string & key, const Value & value);
+
+        size_t capacity () const { return capacity_; }
+        size_t hits () const { return hits_; }
+        size_t misses () const { return misses_; }
+
+    private:
+
+        typedef std::list<std::pair<std::string, Value>> List;
+
+        const size_t capacity_;
+        std::mutex mutex_;
+        List lru_;
+        std::unordered_map<std::string, List::iterator> index_;
+        size_t hits_;
+        size_t misses_;
+    };
+
+    void compute_posterior (
+            rng_t & rng,
+            const ProductValue::Diff & data,
+            Posterior & posterior) const;
+
+    std::shared_ptr<const Posterior> get_posterior (
+            rng_t & rng,
+            const ProductValue::Diff & data) const;
+
     const ValueSchema schema () const { return cross_cats_[0]->schema; }
     const std::vector<ProductValue> tares () const
     {
         return cross_cats_[0]->tares;
     }
 
+    void load_rows ();
+    size_t row_count () const;
+
+    template<class Fun>
+    void for_each_row (const Fun & fun) const;
+
+    float score (rng_t & rng, const ProductValue::Diff & data) const;
+
+    // not threadsafe
+    void update_baseline (rng_t & rng) const;
+    bool load_baseline (const std::string & fingerprint) const;
+    void dump_baseline (const std::string & fingerprint) const;
+
+    // not threadsafe
+    void update_group_index () const;
+    void get_candidates (
+            const std::vector<protobuf::Assignment> & assignments,
+            std::unordered_set<uint64_t> & candidates) const;
+
     bool validate (
             const Query::Sample::Request & request,
             Errors & errors) const;
 
+    bool validate (
+            const Query::BatchSample::Request & request,
+            Errors & errors) const;
+
     bool validate (
             const Query::Score::Request & request,
             Errors & errors) const;
 
+    bool validate (
+            const Query::BatchScore::Request & request,
+            Errors & errors) const;
+
     bool validate (
             const Query::Entropy::Request & request,
             Errors & errors) const;
@@ -81,16 +273,30 @@ private:
             const Query::ScoreDerivative::Request & request,
             Errors & errors) const;
 
+    bool validate (
+            const Query::BatchScoreDerivative::Request & request,
+            Errors & errors) const;
+
     void call (
             rng_t & rng,
             const Query::Sample::Request & request,
             Query::Sample::Response & response) const;
 
+    void call (
+            rng_t & rng,
+            const Query::BatchSample::Request & request,
+            Query::BatchSample::Response & response) const;
+
     void call (
             rng_t & rng,
             const Query::Score::Request & request,
             Query::Score::Response & response) const;
 
+    void call (
+            rng_t & rng,
+            const Query::BatchScore::Request & request,
+            Query::BatchScore::Response & response) const;
+
     void call (
             rng_t & rng,
             const Query::Entropy::Request & request,
@@ -102,10 +308,70 @@ private:
             const Query::ScoreDerivative::Request & request,
             Query::ScoreDerivative::Response & response) const;
 
+    // not threadsafe
+    void call (
+            rng_t & rng,
+            const Query::BatchScoreDerivative::Request & request,
+            Query::BatchScoreDerivative::Response & response) const;
+
     const protobuf::Config config_;
     const std::vector<const CrossCat *> cross_cats_;
+    const store::Paths paths_;
     const char * rows_in_;
+    bool rows_cached_;
+    std::vector<uint64_t> row_ids_;
+    // serialized diffs, back to back; row i spans row_offsets_[i, i + 1]
+    std::string row_data_;
+    std::vector<size_t> row_offsets_;
+
+    // lazily computed scores of dataset rows WRT the unmodified model
+    mutable bool baseline_cached_;
+    mutable std::vector<uint64_t> baseline_ids_;
+    mutable std::vector<float> baseline_scores_;
+
+    // lazily loaded map (sample, kind, groupid) -> rowids, for pruning
+    struct GroupIndex
+    {
+        std::vector<size_t> offsets;
+        std::vector<uint64_t> rowids;
+    };
+    mutable bool group_index_cached_;
+    mutable std::vector<std::vector<GroupIndex>> group_index_;
+    mutable PosteriorCache posterior_cache_;
+    mutable SharedMutex mutex_;
     Timer timer_;
 };
 
+inline size_t QueryServer::row_count () const
+{
+    if (rows_cached_) {
+        return row_ids_.size();
+    } else if (baseline_cached_) {
+        return baseline_ids_.size();
+    } else {
+        return protobuf::InFile::stream_stats(rows_in_).message_count;
+    }
+}
+
+template<class Fun>
+inline void QueryServer::for_each_row (const Fun & fun) const
+{
+    if (rows_cached_) {
+        ProductValue::Diff diff;
+        const size_t row_count = row_ids_.size();
+        for (size_t i = 0; i < row_count; ++i) {
+            const size_t begin = row_offsets_[i];
+            const size_t size = row_offsets_[i + 1] - begin;
+            diff.ParseFromArray(row_data_.data() + begin, size);
+            fun(row_ids_[i], diff);
+        }
+    } else {
+        protobuf::InFile rows(rows_in_);
+        protobuf::Row row;
+        while (rows.try_read_stream(row)) {
+            fun(row.id(), row.diff());
+        }
+    }
+}
+
 } // namespace loom
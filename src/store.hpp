@@ -28,6 +28,7 @@
 
 # pragma once
 
+#include <sys/stat.h>
 #include <sstream>
 #include <fstream>
 #include <loom/common.hpp>
@@ -53,8 +54,15 @@ struct Paths
         std::string assign;
     };
 
+    struct Query
+    {
+        std::string root;
+        std::string baseline_scores;
+    };
+
     Ingest ingest;
     std::vector<Sample> samples;
+    Query query;
 };
 
 inline std::string get_mixture_path (
@@ -80,6 +88,8 @@ inline Paths get_paths (const std::string & root)
     Paths paths;
     paths.ingest.tares = root + "/ingest/tares.pbs.gz";
     paths.ingest.diffs = root + "/ingest/diffs.pbs.gz";
+    paths.query.root = root + "/query";
+    paths.query.baseline_scores = root + "/query/baseline_scores.pbs.gz";
     for (size_t seed = 0;; ++seed) {
         const std::string sample_root = get_sample_path(root, seed);
         if (std::ifstream(sample_root)) {
@@ -96,5 +106,28 @@ inline Paths get_paths (const std::string & root)
     return paths;
 }
 
+// Summarizes the files that determine query results, so that caches under
+// paths.query can be invalidated when the dataset or samples change.
+inline std::string get_fingerprint (const Paths & paths)
+{
+    std::ostringstream fingerprint;
+    auto add = [&](const std::string & filename) {
+        struct stat info;
+        if (stat(filename.c_str(), & info) == 0) {
+            fingerprint << filename << ' ' << info.st_size
+                        << ' ' << info.st_mtime << '\n';
+        } else {
+            fingerprint << filename << " missing\n";
+        }
+    };
+    add(paths.ingest.tares);
+    add(paths.ingest.diffs);
+    for (const auto & sample : paths.samples) {
+        add(sample.model);
+        add(sample.assign);
+    }
+    return fingerprint.str();
+}
+
 } // namespace store
 } // namespace loom